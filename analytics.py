@@ -0,0 +1,134 @@
+"""Columnar analytics functions used in Personal Music Collection project (needs numpy)."""
+
+from db import connection, read_transaction
+from functions import BATCH_SIZE
+
+
+""" // COLUMNAR ANALYTICS FUNCTIONS // """
+
+def fetch_rows(sql, conn):
+    """Count a query's rows, then yield them BATCH_SIZE at a time in its own order (both reads see the same snapshot)."""
+    with read_transaction(conn):
+        total = conn.execute(f"""SELECT COUNT(*) FROM ({sql})""").fetchone()[0]
+        yield total
+        cursor = conn.execute(sql)
+        while True:
+            rows = cursor.fetchmany(BATCH_SIZE)
+            if not rows:
+                return
+            yield rows
+
+def fetch_columns(sql, count, conn):
+    """Run a query with `count` integer columns and return each column as an int64 array."""
+    import numpy as np
+    batches = fetch_rows(sql, conn)
+    total = next(batches)
+    columns = [np.empty(total, dtype=np.int64) for i in range(count)]
+    filled = 0
+    for rows in batches:
+        batch = np.array(rows, dtype=np.int64).reshape(len(rows), count)
+        for column, values in zip(columns, batch.T):
+            column[filled:filled + len(rows)] = values
+        filled += len(rows)
+    return columns
+
+def fetch_names(sql, conn):
+    """Run a query selecting (id, name) ordered by id; return the ids as an array and the names as a list."""
+    import numpy as np
+    batches = fetch_rows(sql, conn)
+    total = next(batches)
+    ids, names = np.empty(total, dtype=np.int64), [None] * total
+    filled = 0
+    for rows in batches:
+        ids[filled:filled + len(rows)] = [row[0] for row in rows]
+        names[filled:filled + len(rows)] = [row[1] for row in rows]
+        filled += len(rows)
+    return ids, names
+
+def decode(ids, sql, conn):
+    """The names of some sorted, distinct ids, looked up from an (id, name) query ordered by id."""
+    import numpy as np
+    known, names = fetch_names(sql, conn)
+    if not names:
+        return [None] * len(ids)
+    positions = np.minimum(np.searchsorted(known, ids), len(known) - 1)
+    found = np.array(names + [None], dtype=object)
+    return found[np.where(known[positions] == ids, positions, len(names))].tolist()
+
+def collection_columns(owned=True, conn=None):
+    """The joined collection as dictionary-encoded NumPy columns, one row per (album, format)."""
+    import numpy as np # only needed here, so the rest of the module works without it
+    conn = connection(conn)
+    if owned:
+        albums = """SELECT album_id FROM FormattedAlbums"""
+        rows_sql = """
+            SELECT FormattedAlbums.album_id, Albums.artist_id, COALESCE(Albums.year, 0), FormattedAlbums.format_id
+            FROM FormattedAlbums
+            JOIN Albums ON FormattedAlbums.album_id = Albums.id
+            ORDER BY FormattedAlbums.album_id, FormattedAlbums.format_id"""
+    else:
+        albums = """SELECT id FROM Albums"""
+        rows_sql = """
+            SELECT Albums.id, Albums.artist_id, COALESCE(Albums.year, 0), COALESCE(FormattedAlbums.format_id, 0)
+            FROM Albums
+            LEFT JOIN FormattedAlbums ON Albums.id = FormattedAlbums.album_id
+            ORDER BY Albums.id, FormattedAlbums.format_id"""
+    row_albums, row_artists, row_years, row_formats = fetch_columns(rows_sql, 4, conn)
+    album_ids, album_codes = np.unique(row_albums, return_inverse=True)
+    artist_ids, artist_codes = np.unique(row_artists, return_inverse=True)
+    format_ids, format_codes = np.unique(row_formats, return_inverse=True)
+    # reading every album and dropping the ones not wanted is quicker than looking each one up, unless most aren't wanted
+    total = conn.execute("""SELECT COUNT(*) FROM Albums""").fetchone()[0]
+    wanted = f"IN ({albums})" if len(album_ids) * 2 < total else "IS NOT NULL"
+    titles = decode(album_ids, f"""SELECT id, title AS name FROM Albums WHERE id {wanted} ORDER BY id""", conn)
+    artists = decode(artist_ids, """SELECT id, name FROM Artists ORDER BY id""", conn)
+    formats = decode(format_ids, """SELECT id, format_name AS name FROM Formats ORDER BY id""", conn)
+
+    # genres as CSR: each row's genre codes sit next to each other, rows found through the offsets
+    pair_albums, pair_genres = fetch_columns(f"""
+        SELECT album_id, genre_id FROM AlbumGenres WHERE album_id {wanted}
+        ORDER BY album_id, genre_id""", 2, conn)
+    keep = np.isin(pair_albums, album_ids)
+    pair_albums, pair_genres = pair_albums[keep], pair_genres[keep]
+    genre_ids, pair_codes = np.unique(pair_genres, return_inverse=True)
+    genres = decode(genre_ids, """SELECT id, genre_name AS name FROM Genres ORDER BY id""", conn)
+    starts = np.searchsorted(pair_albums, row_albums, side='left')
+    lengths = np.searchsorted(pair_albums, row_albums, side='right') - starts
+    offsets = np.zeros(len(row_albums) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=offsets[1:])
+    positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+    return {
+        'album': album_codes.astype(np.int32), 'titles': titles, # codes into the names lists
+        'artist': artist_codes.astype(np.int32), 'artists': artists,
+        'year': row_years.astype(np.int16), # 0 when unknown
+        'format': format_codes.astype(np.int32), 'formats': formats, # None for albums I don't own (owned=False)
+        # the genres of row i are genre[genre_offsets[i]:genre_offsets[i + 1]]
+        'genre_offsets': offsets, 'genre': pair_codes[positions].astype(np.int32), 'genres': genres,
+    }
+
+def count_table(row_codes, row_count, column_codes, column_count):
+    """Cross-tabulate two code arrays into a (row_count x column_count) matrix of counts with one bincount."""
+    import numpy as np
+    cells = row_codes.astype(np.int64) * column_count + column_codes
+    return np.bincount(cells, minlength=row_count * column_count).reshape(row_count, column_count)
+
+def decade_format_table(columns):
+    """(decades, formats, counts) where counts[i, j] is how many albums from decades[i] I have on formats[j]."""
+    import numpy as np
+    known = columns['year'] > 0
+    decades, decade_codes = np.unique(columns['year'][known] // 10 * 10, return_inverse=True)
+    counts = count_table(decade_codes, len(decades), columns['format'][known], len(columns['formats']))
+    return decades, columns['formats'], counts
+
+def genre_format_table(columns):
+    """(genres, formats, counts) where counts[i, j] is how many albums tagged genres[i] I have on formats[j]."""
+    import numpy as np
+    lengths = np.diff(columns['genre_offsets'])
+    formats_of_tags = np.repeat(columns['format'], lengths) # the format of the row each genre tag belongs to
+    counts = count_table(columns['genre'], len(columns['genres']), formats_of_tags, len(columns['formats']))
+    return columns['genres'], columns['formats'], counts
+
+def genres_of_row(columns, row):
+    """The genre names of one row of collection_columns."""
+    start, end = columns['genre_offsets'][row], columns['genre_offsets'][row + 1]
+    return [columns['genres'][code] for code in columns['genre'][start:end]]
@@ -0,0 +1,653 @@
+"""Benchmarks for the Personal Music Collection project.
+Run `python benchmarks.py search` to compare fuzzy search with the old exact/LIKE lookups,
+`python benchmarks.py match` to measure how well and how fast my albums are matched to the catalogs,
+`python benchmarks.py suite --output results.json` to time every public function at 1k/100k albums,
+`python benchmarks.py compare old.json new.json` to see what got slower between two commits,
+`python benchmarks.py memory` to compare nested lists with the compact collection.Collection,
+`python benchmarks.py startup` to time imports and how soon user_music.py shows its menu,
+`python benchmarks.py snapshot --synthetic 100000` to compare a collection.py snapshot file with the database,
+`python benchmarks.py mutate --synthetic 100000 --queries 2000` to compare the bulk mutation functions with one-album-at-a-time calls,
+and `python benchmarks.py ingest --synthetic 500000 --workers 1 2 4` to see how catalog imports scale with worker processes."""
+
+import argparse
+import contextlib
+import csv
+import functools
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+import analytics
+import catalog
+import collection
+import db
+import functions
+import history
+import my_music
+import mutations
+import search
+import similarity
+
+CATALOGS = ['all.csv', 'rym_top_5000_all_time.csv']
+
+
+""" // DATA SET-UP // """
+
+def catalog_words():
+    """Every distinct word used in the all.csv titles and artist names, so made-up albums read like real ones."""
+    words = set()
+    for record, info in catalog.catalog_records('all.csv'):
+        words.update(record[0].split())
+        words.update(record[1].split())
+    return sorted(words)
+
+def catalog_profile():
+    """The shape of real collections, from both catalogs: release years, genre tags, tags per album and albums per artist."""
+    years, genres, fan_out, artists = [], [], [], Counter()
+    for path in CATALOGS:
+        for (title, artist, year, tags), info in catalog.catalog_records(path):
+            if year:
+                years.append(year)
+            genres.extend(tags)
+            fan_out.append(len(tags))
+            artists[artist] += 1
+    return {'years': years, 'genres': genres, 'fan_out': fan_out, 'albums_per_artist': list(artists.values())}
+
+def synthetic_records(count, seed=0):
+    """Make up `count` ([title, artist, year, [genres...]], format) pairs shaped like catalog_profile(), the same ones for the same seed."""
+    rng = random.Random(seed)
+    words = catalog_words()
+    profile = catalog_profile()
+    formats = {'CD': len(my_music.cds), 'cassette': len(my_music.cassettes), 'vinyl': len(my_music.vinyl)}
+    number = 0
+    while number < count:
+        artist = ' '.join(rng.sample(words, rng.randint(1, 3)))
+        for _ in range(rng.choice(profile['albums_per_artist'])):
+            if number == count:
+                break
+            title = ' '.join(rng.sample(words, rng.randint(1, 5))) + f' {seed}-{number}' # titles are unique in Albums
+            genres = list(dict.fromkeys(rng.choices(profile['genres'], k=max(1, rng.choice(profile['fan_out'])))))
+            record = [title, artist, rng.choice(profile['years']), genres]
+            yield record, rng.choices(list(formats), weights=list(formats.values()))[0]
+            number += 1
+
+def add_synthetic(conn, count, seed=0, chunk_size=5000):
+    """Bulk load `count` made-up albums, one add_music call per format per chunk; returns the seconds of each call."""
+    latencies = []
+    for chunk in functions.chunked(synthetic_records(count, seed), chunk_size):
+        by_format = {}
+        for record, format_name in chunk:
+            by_format.setdefault(format_name, []).append(record)
+        for format_name, records in by_format.items():
+            start = time.perf_counter()
+            functions.add_music(records, format_name, conn=conn)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+def build_database(path, synthetic=0, seed=0, catalogs=True):
+    """Create a database at `path` with my collection, both catalogs (unless catalogs=False) and `synthetic` made-up albums."""
+    conn = db.connect(path)
+    functions.create_tables(conn=conn)
+    functions.add_music(my_music.cds, 'CD', conn=conn)
+    functions.add_music(my_music.cassettes, 'cassette', conn=conn)
+    functions.add_music(my_music.vinyl, 'vinyl', conn=conn)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for catalog_path in CATALOGS if catalogs else []:
+            catalog.import_catalog(catalog_path, conn=conn)
+    add_synthetic(conn, synthetic, seed)
+    return conn
+
+def typo(text, rng):
+    """Misspell text the way people do: drop, double or swap a letter."""
+    i = rng.randrange(1, max(2, len(text) - 1))
+    kind = rng.choice(['drop', 'double', 'swap'])
+    if kind == 'drop':
+        return text[:i] + text[i + 1:]
+    if kind == 'double':
+        return text[:i] + text[i] + text[i:]
+    return text[:i - 1] + text[i] + text[i - 1] + text[i + 1:]
+
+
+def perturb(text, rng):
+    """Write a title or name differently without it becoming a different album (a typo, casing, '&' for 'and', 'The'...)."""
+    kind = rng.choice(['typo', 'case', 'and', 'the', 'punctuation'])
+    if kind == 'typo' and len(text) > 4:
+        return typo(text, rng)
+    if kind == 'case':
+        return text.lower() if rng.random() < 0.5 else text.upper()
+    if kind == 'and' and (' and ' in text or ' & ' in text):
+        return text.replace(' and ', ' & ') if ' and ' in text else text.replace(' & ', ' and ')
+    if kind == 'the':
+        return text[4:] if text.startswith('The ') else 'The ' + text
+    return text.replace(' ', ' - ', 1) + '!'
+
+
+""" // TIMING // """
+
+def time_calls(function, calls):
+    """Run function once per argument tuple; return the results and the latency of each call in milliseconds."""
+    results, latencies = [], []
+    for args in calls:
+        start = time.perf_counter()
+        results.append(function(*args))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, latencies
+
+def percentile(ordered, fraction):
+    """The value `fraction` of the way through an already sorted list."""
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def summarize(latencies):
+    """Mean, median, p95 and p99 latency (ms) of a list of timings."""
+    ordered = sorted(latencies)
+    return {'calls': len(ordered), 'mean_ms': statistics.fmean(ordered), 'p50_ms': percentile(ordered, 0.5),
+            'p95_ms': percentile(ordered, 0.95), 'p99_ms': percentile(ordered, 0.99)}
+
+
+""" // SEARCH BENCHMARK // """
+
+def exact_lookup(conn, text):
+    """Today's behaviour: titles and artist names have to match exactly."""
+    return conn.execute("""
+        SELECT title FROM Albums WHERE title = ?
+        UNION ALL
+        SELECT Albums.title FROM Albums JOIN Artists ON Albums.artist_id = Artists.id WHERE Artists.name = ?""",
+        (text, text)).fetchall()
+
+def like_scan(conn, text):
+    """A substring LIKE search, which scans every album."""
+    pattern = f'%{text}%'
+    return conn.execute("""
+        SELECT Albums.title FROM Albums JOIN Artists ON Albums.artist_id = Artists.id
+        WHERE Albums.title LIKE ? OR Artists.name LIKE ?""", (pattern, pattern)).fetchall()
+
+def fuzzy(conn, text):
+    """The new trigram index search."""
+    return [(title,) for score, title, artist, year in search.fuzzy_search(text, limit=5, conn=conn)]
+
+def benchmark_search(conn, queries=200, seed=0):
+    """Look up misspelled titles from my collection with each method; report latency and how often the album was found."""
+    rng = random.Random(seed)
+    collection = my_music.cds + my_music.cassettes + my_music.vinyl
+    titles = [rng.choice(collection)[0] for _ in range(queries)]
+    calls = [(conn, typo(title, rng)) for title in titles]
+    report = {}
+    for name, method in [('exact', exact_lookup), ('like', like_scan), ('fuzzy', fuzzy)]:
+        results, latencies = time_calls(method, calls)
+        found = sum(any(row[0] == title for row in rows) for title, rows in zip(titles, results))
+        report[name] = dict(summarize(latencies), found=found / queries)
+    return report
+
+""" // MATCHING BENCHMARK // """
+
+def catalog_albums(conn):
+    """(id, title, artist) for every album in the catalogs."""
+    return conn.execute("""
+        SELECT Albums.id, Albums.title, Artists.name FROM Albums
+        JOIN Artists ON Albums.artist_id = Artists.id
+        WHERE Albums.id IN (SELECT album_id FROM CatalogAlbums)""").fetchall()
+
+def loop_match(owned, catalog, threshold=0.8):
+    """The obvious way: compare every owned album with every catalog album in Python."""
+    matches = []
+    for album_id, title, artist in owned:
+        score, catalog_id = max((0.7 * search.similarity(title, other_title) + 0.3 * search.similarity(artist, other_artist), other_id)
+                                for other_id, other_title, other_artist in catalog)
+        if score >= threshold:
+            matches.append((album_id, catalog_id, score))
+    return matches
+
+def benchmark_match(conn, queries=1000, seed=0):
+    """Precision, recall and albums/sec matching re-spelled copies of catalog albums back against the catalog."""
+    rng = random.Random(seed)
+    catalog_rows = catalog_albums(conn)
+    # the catalogs list some albums twice ('Love It to Death' / 'Love It To Death'), so a match to either copy counts as right
+    keys = {album_id: (catalog.normalize_name(title), catalog.normalize_name(artist)) for album_id, title, artist in catalog_rows}
+    sample = rng.sample(catalog_rows, min(queries, len(catalog_rows)))
+    owned = [(album_id, perturb(title, rng), perturb(artist, rng) if rng.random() < 0.3 else artist)
+             for album_id, title, artist in sample]
+    report = {}
+    for name, method, albums in [('numpy', catalog.match_records, owned), ('loop', loop_match, owned[:max(1, len(owned) // 10)])]:
+        start = time.perf_counter()
+        matches = method(albums, catalog_rows)
+        seconds = time.perf_counter() - start
+        correct = sum(keys[album_id] == keys[catalog_id] for album_id, catalog_id, score in matches)
+        report[name] = {'albums': len(albums), 'precision': correct / len(matches) if matches else 0.0,
+                        'recall': correct / len(albums), 'albums_per_sec': len(albums) / seconds}
+    return report
+
+""" // FUNCTION SUITE // """
+
+SUITE_SIZES = [1000, 100000] # add 1000000 with `--sizes`; it takes several minutes to build
+
+def quietly(function):
+    """Wrap a function that prints so its output doesn't flood the benchmark report."""
+    def run(*args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return function(*args, **kwargs)
+    return run
+
+def first_page(iter_function):
+    """What a search_by_* prompt costs before the user sees anything: the first page of an iter_* function."""
+    def run(*args, **kwargs):
+        return list(itertools.islice(iter_function(*args, **kwargs), functions.PAGE_SIZE))
+    return run
+
+def suite_calls(conn, calls, seed=0):
+    """(name, function, argument tuples) for each public function worth timing, drawn from the database by seed."""
+    rng = random.Random(seed)
+    def pick(sql):
+        values = [row[0] for row in conn.execute(sql).fetchall()]
+        return [rng.choice(values) for _ in range(calls)] if values else []
+    genres = pick("""SELECT Genres.genre_name FROM GenreStats JOIN Genres ON GenreStats.genre_id = Genres.id WHERE album_count > 0""")
+    artists = pick("""SELECT Artists.name FROM ArtistStats JOIN Artists ON ArtistStats.artist_id = Artists.id WHERE album_count > 0""")
+    titles = pick("""SELECT Albums.title FROM Albums JOIN FormattedAlbums ON Albums.id = FormattedAlbums.album_id""")
+    formats = pick("""SELECT format_name FROM Formats""")
+    years = [(start, start + rng.randint(0, 9)) for start in (rng.randint(1950, 2020) for _ in range(calls))]
+    possibilities = functions.sample_albums(50, rng=seed, conn=conn)
+    new_records = [record for record, format_name in synthetic_records(calls, seed + 1)]
+    columns = analytics.collection_columns(conn=conn)
+    batches = [[record for record, format_name in synthetic_records(500, seed + 2 + batch)] for batch in range(max(1, calls // 10))]
+    similarity.similarity_index(conn=conn) # built once up front, not inside the first timed call
+    on = lambda function: functools.partial(getattr(function, '__wrapped__', function), conn=conn) # time the queries, not the result cache
+    return [
+        ('get_albums_by_genre', on(functions.get_albums_by_genre), [(genre,) for genre in genres]),
+        ('get_albums_by_genre (result cache)', functools.partial(functions.get_albums_by_genre, conn=conn), [(genre,) for genre in genres]),
+        ('get_albums_by_artist', on(functions.get_albums_by_artist), [(artist,) for artist in artists]),
+        ('get_albums_by_media', on(functions.get_albums_by_media), [(media,) for media in formats[:5]]),
+        ('get_formatted_albums', on(functions.get_formatted_albums), [()] * 3),
+        ('get_genres_for_album', on(functions.get_genres_for_album), [(title,) for title in titles]),
+        ('genre listing, N+1 queries', functools.partial(genre_listing_one_by_one, conn=conn), [(genre,) for genre in genres]),
+        ('genre listing, get_album_view', on(functions.get_album_view), [(genre,) for genre in genres]),
+        ('get_album_view (2 genres, all)', on(functions.get_album_view), [((genre, other), 'all') for genre, other in zip(genres, reversed(genres))]),
+        ('formatted_album_between_years', on(functions.formatted_album_between_years), years),
+        ('artist_album_count', on(functions.artist_album_count), [(artist,) for artist in artists]),
+        ('descending_count_albums_by_artist', on(functions.descending_count_albums_by_artist), [()] * 5),
+        ('genre_album_counts', on(functions.genre_album_counts), [()] * 5),
+        ('decade_format_counts', on(functions.decade_format_counts), [()] * calls),
+        ('collection_columns', on(analytics.collection_columns), [()] * 3),
+        ('decade_format_table', analytics.decade_format_table, [(columns,)] * calls),
+        ('genre_format_table', analytics.genre_format_table, [(columns,)] * calls),
+        ('find_album_id', on(functions.find_album_id), [(title,) for title in titles]),
+        ('iter_albums_by_genre (first page)', first_page(on(functions.iter_albums_by_genre)), [(genre,) for genre in genres]),
+        ('iter_albums_by_artist (first page)', first_page(on(functions.iter_albums_by_artist)), [(artist,) for artist in artists]),
+        ('fuzzy_search', on(search.fuzzy_search), [(typo(title, rng),) for title in titles]),
+        ('fuzzy_find_artist', on(search.fuzzy_find_artist), [(typo(artist, rng),) for artist in artists]),
+        ('similar_albums', on(similarity.similar_albums), [(title,) for title in titles]),
+        ('recommend_albums', on(similarity.recommend_albums), [()] * 5),
+        ('count_albums', on(functions.count_albums), years),
+        ('sample_albums', on(functions.sample_albums), [(5, None, None, genre) for genre in genres]),
+        ('sample_albums (rating weight)', on(functions.sample_albums), [(5, None, None, genre, None, 'rating') for genre in genres]),
+        ('sample_albums (fresh weight)', on(functions.sample_albums), [(5, None, None, genre, None, 'fresh') for genre in genres]),
+        ('suggest_albums', quietly(functions.suggest_albums), [(possibilities, 5)] * calls),
+        ('record_suggestions (buffered)', on(history.record_suggestions), [(possibilities[:5],)] * calls),
+        ('insert_album', quietly(on(functions.insert_album)), [tuple(record[:3]) for record in new_records]),
+        ('insert_formatted_album', on(functions.insert_formatted_album), [(record[0], 'vinyl') for record in new_records]),
+        ('associate_album_with_genres', quietly(on(functions.associate_album_with_genres)), [(record[0], record[3]) for record in new_records]),
+        ('add_music (500 albums)', quietly(on(functions.add_music)), [(batch, 'CD') for batch in batches]),
+    ]
+
+def genre_listing_one_by_one(genre, conn):
+    """Listing a genre's albums with all of their genres the old way: get_albums_by_genre, then get_genres_for_album per row."""
+    rows = functions.get_albums_by_genre.__wrapped__(genre, conn=conn)
+    return [row + (functions.get_genres_for_album.__wrapped__(row[0], conn=conn),) for row in rows]
+
+def benchmark_suite(conn, calls=100, seed=0):
+    """Time every call of suite_calls; returns {name: latency summary + calls/sec + average rows returned}."""
+    report = {}
+    for name, function, arguments in suite_calls(conn, calls, seed):
+        if not arguments:
+            continue
+        results, latencies = time_calls(function, arguments)
+        sizes = [len(result) for result in results if isinstance(result, (list, tuple))]
+        report[name] = dict(summarize(latencies), calls_per_sec=len(latencies) / (sum(latencies) / 1000 or 1e-9),
+                            rows=statistics.fmean(sizes) if sizes else 0.0)
+    return report
+
+def run_suite(sizes, calls=100, seed=0):
+    """Build a database of each size, time the build and every function, and return the whole lot as a JSON-ready dict."""
+    results = {'commit': git_commit(), 'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+               'seed': seed, 'calls': calls, 'sizes': {}}
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            conn = build_database(os.path.join(directory, 'bench.db'), catalogs=False)
+            existing = conn.execute("""SELECT COUNT(*) FROM Albums""").fetchone()[0]
+            synthetic = max(0, size - existing)
+            start = time.perf_counter()
+            batches = add_synthetic(conn, synthetic, seed)
+            seconds = time.perf_counter() - start
+            build = dict(summarize(batches or [0.0]), albums=synthetic, seconds=seconds,
+                         albums_per_sec=synthetic / seconds if seconds else 0.0)
+            albums = conn.execute("""SELECT COUNT(*) FROM Albums""").fetchone()[0]
+            print(f"\n{albums} albums (built {synthetic} in {seconds:.1f}s):")
+            report = benchmark_suite(conn, calls, seed)
+            print_report(report)
+            results['sizes'][str(size)] = {'albums': albums, 'build': build, 'functions': report}
+            conn.close()
+    return results
+
+def git_commit():
+    """The commit being benchmarked, so result files can be told apart."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare_results(old, new):
+    """p50 latency of every function in both result files, and how many times slower (>1) or faster (<1) it got."""
+    print(f"\n{old.get('commit')} -> {new.get('commit')}")
+    for size, measured in new['sizes'].items():
+        before = old['sizes'].get(size)
+        if not before:
+            continue
+        print(f"\n{measured['albums']} albums:")
+        for name, row in measured['functions'].items():
+            if name in before['functions']:
+                was = before['functions'][name]['p50_ms']
+                ratio = row['p50_ms'] / was if was else float('inf')
+                flag = '  <-- slower' if ratio > 1.25 else ''
+                print(f"{name:>36}: {was:9.3f} -> {row['p50_ms']:9.3f} ms  x{ratio:.2f}{flag}")
+
+
+""" // MEMORY BENCHMARK // """
+
+def measure_memory(build):
+    """Bytes still allocated by whatever `build()` returns, and the thing itself."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+def benchmark_memory(count, seed=0, calls=100):
+    """Bytes per album as nested lists vs a collection.Collection, and in-memory vs database search/suggestion speed."""
+    report = {}
+    sources = {
+        'rym csv': (lambda: [record for record, info in catalog.catalog_records(CATALOGS[1])],
+                    lambda: collection.Collection.from_csv(CATALOGS[1])),
+        f'{count} made-up': (lambda: [[title, artist, year, list(genres)] for (title, artist, year, genres), format_name in synthetic_records(count, seed)],
+                             lambda: collection.Collection().extend(record for record, format_name in synthetic_records(count, seed))),
+    }
+    for name, (as_lists, as_collection) in sources.items():
+        list_bytes, lists = measure_memory(as_lists)
+        collection_bytes, albums = measure_memory(as_collection)
+        report[name] = {'albums': len(lists), 'list_bytes_per_album': list_bytes / len(lists),
+                        'collection_bytes_per_album': collection_bytes / len(albums), 'times_smaller': list_bytes / collection_bytes}
+        del lists, albums
+
+    with tempfile.TemporaryDirectory() as directory:
+        conn = build_database(os.path.join(directory, 'bench.db'), catalogs=False)
+        add_synthetic(conn, count, seed)
+        albums = collection.Collection.from_database(conn=conn)
+        rng = random.Random(seed)
+        genres = [rng.choice(albums.genres.names) for _ in range(calls)]
+        artists = [rng.choice(albums.artists.names) for _ in range(calls)]
+        albums.matching(genre=genres[0], media='CD', artist=artists[0]) # build the indexes up front, as a long-running app would
+        for name, function, arguments in [
+            ('database sample_albums', functools.partial(functions.sample_albums, conn=conn), [(5, None, None, genre) for genre in genres]),
+            ('memory sample_albums', albums.sample_albums, [(5, None, None, genre) for genre in genres]),
+            ('database get_albums_by_artist', functools.partial(functions.get_albums_by_artist.__wrapped__, conn=conn), [(artist,) for artist in artists]),
+            ('memory albums_by_artist', albums.albums_by_artist, [(artist,) for artist in artists]),
+        ]:
+            results, latencies = time_calls(function, arguments)
+            report[name] = summarize(latencies)
+        conn.close()
+    return report
+
+""" // INGESTION BENCHMARK // """
+
+def write_dump(path, count, seed=0):
+    """Write `count` made-up albums to an all.csv-style file (title, artist, year, lists, url, id, genres, styles)."""
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file, quoting=csv.QUOTE_ALL)
+        for number, ((title, artist, year, genres), format_name) in enumerate(synthetic_records(count, seed)):
+            writer.writerow([title, artist, year, 'made-up', f'https://example.com/{seed}/{number}', number,
+                             '; '.join(genres[:2]), ', '.join(genres[2:])])
+
+def benchmark_ingest(count, files=4, worker_counts=(1, 2, 4), seed=0):
+    """Rows/sec importing `files` made-up catalog dumps serially and with each number of worker processes."""
+    report = {}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, f'dump{number}.csv') for number in range(files)]
+        for number, path in enumerate(paths):
+            write_dump(path, count // files, seed + number)
+        runs = [('import_catalog', None)] + [(f'import_catalogs ({workers} workers)', workers) for workers in worker_counts]
+        for name, workers in runs:
+            conn = db.connect(os.path.join(directory, f'{name}.db'))
+            functions.create_tables(conn=conn)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                if workers is None:
+                    for path in paths:
+                        catalog.import_catalog(path, chunk_size=5000, conn=conn)
+                    stats = {}
+                else:
+                    stats = catalog.import_catalogs(paths, workers, conn=conn)
+            seconds = time.perf_counter() - start
+            report[name] = {'rows': count, 'seconds': seconds, 'rows_per_sec': count / seconds,
+                            'writer_waiting': stats.get('wait_seconds', 0.0), 'writing': stats.get('write_seconds', seconds)}
+            conn.close()
+    return report
+
+""" // STARTUP BENCHMARK // """
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def time_process(command, cwd, answers=None, until=()):
+    """Milliseconds until `command` exits or, with `until`, prints each of those prompts (answered from `answers`)."""
+    environment = dict(os.environ, PYTHONPATH=HERE, PYTHONUNBUFFERED='1')
+    environment.pop('PYTHONDONTWRITEBYTECODE', None) # time imports the way they usually run, from cached bytecode
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, env=environment, text=True,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if not until:
+        process.communicate()
+        return [(time.perf_counter() - start) * 1000]
+    marks = []
+    answers = list(answers or [])
+    for line in process.stdout:
+        if line.startswith(until[len(marks)]):
+            marks.append((time.perf_counter() - start) * 1000)
+            if len(marks) == len(until):
+                break
+            process.stdin.write(answers.pop(0) + '\n')
+            process.stdin.flush()
+    process.kill()
+    process.wait()
+    return marks
+
+def benchmark_startup(runs=10):
+    """How long importing functions/user_music takes, and how soon user_music.py asks its first question and shows the menu."""
+    report = {}
+    python = [sys.executable]
+    baseline = statistics.median(time_process(python + ['-c', 'pass'], HERE)[0] for _ in range(runs))
+    for module in ['functions', 'user_music']:
+        times = [time_process(python + ['-c', f'import {module}'], HERE)[0] - baseline for _ in range(runs)]
+        report[f'import {module}'] = summarize(times)
+    prompts = ("Will you be using", "Choose '1', '2', or '3'")
+    with tempfile.TemporaryDirectory() as directory:
+        warm = os.path.join(directory, 'warm')
+        os.mkdir(warm)
+        shutil.copy(os.path.join(HERE, db.DATABASE), warm)
+        time_process(python + [os.path.join(HERE, 'user_music.py')], warm, ['yes', '9'], prompts + ('Invalid',)) # sync it once
+        for name, fresh in [('in sync', False), ('no database', True)]:
+            first, menu = [], []
+            for run in range(runs):
+                cwd = warm
+                if fresh:
+                    cwd = os.path.join(directory, f'fresh{run}')
+                    os.mkdir(cwd)
+                marks = time_process(python + [os.path.join(HERE, 'user_music.py')], cwd, ['yes'], prompts)
+                first.append(marks[0])
+                menu.append(marks[1])
+            report[f'first prompt ({name})'] = summarize(first)
+            report[f'menu ({name})'] = summarize(menu)
+    return report
+
+""" // BULK MUTATION BENCHMARK // """
+
+def benchmark_mutate(count, albums=2000, seed=0):
+    """The same clean-up of `albums` albums done one album at a time and with retag_albums/delete_formatted_albums."""
+    report = {}
+    with tempfile.TemporaryDirectory() as directory:
+        original = os.path.join(directory, 'bench.db')
+        conn = build_database(original, catalogs=False)
+        add_synthetic(conn, count, seed)
+        genre = conn.execute("""SELECT Genres.genre_name FROM GenreStats JOIN Genres ON GenreStats.genre_id = Genres.id
+                                ORDER BY album_count DESC LIMIT 1""").fetchone()[0]
+        rows = conn.execute("""
+            SELECT Albums.title, MIN(Formats.format_name) FROM Albums
+            JOIN FormattedAlbums ON Albums.id = FormattedAlbums.album_id
+            JOIN Formats ON FormattedAlbums.format_id = Formats.id
+            WHERE Albums.id IN (SELECT album_id FROM AlbumGenres WHERE genre_id = (SELECT id FROM Genres WHERE genre_name = ?))
+            GROUP BY Albums.id HAVING COUNT(*) = 1 LIMIT ?""", (genre, albums)).fetchall()
+        conn.close()
+        titles = [title for title, format_name in rows]
+
+        def one_by_one(conn):
+            for title, format_name in rows:
+                functions.remove_genre_from_album(title, genre, conn=conn)
+                functions.delete_formatted_album(title, format_name, conn=conn)
+            search.refresh_search_index(conn=conn)
+
+        def bulk(conn):
+            mutations.retag_albums(titles, remove=[genre], conn=conn)
+            mutations.delete_formatted_albums(titles, conn=conn)
+
+        for name, clean_up in [('one album at a time', one_by_one), ('bulk', bulk)]:
+            path = os.path.join(directory, f'{name}.db')
+            shutil.copy(original, path)
+            conn = db.connect(path)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                clean_up(conn)
+            seconds = time.perf_counter() - start
+            owned = conn.execute("""SELECT COUNT(*) FROM FormattedAlbums""").fetchone()[0]
+            report[name] = {'albums': len(rows), 'seconds': seconds, 'albums_per_sec': len(rows) / seconds, 'owned_after': owned}
+            conn.close()
+    return report
+
+""" // SNAPSHOT BENCHMARK // """
+
+def benchmark_snapshot(count, seed=0, calls=100, runs=10):
+    """File sizes, cold start and per-call latency of a snapshot file next to the database it was written from."""
+    report = {}
+    with tempfile.TemporaryDirectory() as directory:
+        database, snapshot_path = os.path.join(directory, 'bench.db'), os.path.join(directory, 'bench.snap')
+        conn = build_database(database, catalogs=False)
+        add_synthetic(conn, count, seed)
+        start = time.perf_counter()
+        collection.export_snapshot(snapshot_path, conn=conn)
+        report['export_snapshot'] = {'albums': count, 'seconds': time.perf_counter() - start}
+        report['file size'] = {'database_bytes': os.path.getsize(database), 'snapshot_bytes': os.path.getsize(snapshot_path)}
+        conn.close()
+
+        snapshot = collection.Collection.open(snapshot_path)
+        rng = random.Random(seed)
+        genres = [rng.choice(snapshot.genres.names) for _ in range(calls)]
+        artists = [rng.choice(snapshot.artists.names) for _ in range(calls)]
+
+        python = [sys.executable, '-c']
+        first = f"sample_albums(5, genre={genres[0]!r}, media='CD', conn=conn)"
+        for name, script in [
+            ('cold start (database)', f"import db, functions; conn = db.connect({database!r}); functions.{first}"),
+            ('cold start (snapshot)', f"import collection, functions; conn = collection.Collection.open({snapshot_path!r}); functions.{first}"),
+        ]:
+            report[name] = summarize([time_process(python + [script], HERE)[0] for _ in range(runs)])
+
+        conn = db.connect(database)
+        snapshot.matching(genre=genres[0], media='CD', artist=artists[0]) # build the indexes up front, as the menu would
+        for name, function, arguments in [
+            ('sample_albums', functions.sample_albums, [(5, None, None, genre, 'CD') for genre in genres]),
+            ('sample_albums (rating weight)', functools.partial(functions.sample_albums, weight='rating'), [(5, 1970, 1999) for _ in genres]),
+            ('count_albums', functions.count_albums, [(None, None, genre) for genre in genres]),
+            ('get_albums_by_artist', functions.get_albums_by_artist.__wrapped__, [(artist,) for artist in artists]),
+            ('artist_album_count', functions.artist_album_count.__wrapped__, [(artist,) for artist in artists]),
+            ('album view, first page', first_page(functions.iter_album_view), [(genre,) for genre in genres]),
+        ]:
+            for source, target in [('database', conn), ('snapshot', snapshot)]:
+                results, latencies = time_calls(functools.partial(function, conn=target), arguments)
+                report[f'{name} ({source})'] = summarize(latencies)
+        conn.close()
+        snapshot.close()
+    return report
+
+def print_report(report):
+    """One line per measured method."""
+    width = max(8, *(len(name) for name in report))
+    for name, row in report.items():
+        print(f"{name:>{width}}: " + ', '.join(f"{key} {value:.3f}" if isinstance(value, float) else f"{key} {value}"
+                                         for key, value in row.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmark', choices=['search', 'match', 'suite', 'compare', 'memory', 'ingest', 'startup', 'snapshot', 'mutate'])
+    parser.add_argument('files', nargs='*', help='compare: an older and a newer --output file')
+    parser.add_argument('--synthetic', type=int, default=0, help='made-up albums to add on top of the catalogs')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--sizes', type=int, nargs='+', default=SUITE_SIZES, help='suite: total albums in each database')
+    parser.add_argument('--calls', type=int, default=100, help='suite: calls per function')
+    parser.add_argument('--runs', type=int, default=10, help='startup/snapshot: processes started per measurement')
+    parser.add_argument('--output', help='suite: write the results to this JSON file')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='ingest: worker processes to try')
+    parser.add_argument('--dumps', type=int, default=4, help='ingest: how many dump files to split the rows over')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.benchmark == 'suite':
+        results = run_suite(args.sizes, args.calls, args.seed)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(results, file, indent=2)
+            print(f"\nResults written to {args.output}")
+        return
+    if args.benchmark == 'memory':
+        print_report(benchmark_memory(args.synthetic or 100000, args.seed, args.calls))
+        return
+    if args.benchmark == 'startup':
+        print_report(benchmark_startup(args.runs))
+        return
+    if args.benchmark == 'snapshot':
+        print_report(benchmark_snapshot(args.synthetic or 100000, args.seed, args.calls, args.runs))
+        return
+    if args.benchmark == 'mutate':
+        print_report(benchmark_mutate(args.synthetic or 100000, args.queries, args.seed))
+        return
+    if args.benchmark == 'ingest':
+        print_report(benchmark_ingest(args.synthetic or 200000, args.dumps, args.workers, args.seed))
+        return
+    if args.benchmark == 'compare':
+        if len(args.files) != 2:
+            parser.error('compare needs two result files: old.json new.json')
+        old, new = (json.load(open(path)) for path in args.files)
+        compare_results(old, new)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        conn = build_database(os.path.join(directory, 'bench.db'), args.synthetic, args.seed)
+        albums = conn.execute("""SELECT COUNT(*) FROM Albums""").fetchone()[0]
+        if args.benchmark == 'search':
+            print(f"\nSearching {albums} albums with {args.queries} misspelled titles:")
+            print_report(benchmark_search(conn, args.queries, args.seed))
+        else:
+            print(f"\nMatching {args.queries} re-spelled catalog albums against {albums} albums:")
+            print_report(benchmark_match(conn, args.queries, args.seed))
+        conn.close()
+
+if __name__ == "__main__":
+    main()
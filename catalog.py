@@ -0,0 +1,322 @@
+"""Catalog import and matching functions used in Personal Music Collection project."""
+
+import os
+import re
+import time
+from collections import defaultdict, deque
+
+from db import bump_generation, cached_result, connection, transaction
+from functions import chunked, write_albums
+from search import refresh_search_index
+
+
+""" // CATALOG IMPORT FUNCTIONS (all.csv & rym_top_5000_all_time.csv) // """
+
+def read_csv_rows(path):
+    """Stream the rows of a CSV file one at a time."""
+    import csv # only needed for catalog imports
+    with open(path, newline='', encoding='utf-8') as file:
+        yield from csv.reader(file)
+
+def split_tags(*fields, separator=','):
+    """Split genre/style/descriptor fields into one de-duplicated list (all.csv separates them with ';', RYM with ',')."""
+    tags = []
+    for field in fields:
+        for tag in field.split(separator):
+            tag = tag.strip()
+            if tag and tag not in tags:
+                tags.append(tag)
+    return tags
+
+def parse_year(text):
+    """Pull the year out of '1997', 'June 1997' or RYM's '16 June 1997'."""
+    match = re.search(r'\d{4}', text)
+    return int(match.group()) if match else None
+
+def parse_count(text):
+    """Turn counts like '70,382' into integers."""
+    text = text.replace(',', '').strip()
+    return int(text) if text else None
+
+def parse_all_csv(rows):
+    """Turn all.csv rows (title, artist, year, lists, discogs url, id, genres, styles) into catalog records."""
+    for title, artist, year, lists, url, discogs_id, genres, styles in rows:
+        record = [title, artist, parse_year(year), []]
+        yield record, ('all.csv', discogs_id, None, None, None, None, None, url, '; '.join(split_tags(genres, styles, separator=';')))
+
+def parse_rym_csv(rows, header=True):
+    """Turn rym_top_5000_all_time.csv rows into catalog records, skipping the header (if the rows start with it)."""
+    if header:
+        next(rows, None)
+    for ranking, title, artist, date, genres, descriptors, rating, ratings, reviews in rows:
+        record = [title, artist, parse_year(date), []]
+        yield record, ('rym', ranking.rstrip('.'), parse_count(ranking.rstrip('.')), float(rating) if rating else None,
+                       parse_count(ratings), parse_count(reviews), ', '.join(split_tags(descriptors)), None,
+                       '; '.join(split_tags(genres)))
+
+def chain_rows(first, rows):
+    """Put a peeked-at row back in front of the stream."""
+    yield first
+    yield from rows
+
+def catalog_records(path):
+    """Pick the right parser for a catalog file by peeking at its first row."""
+    rows = read_csv_rows(path)
+    first = next(rows, None)
+    if first is None:
+        return iter(())
+    rows = chain_rows(first, rows)
+    if first[0] == 'Ranking':
+        return parse_rym_csv(rows)
+    return parse_all_csv(rows)
+
+def import_catalog(path, chunk_size=1000, conn=None):
+    """Stream a catalog CSV into the Artists/Albums/CatalogAlbums tables, chunk_size rows per transaction."""
+    conn = connection(conn)
+    start = time.perf_counter()
+    rows = skipped = 0
+    for chunk in chunked(catalog_records(path), chunk_size):
+        with transaction(conn):
+            skipped += write_catalog_chunk(chunk, conn)
+        rows += len(chunk)
+    refresh_search_index(conn=conn)
+    seconds = time.perf_counter() - start
+    stats = {'path': path, 'rows': rows, 'skipped': skipped, 'seconds': seconds, 'rows_per_sec': rows / seconds if seconds else 0.0}
+    print(f"Imported {rows} rows from {path} ({skipped} skipped) in {seconds:.2f}s, {stats['rows_per_sec']:,.0f} rows/sec.")
+    return stats
+
+def write_catalog_chunk(chunk, conn):
+    """Write (record, info) pairs from catalog_records inside a transaction; returns how many were skipped."""
+    album_ids = write_albums([record for record, info in chunk], conn=conn)
+    catalog_rows = {}
+    skipped = 0
+    for album_id, (record, info) in zip(album_ids, chunk):
+        if album_id is None:
+            skipped += 1
+        else:
+            catalog_rows[(album_id, info[0])] = (album_id,) + info # de-duplicates repeated albums within the chunk
+    conn.executemany("""
+        INSERT OR REPLACE INTO CatalogAlbums
+        (album_id, source, source_id, ranking, average_rating, rating_count, review_count, descriptors, url, genres)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", catalog_rows.values())
+    return skipped
+
+
+
+""" // PARALLEL CATALOG IMPORT FUNCTIONS // """
+
+# import_catalogs parses byte-range shards of the files on a pool of worker processes, while this process is the only
+# writer. Each shard is committed together with its IngestShards row, so an interrupted import can be resumed.
+SHARD_BYTES = 4 * 2 ** 20 # bytes of CSV per shard
+
+def shard_file(path, shard_bytes=SHARD_BYTES):
+    """Split a CSV file into (start, end) byte ranges of about shard_bytes that begin and end on a row boundary."""
+    import mmap # only needed for parallel catalog imports
+    size = os.path.getsize(path)
+    if not size:
+        return []
+    shards = []
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = scanned = quotes = 0 # quotes: how many '"' come before `scanned`
+        while start < size:
+            end = size
+            if start + shard_bytes < size:
+                quotes += data[scanned:start + shard_bytes].count(b'"')
+                scanned = start + shard_bytes
+                while True:
+                    newline = data.find(b'\n', scanned)
+                    if newline == -1:
+                        break
+                    quotes += data[scanned:newline].count(b'"')
+                    scanned = newline + 1
+                    if quotes % 2 == 0:
+                        end = scanned
+                        break
+            shards.append((start, end))
+            start = end
+    return shards
+
+def file_signature(path):
+    """Size and modification time of a file; if either changes, the shards recorded for it are no longer trusted."""
+    status = os.stat(path)
+    return f"{status.st_size}:{status.st_mtime_ns}"
+
+def catalog_kind(path):
+    """'rym' for rym_top_5000_all_time.csv-style files (they start with a 'Ranking' header), otherwise 'all'."""
+    first = next(read_csv_rows(path), None)
+    return 'rym' if first and first[0] == 'Ranking' else 'all'
+
+def parse_shard(path, start, end, kind):
+    """Parse the rows in bytes [start, end) of a catalog file into (record, info) pairs; runs in a worker process."""
+    import csv
+    import io
+    with open(path, 'rb') as file:
+        file.seek(start)
+        text = file.read(end - start).decode('utf-8')
+    rows = csv.reader(io.StringIO(text, newline=''))
+    if kind == 'rym':
+        return list(parse_rym_csv(rows, header=start == 0))
+    return list(parse_all_csv(rows))
+
+def write_shard(shard, parsed, stats, conn):
+    """Wait for a shard to be parsed, then write it and record it as done in a single transaction, adding to stats."""
+    path, signature, kind, start, end = shard
+    waited = time.perf_counter()
+    chunk = parsed.result()
+    wrote = time.perf_counter()
+    with transaction(conn):
+        skipped = write_catalog_chunk(chunk, conn)
+        conn.execute("""
+            INSERT OR REPLACE INTO IngestShards (path, signature, start_byte, end_byte, rows, skipped, done_at)
+            VALUES (?, ?, ?, ?, ?, ?, datetime('now'))""", (path, signature, start, end, len(chunk), skipped))
+    stats['wait_seconds'] += wrote - waited
+    stats['write_seconds'] += time.perf_counter() - wrote
+    stats['rows'] += len(chunk)
+    stats['skipped'] += skipped
+    stats['shards'] += 1
+
+def import_catalogs(paths, workers=None, shard_bytes=SHARD_BYTES, max_pending=None, conn=None):
+    """Import many catalog CSVs with `workers` parsing processes, resuming any import that was interrupted."""
+    conn = connection(conn)
+    start_time = time.perf_counter()
+    stats = {'files': len(paths), 'rows': 0, 'skipped': 0, 'shards': 0, 'resumed': 0, 'wait_seconds': 0.0, 'write_seconds': 0.0}
+    shards = []
+    for path in paths:
+        path, signature = os.path.abspath(path), file_signature(path)
+        with transaction(conn): # a file that changed since its shards were recorded is imported again from the start
+            conn.execute("""DELETE FROM IngestShards WHERE path = ? AND signature <> ?""", (path, signature))
+        cursor = conn.execute("""SELECT start_byte, end_byte FROM IngestShards WHERE path = ?""", (path,))
+        done = set(cursor.fetchall())
+        kind = catalog_kind(path)
+        for start, end in shard_file(path, shard_bytes):
+            if (start, end) in done:
+                stats['resumed'] += 1
+            else:
+                shards.append((path, signature, kind, start, end))
+
+    from concurrent.futures import ProcessPoolExecutor # multiprocessing is slow to import, and only needed here
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque() # (shard, future) in file order; the writer always takes the oldest
+        for shard in shards:
+            path, signature, kind, start, end = shard
+            pending.append((shard, pool.submit(parse_shard, path, start, end, kind)))
+            if len(pending) >= max_pending:
+                write_shard(*pending.popleft(), stats, conn)
+        while pending:
+            write_shard(*pending.popleft(), stats, conn)
+    refresh_search_index(conn=conn)
+    seconds = time.perf_counter() - start_time
+    stats.update(workers=workers, seconds=seconds, rows_per_sec=stats['rows'] / seconds if seconds else 0.0)
+    print(f"Imported {stats['rows']} rows in {stats['shards']} shards from {len(paths)} files "
+          f"({stats['skipped']} skipped, {stats['resumed']} shards already done) with {workers} workers in {seconds:.2f}s, "
+          f"{stats['rows_per_sec']:,.0f} rows/sec (writer waited {stats['wait_seconds']:.2f}s for parsing).")
+    return stats
+
+
+
+""" // CATALOG MATCHING FUNCTIONS // """
+
+MATCH_THRESHOLD = 0.8 # weighted title/artist similarity an owned album needs to be linked to a catalog album
+MATCH_TITLE_WEIGHT = 0.7
+MATCH_KEY_LENGTH = 4 # albums are only compared with catalog albums whose artist starts with the same 4 letters
+MATCH_BATCH_SIZE = 2000 # catalog albums scored per NumPy batch, which keeps big blocks from using lots of memory
+
+def normalize_name(text):
+    """Reduce a title or artist name to lowercase letters and digits, ie 'The Doobie Brothers' -> 'doobiebrothers'."""
+    import unicodedata # only needed for catalog matching
+    folded = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode().lower()
+    words = re.sub(r'[^a-z0-9]+', ' ', folded.replace('&', ' and ')).split()
+    if words[:1] == ['the'] and len(words) > 1:
+        words = words[1:]
+    return ''.join(words) or re.sub(r'\W+', '', text.casefold()) # titles with no latin letters at all, ie '恋人へ'
+
+def artist_key(artist):
+    """The block an artist's albums are matched within, so 'Snoop Doggy Dog' and 'Snoop Doggy Dogg' meet."""
+    return normalize_name(artist)[:MATCH_KEY_LENGTH]
+
+def trigram_vectors(names, np):
+    """Unit-length trigram count vectors for a list of normalized names, one row each."""
+    vocabulary, rows, columns = {}, [], []
+    for row, name in enumerate(names):
+        padded = f' {name} '
+        for i in range(len(padded) - 2):
+            rows.append(row)
+            columns.append(vocabulary.setdefault(padded[i:i + 3], len(vocabulary)))
+    matrix = np.zeros((len(names), max(1, len(vocabulary))), dtype=np.float32)
+    np.add.at(matrix, (rows, columns), 1.0)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1), 1e-9)[:, None]
+    return matrix
+
+def match_records(owned, catalog, threshold=MATCH_THRESHOLD, title_weight=MATCH_TITLE_WEIGHT, batch_size=MATCH_BATCH_SIZE):
+    """Match (id, title, artist) records against catalog records; returns (owned id, catalog id, score) triples."""
+    import numpy as np # only needed here, so the rest of the module works without it
+    blocks = defaultdict(lambda: ([], []))
+    for side, records in enumerate((owned, catalog)):
+        for album_id, title, artist in records:
+            blocks[artist_key(artist)][side].append((album_id, normalize_name(title), normalize_name(artist)))
+    matches = []
+    for queries, candidates in blocks.values():
+        if not queries or not candidates:
+            continue
+        count = len(queries)
+        best_scores = np.full(count, -1.0)
+        best_ids = [None] * count
+        for start in range(0, len(candidates), batch_size):
+            batch = queries + candidates[start:start + batch_size]
+            titles = trigram_vectors([record[1] for record in batch], np)
+            artists = trigram_vectors([record[2] for record in batch], np)
+            scores = title_weight * (titles[:count] @ titles[count:].T) + (1 - title_weight) * (artists[:count] @ artists[count:].T)
+            columns = scores.argmax(axis=1)
+            column_scores = scores[np.arange(count), columns]
+            for row in np.flatnonzero(column_scores > best_scores):
+                best_scores[row] = column_scores[row]
+                best_ids[row] = candidates[start + columns[row]][0]
+        for query, catalog_id, score in zip(queries, best_ids, best_scores):
+            if score >= threshold:
+                matches.append((query[0], catalog_id, round(float(score), 3)))
+    return matches
+
+def match_collection_to_catalog(threshold=MATCH_THRESHOLD, conn=None):
+    """Link every album I own to the catalog album it most likely is, in CatalogMatches."""
+    conn = connection(conn)
+    start = time.perf_counter()
+    cursor = conn.execute("""
+        SELECT Albums.id, Albums.title, Artists.name FROM Albums
+        JOIN Artists ON Albums.artist_id = Artists.id
+        WHERE Albums.id IN (SELECT album_id FROM FormattedAlbums)""")
+    owned = cursor.fetchall()
+    cursor = conn.execute("""
+        SELECT Albums.id, Albums.title, Artists.name FROM Albums
+        JOIN Artists ON Albums.artist_id = Artists.id
+        WHERE Albums.id IN (SELECT album_id FROM CatalogAlbums)""")
+    catalog = cursor.fetchall()
+    matches = match_records(owned, catalog, threshold)
+    with transaction(conn):
+        conn.execute("""DELETE FROM CatalogMatches""")
+        conn.executemany("""INSERT INTO CatalogMatches (album_id, catalog_album_id, score) VALUES (?, ?, ?)""", matches)
+        bump_generation(conn)
+    seconds = time.perf_counter() - start
+    stats = {'owned': len(owned), 'catalog': len(catalog), 'matched': len(matches), 'seconds': seconds,
+             'albums_per_sec': len(owned) / seconds if seconds else 0.0}
+    print(f"Matched {len(matches)} of {len(owned)} owned albums to {len(catalog)} catalog albums "
+          f"in {seconds:.2f}s, {stats['albums_per_sec']:,.0f} albums/sec.")
+    return stats
+
+@cached_result
+def get_catalog_matches(conn=None):
+    """Return the catalog title, artist, score, RYM rating, descriptors and Discogs url of every matched album I own."""
+    conn = connection(conn)
+    cursor = conn.execute("""
+        SELECT Albums.title, Artists.name, Catalog.title, CatalogArtists.name, CatalogMatches.score,
+               Rym.average_rating, Rym.descriptors, Discogs.url
+        FROM CatalogMatches
+        JOIN Albums ON CatalogMatches.album_id = Albums.id
+        JOIN Artists ON Albums.artist_id = Artists.id
+        JOIN Albums AS Catalog ON CatalogMatches.catalog_album_id = Catalog.id
+        JOIN Artists AS CatalogArtists ON Catalog.artist_id = CatalogArtists.id
+        LEFT JOIN CatalogAlbums AS Rym ON Rym.album_id = Catalog.id AND Rym.source = 'rym'
+        LEFT JOIN CatalogAlbums AS Discogs ON Discogs.album_id = Catalog.id AND Discogs.source = 'all.csv'
+        ORDER BY Artists.name, Albums.year""")
+    return cursor.fetchall()
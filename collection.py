@@ -0,0 +1,500 @@
+"""Compact in-memory model of a music collection for the Personal Music Collection project, searchable without the
+database and savable as a read-only snapshot file (see Collection.save/open)."""
+
+import heapq
+import mmap
+import os
+import random as rand
+import struct
+import sys
+from array import array
+
+import catalog
+import db
+import functions
+import my_music
+import search
+
+# Snapshot file layout: a header, a table of columns, then each column's raw bytes (8-byte aligned).
+#   header   magic, format version, number of columns, byte order ('<' or '>')
+#   column   name, array typecode, offset of its data in the file, number of items
+# Names (artists, genres, formats) are stored once each, as UTF-8 joined by the unit separator, and the artist, genre
+# and format indexes are stored too (the rows with id i are <kind>_rows[<kind>_starts[i]:<kind>_starts[i + 1]]),
+# so even the first search after opening a snapshot doesn't have to build them.
+# A snapshot written from the database also keeps each genre's and format's id there (ID_COLUMNS).
+SNAPSHOT_MAGIC = b'MUSICSNP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<8sIIc3x')
+SNAPSHOT_COLUMN = struct.Struct('<16s4sQQ')
+BYTE_ORDER = b'<' if sys.byteorder == 'little' else b'>'
+ARRAY_COLUMNS = ['title_bytes', 'title_offsets', 'artist', 'year', 'format', 'genre', 'genre_offsets', 'rating']
+NAME_COLUMNS = ['artists', 'genres', 'formats']
+ID_COLUMNS = ['genre_ids', 'format_ids'] # the database's Genres/Formats ids, in the same order as the names
+INDEX_KINDS = ['artist', 'genre', 'format']
+NO_RATING = float('nan')
+
+
+class Album:
+    """One (album, format) row of a Collection, built on demand."""
+    __slots__ = ('title', 'artist', 'year', 'genres', 'format')
+
+    def __init__(self, title, artist, year, genres, format):
+        self.title = title
+        self.artist = artist
+        self.year = year
+        self.genres = genres
+        self.format = format
+
+    def row(self):
+        """(title, artist, year, format), the same shape as the get_* functions return."""
+        return (self.title, self.artist, self.year, self.format)
+
+    def __repr__(self):
+        return f"Album{(self.title, self.artist, self.year, self.genres, self.format)}"
+
+
+class Names:
+    """Interned names: each distinct name is stored once and referred to by its position."""
+    __slots__ = ('names', 'lookup')
+
+    def __init__(self, names=()):
+        self.names = []
+        self.lookup = {}
+        for name in names:
+            self.id(name)
+
+    @classmethod
+    def distinct(cls, names):
+        """Names already known to be distinct (ie read back from a snapshot); the name -> id dict waits until it's used."""
+        interned = cls()
+        interned.names = list(names)
+        interned.lookup = None
+        return interned
+
+    @property
+    def ids(self):
+        """name -> id."""
+        if self.lookup is None:
+            self.lookup = dict(zip(self.names, range(len(self.names))))
+        return self.lookup
+
+    def id(self, name):
+        """The id of a name, adding it the first time it is seen."""
+        ids = self.ids
+        found = ids.get(name)
+        if found is None:
+            found = ids[name] = len(self.names)
+            self.names.append(name)
+        return found
+
+    def __getitem__(self, id):
+        return self.names[id]
+
+    def __len__(self):
+        return len(self.names)
+
+
+class Collection:
+    """Albums as parallel typed arrays, one row per album on one format (memoryviews onto the file once opened from a snapshot)."""
+    snapshot = True # what db.is_snapshot checks: the functions read a Collection instead of running SQL
+
+    def __init__(self):
+        self.title_bytes = bytearray() # row i's title is title_bytes[title_offsets[i]:title_offsets[i + 1]]
+        self.title_offsets = array('I', [0])
+        self.artist = array('I') # ids into self.artists
+        self.year = array('H') # 0 when unknown
+        self.format = array('B') # ids into self.formats (0 is None, for catalog albums I don't own)
+        self.genre = array('I') # row i's genre ids are genre[genre_offsets[i]:genre_offsets[i + 1]]
+        self.genre_offsets = array('I', [0])
+        self.rating = array('f') # the RYM average rating, NaN when the album isn't in a catalog
+        self.artists = Names()
+        self.genres = Names()
+        self.formats = Names([None])
+        self.indexes = {} # artist/genre/format id -> rows, built the first time they're searched
+        self.mapping = None # the mmap behind a collection opened from a snapshot
+        self.postings = {} # kind -> {'starts': ..., 'rows': ...}, the indexes stored in that snapshot
+        self.database_ids = {} # 'genre'/'format' -> the database's id of each name, when loaded from the database
+
+    # Loading
+
+    def add(self, title, artist, year, genres=(), format=None, rating=None):
+        """Add one album on one format; returns its row."""
+        if self.mapping is not None:
+            raise TypeError("a collection opened from a snapshot is read-only")
+        self.title_bytes += title.encode('utf-8')
+        self.title_offsets.append(len(self.title_bytes))
+        self.artist.append(self.artists.id(artist))
+        self.year.append(int(year) if year else 0)
+        self.format.append(self.formats.id(format))
+        self.genre.extend(self.genres.id(genre) for genre in genres)
+        self.genre_offsets.append(len(self.genre))
+        self.rating.append(NO_RATING if rating is None else rating)
+        self.indexes.clear()
+        return len(self.year) - 1
+
+    def extend(self, records, format=None):
+        """Add [title, artist, year, [genres...]] records, ie my_music.cds, all on one format."""
+        for title, artist, year, genres in records:
+            self.add(title, artist, year, genres, format)
+        return self
+
+    @classmethod
+    def from_lists(cls, lists):
+        """Build a collection from {format: records}, ie {'CD': my_music.cds, ...}."""
+        collection = cls()
+        for format, records in lists.items():
+            collection.extend(records, format)
+        return collection
+
+    @classmethod
+    def from_my_music(cls):
+        """My own collection, straight from my_music.py."""
+        return cls.from_lists({'CD': my_music.cds, 'cassette': my_music.cassettes, 'vinyl': my_music.vinyl})
+
+    @classmethod
+    def from_csv(cls, path):
+        """A whole catalog (all.csv or rym_top_5000_all_time.csv), streamed without keeping the parsed rows around."""
+        collection = cls()
+        for (title, artist, year, genres), info in catalog.catalog_records(path):
+            collection.add(title, artist, year, genres)
+        return collection
+
+    @classmethod
+    def from_database(cls, owned=True, ratings=True, conn=None):
+        """Everything I own in the database (or every album, with owned=False), with RYM ratings if asked, in one query."""
+        conn = db.connection(conn)
+        join = "JOIN" if owned else "LEFT JOIN"
+        rating = """(SELECT MAX(CatalogAlbums.average_rating) FROM CatalogAlbums
+                     WHERE CatalogAlbums.album_id = Albums.id)""" if ratings else "NULL"
+        cursor = conn.execute(f"""
+            SELECT Albums.title, Artists.name, Albums.year, Formats.format_name,
+                   (SELECT group_concat(Genres.genre_name, char(31)) FROM AlbumGenres
+                    JOIN Genres ON AlbumGenres.genre_id = Genres.id
+                    WHERE AlbumGenres.album_id = Albums.id),
+                   {rating}
+            FROM Albums
+            JOIN Artists ON Albums.artist_id = Artists.id
+            {join} FormattedAlbums ON Albums.id = FormattedAlbums.album_id
+            LEFT JOIN Formats ON FormattedAlbums.format_id = Formats.id
+            ORDER BY Albums.id, Formats.id""")
+        collection = cls()
+        while True:
+            rows = cursor.fetchmany(functions.BATCH_SIZE)
+            if not rows:
+                break
+            for title, artist, year, format, genres, rating in rows:
+                collection.add(title, artist, year, genres.split(functions.UNIT_SEPARATOR) if genres else (), format, rating)
+        genre_ids = dict(conn.execute("""SELECT genre_name, id FROM Genres""").fetchall())
+        format_ids = dict(conn.execute("""SELECT format_name, id FROM Formats""").fetchall())
+        collection.database_ids = {'genre': array('I', (genre_ids[name] for name in collection.genres.names)),
+                                   'format': array('I', (format_ids[name] for name in collection.formats.names[1:]))}
+        return collection
+
+    # Snapshots
+
+    def save(self, path):
+        """Write the collection to a snapshot file, replacing `path` only once the new file is complete."""
+        columns = [(name, 'B' if name == 'title_bytes' else getattr(self, name).typecode, getattr(self, name))
+                   for name in ARRAY_COLUMNS]
+        names = {'artists': self.artists.names, 'genres': self.genres.names, 'formats': self.formats.names[1:]}
+        columns += [(name, 'B', functions.UNIT_SEPARATOR.join(names[name]).encode('utf-8')) for name in NAME_COLUMNS]
+        columns += [(kind + '_ids', 'I', ids) for kind, ids in self.database_ids.items()]
+        for kind in INDEX_KINDS:
+            starts, rows = array('I', [0]), array('I')
+            for id in range(len(getattr(self, kind + 's'))):
+                rows.extend(self.index(kind, id))
+                starts.append(len(rows))
+            columns += [(kind + '_starts', 'I', starts), (kind + '_rows', 'I', rows)]
+        offset = SNAPSHOT_HEADER.size + SNAPSHOT_COLUMN.size * len(columns)
+        table, blobs = [], []
+        for name, typecode, column in columns:
+            data = memoryview(column).cast('B')
+            offset += -offset % 8
+            table.append(SNAPSHOT_COLUMN.pack(name.encode(), typecode.encode(), offset, len(data) // array(typecode).itemsize))
+            blobs.append((offset, data))
+            offset += len(data)
+        with open(path + '.tmp', 'wb') as file:
+            file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(columns), BYTE_ORDER))
+            file.write(b''.join(table))
+            for offset, data in blobs:
+                file.write(b'\0' * (offset - file.tell()))
+                file.write(data)
+        os.replace(path + '.tmp', path)
+        return path
+
+    @classmethod
+    def open(cls, path):
+        """Open a snapshot written by save() without reading it in: every column is a memoryview onto the mapped file."""
+        with open(path, 'rb') as file:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, byte_order = SNAPSHOT_HEADER.unpack_from(mapping, 0)
+        problem = None
+        if magic != SNAPSHOT_MAGIC:
+            problem = "is not a collection snapshot"
+        elif version != SNAPSHOT_VERSION:
+            problem = f"is snapshot version {version}; this code reads version {SNAPSHOT_VERSION}"
+        elif byte_order != BYTE_ORDER:
+            problem = "was written on a machine with the other byte order"
+        if problem:
+            mapping.close()
+            raise ValueError(f"{path} {problem}")
+        collection = cls()
+        collection.mapping = mapping
+        whole = memoryview(mapping)
+        for number in range(count):
+            name, typecode, offset, length = SNAPSHOT_COLUMN.unpack_from(mapping, SNAPSHOT_HEADER.size + number * SNAPSHOT_COLUMN.size)
+            name, typecode = name.rstrip(b'\0').decode(), typecode.rstrip(b'\0').decode()
+            column = whole[offset:offset + length * array(typecode).itemsize].cast(typecode)
+            if name in NAME_COLUMNS:
+                text = str(column, 'utf-8')
+                column.release()
+                found = text.split(functions.UNIT_SEPARATOR) if text else []
+                setattr(collection, name, Names.distinct([None] + found if name == 'formats' else found))
+            elif name in ARRAY_COLUMNS:
+                setattr(collection, name, column)
+            elif name in ID_COLUMNS:
+                collection.database_ids[name.split('_')[0]] = column
+            else:
+                kind, part = name.split('_')
+                collection.postings.setdefault(kind, {})[part] = column
+        whole.release()
+        return collection
+
+    def close(self):
+        """Let go of the file behind a collection opened from a snapshot."""
+        if self.mapping is not None:
+            self.indexes.clear()
+            for name in ARRAY_COLUMNS:
+                getattr(self, name).release()
+            for postings in self.postings.values():
+                for column in postings.values():
+                    column.release()
+            self.postings.clear()
+            for column in self.database_ids.values():
+                column.release()
+            self.database_ids.clear()
+            self.mapping.close()
+            self.mapping = None
+
+    def records(self, format=None):
+        """The [title, artist, year, [genres...]] records on one format (or all of them), ready for functions.add_music."""
+        wanted = self.formats.ids.get(format) if format is not None else None
+        return [[album.title, album.artist, album.year, album.genres] for row, album in enumerate(self)
+                if wanted is None or self.format[row] == wanted]
+
+    # Reading
+
+    def __len__(self):
+        return len(self.year)
+
+    def title(self, row):
+        return str(self.title_bytes[self.title_offsets[row]:self.title_offsets[row + 1]], 'utf-8')
+
+    def genres_of(self, row):
+        return [self.genres[id] for id in self.genre[self.genre_offsets[row]:self.genre_offsets[row + 1]]]
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        return Album(self.title(row), self.artists[self.artist[row]], self.year[row] or None,
+                     self.genres_of(row), self.formats[self.format[row]])
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def name_rows(self, kind):
+        """(id, name) for every artist, genre or format, like functions.get_artists/get_genres/get_formats (database ids if loaded from it)."""
+        names = {'artist': self.artists.names, 'genre': self.genres.names, 'format': self.formats.names[1:]}[kind]
+        ids = self.database_ids[kind] if kind in self.database_ids else range(1, len(names) + 1)
+        return sorted(zip(ids, names))
+
+    def row(self, row):
+        """(title, artist, year, format) for one row, without building the genre list."""
+        return (self.title(row), self.artists[self.artist[row]], self.year[row] or None, self.formats[self.format[row]])
+
+    def album_rows(self):
+        """The first row of each album (title and artist) in the collection, on whatever format."""
+        albums = {}
+        for row in range(len(self)):
+            albums.setdefault((self.title(row), self.artist[row]), row)
+        return list(albums.values())
+
+    def albums(self):
+        """(id, title, artist id, year) for each album, like functions.get_albums (the ids are its position, from 1)."""
+        return [(id, self.title(row), self.artist[row] + 1, self.year[row] or None)
+                for id, row in enumerate(self.album_rows(), start=1)]
+
+    def nbytes(self):
+        """Roughly how much memory the arrays and interned names take up."""
+        arrays = [self.title_offsets, self.artist, self.year, self.format, self.genre, self.genre_offsets, self.rating]
+        names = self.artists.names + self.genres.names + self.formats.names[1:]
+        return (len(self.title_bytes) + sum(column.itemsize * len(column) for column in arrays)
+                + sum(len(name.encode('utf-8')) + 49 for name in names)) # ~49 bytes of str object overhead each
+
+    # Searching
+
+    def index(self, kind, id):
+        """The rows with a given artist, genre or format id (kind is 'artist', 'genre' or 'format')."""
+        if kind in self.postings:
+            starts, rows = self.postings[kind]['starts'], self.postings[kind]['rows']
+            return rows[starts[id]:starts[id + 1]] if 0 <= id < len(starts) - 1 else array('I')
+        if kind not in self.indexes:
+            index = {}
+            if kind == 'genre':
+                for row in range(len(self)):
+                    for genre in self.genre[self.genre_offsets[row]:self.genre_offsets[row + 1]]:
+                        index.setdefault(genre, array('I')).append(row)
+            else:
+                for row, value in enumerate(getattr(self, kind)):
+                    index.setdefault(value, array('I')).append(row)
+            self.indexes[kind] = index
+        return self.indexes[kind].get(id, array('I'))
+
+    def matching(self, start_year=None, end_year=None, genre=None, media=None, artist=None, owned=False):
+        """The rows that pass every filter given (owned=True: only rows with a format), starting from the narrowest index."""
+        candidates = []
+        for kind, name, names in [('artist', artist, self.artists), ('genre', genre, self.genres), ('format', media, self.formats)]:
+            if name is not None:
+                id = names.ids.get(name)
+                if id is None:
+                    return []
+                candidates.append((kind, id, self.index(kind, id)))
+        if candidates:
+            candidates.sort(key=lambda candidate: len(candidate[2]))
+            rows = candidates[0][2]
+            for kind, id, found in candidates[1:]:
+                if kind == 'genre':
+                    found = set(found)
+                    rows = [row for row in rows if row in found]
+                else:
+                    column = getattr(self, kind)
+                    rows = [row for row in rows if column[row] == id]
+        else:
+            rows = range(len(self))
+        year, format = self.year, self.format
+        if start_year is not None:
+            rows = [row for row in rows if year[row] and year[row] >= start_year]
+        if end_year is not None:
+            rows = [row for row in rows if year[row] and year[row] <= end_year]
+        if owned:
+            rows = [row for row in rows if format[row]]
+        return list(rows)
+
+    def has(self, kind, id, row):
+        if kind == 'genre':
+            return id in self.genre[self.genre_offsets[row]:self.genre_offsets[row + 1]]
+        return getattr(self, kind)[row] == id
+
+    def albums_by_artist(self, artist):
+        return [self.row(row) for row in self.matching(artist=artist)]
+
+    def albums_by_genre(self, genre):
+        return [self.row(row) for row in self.matching(genre=genre)]
+
+    def albums_by_media(self, media):
+        return [self.row(row) for row in self.matching(media=media)]
+
+    def albums_between_years(self, start_year, end_year):
+        return [self.row(row) for row in self.matching(start_year, end_year)]
+
+    def count_albums(self, start_year=None, end_year=None, genre=None, media=None, owned=False):
+        return len(self.matching(start_year, end_year, genre, media, owned=owned))
+
+    def sample_albums(self, quantity, start_year=None, end_year=None, genre=None, media=None, weight=None, rng=None, owned=False):
+        """Like functions.sample_albums: up to `quantity` distinct random matching rows."""
+        if not isinstance(rng, rand.Random):
+            rng = rand.Random(rng)
+        if weight not in (None, 'fresh', 'rating'):
+            raise ValueError(f"unknown weight {weight!r}; use None, 'fresh' or 'rating'")
+        rows = self.matching(start_year, end_year, genre, media, owned=owned)
+        if weight != 'rating': # 'fresh' too: a snapshot has no suggestion history
+            return [self.row(row) for row in rng.sample(rows, min(max(quantity, 0), len(rows)))]
+        keys = []
+        for row in rows:
+            rating = self.rating[row]
+            rating = 3.0 if rating != rating else rating # NaN: not in a catalog
+            if rating > 0:
+                keys.append((rng.random() ** (1.0 / rating), row))
+        return [self.row(row) for key, row in heapq.nlargest(max(quantity, 0), keys)]
+
+    def artist_album_count(self, artist):
+        """How many different albums I own by `artist`, like functions.artist_album_count."""
+        return len({self.title(row) for row in self.matching(artist=artist, owned=True)})
+
+    def album_view(self, genres=(), match='any', media=None, artist=None, start_year=None, end_year=None, owned=True):
+        """Like functions.iter_album_view: (title, artist, year, [formats], [genres]) once per album."""
+        if match not in ('any', 'all'):
+            raise ValueError(f"match must be 'any' or 'all', not {match!r}")
+        genres = set([genres] if isinstance(genres, str) else genres)
+        wanted = {self.genres.ids[genre] for genre in genres if genre in self.genres.ids}
+        if genres and (not wanted or (match == 'all' and len(wanted) < len(genres))):
+            return []
+        rows = sorted({row for id in wanted for row in self.index('genre', id)}) if wanted else range(len(self))
+        artist_id = self.artists.ids.get(artist) if artist is not None else None
+        albums = {}
+        for row in rows:
+            year = self.year[row]
+            if start_year is not None and (not year or year < start_year):
+                continue
+            if end_year is not None and (not year or year > end_year):
+                continue
+            if artist is not None and self.artist[row] != artist_id:
+                continue
+            if match == 'all' and not wanted.issubset(self.genre[self.genre_offsets[row]:self.genre_offsets[row + 1]]):
+                continue
+            title = self.title(row)
+            if title not in albums:
+                albums[title] = (title, self.artists[self.artist[row]], year or None, [], self.genres_of(row))
+            if self.format[row]:
+                albums[title][3].append(self.formats[self.format[row]])
+        return [album for album in albums.values()
+                if (media is None or media in album[3]) and (album[3] or not owned)]
+
+    def genres_for_album(self, title):
+        """The genres of the album called `title` (the one I own, if several are), like functions.get_genres_for_album."""
+        wanted = title.encode('utf-8')
+        rows = [row for row in range(len(self)) if self.title_bytes[self.title_offsets[row]:self.title_offsets[row + 1]] == wanted]
+        owned = [row for row in rows if self.format[row]]
+        return self.genres_of((owned or rows)[-1]) if rows else []
+
+    def album_counts(self, kind):
+        """(name, how many albums I own) for each artist, genre or format, most first, like functions.genre_album_counts."""
+        albums = {}
+        for row in self.matching(owned=True):
+            album = (self.title(row), self.artist[row])
+            ids = self.genre[self.genre_offsets[row]:self.genre_offsets[row + 1]] if kind == 'genre' else [getattr(self, kind)[row]]
+            for id in ids:
+                albums.setdefault(id, set()).add(album)
+        names = getattr(self, kind + 's')
+        return sorted(((names[id], len(found)) for id, found in albums.items()), key=lambda count: (-count[1], count[0]))
+
+    def decade_format_counts(self):
+        """(decade, format, how many albums I own) rows, like functions.decade_format_counts."""
+        albums = {}
+        for row in self.matching(owned=True):
+            if self.year[row]:
+                key = (self.year[row] // 10 * 10, self.formats[self.format[row]])
+                albums.setdefault(key, set()).add((self.title(row), self.artist[row]))
+        return sorted((decade, format, len(found)) for (decade, format), found in albums.items())
+
+    def search_rows(self):
+        """(title, artist, genres, year) for each album, the candidates search.fuzzy_search scores (a snapshot has no index)."""
+        return [(self.title(row), self.artists[self.artist[row]], ', '.join(self.genres_of(row)), self.year[row] or None)
+                for row in self.album_rows()]
+
+    def find_artist(self, name):
+        """The artist called `name`, or failing that the closest-named one, scored like search.fuzzy_find_artist."""
+        if name in self.artists.ids:
+            return name
+        wanted = search.trigrams(name)
+        score, closest = max(((search.dice(wanted, search.trigrams(artist)), artist) for artist in self.artists.names),
+                             default=(0.0, None))
+        return closest if score >= 0.5 else None
+
+
+def export_snapshot(path, owned=True, ratings=True, conn=None):
+    """Save the database's albums (with owned=False, the catalog albums too) as a snapshot file for Collection.open."""
+    return Collection.from_database(owned, ratings, conn=conn).save(path)
@@ -0,0 +1,645 @@
+"""Connection, cache and profiling functions used in Personal Music Collection project."""
+
+import sqlite3
+import atexit
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+
+""" // CONNECTION FUNCTIONS // """
+
+# Every function takes an optional `conn`: None for the default database, a path to another database file,
+# or an already open sqlite3 connection. Nothing is opened until a function actually needs the database.
+DATABASE = 'music_collection.db'
+
+# Applied to every connection we open. WAL lets readers keep going while a writer commits.
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -32000, # in KiB, so ~32MB of page cache
+    'mmap_size': 268435456, # 256MB
+    'temp_store': 'MEMORY',
+}
+
+thread_connections = threading.local() # each thread gets its own connection to each database
+
+class Connection(sqlite3.Connection):
+    """A sqlite3 connection that knows its database (see database_key) and can profile its statements."""
+    database_key = None
+    data_version = None # PRAGMA data_version when the id cache last looked (see ID CACHE)
+    pending_ids = None # ids read or inserted in the open transaction, shared once it commits (see ID CACHE)
+    instrumented = False # whether instrument() has hooked the connection up for profiling
+
+    def execute(self, sql, parameters=()):
+        if not profiling['enabled']:
+            return super().execute(sql, parameters)
+        return self.profiled().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not profiling['enabled']:
+            return super().executemany(sql, seq_of_parameters)
+        return self.profiled().executemany(sql, seq_of_parameters)
+
+    def profiled(self):
+        """A ProfiledCursor; a connection opened before profiling was turned on is hooked up first, on its own thread."""
+        if not self.instrumented:
+            instrument(self)
+        return self.cursor(ProfiledCursor)
+
+    def commit(self):
+        super().commit()
+        share_ids(self)
+
+    def rollback(self):
+        super().rollback()
+        self.pending_ids = None
+
+    def executescript(self, script):
+        if not profiling['enabled']:
+            return super().executescript(script)
+        if not self.instrumented:
+            instrument(self)
+        start = time.perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            query_profile.record(script, (time.perf_counter() - start) * 1000, 0)
+
+def use_database(path):
+    """Point the default connection at a different database file."""
+    global DATABASE
+    DATABASE = path
+
+def connect(database=None):
+    """Open a brand new connection with our PRAGMAs applied."""
+    conn = sqlite3.connect(database or DATABASE, factory=Connection)
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    if profiling['enabled']:
+        instrument(conn)
+    return conn
+
+def get_connection(database=None):
+    """Hand out this thread's connection to a database, opening it the first time it is asked for."""
+    database = database or DATABASE
+    connections = thread_connections.__dict__.setdefault('connections', {})
+    if database not in connections:
+        connections[database] = connect(database)
+    return connections[database]
+
+def connection(conn=None):
+    """Turn a function's `conn` argument (None, a database path or a connection) into an open connection."""
+    if conn is None or isinstance(conn, str):
+        return get_connection(conn)
+    return conn
+
+def is_snapshot(conn):
+    """Whether `conn` is a collection.Collection (ie opened from a snapshot file) instead of a database."""
+    return getattr(conn, 'snapshot', False) is True
+
+def snapshot_rows(conn, rows, limit=None, offset=0):
+    """The (title, artist, year, format) rows for a snapshot's row numbers, paged like iter_rows."""
+    return (conn.row(row) for row in itertools.islice(rows, offset, None if limit is None else offset + limit))
+
+def database_key(conn):
+    """A key naming the database behind a connection, so caches don't mix up two databases."""
+    key = getattr(conn, 'database_key', None)
+    if key is None:
+        path = conn.execute("""PRAGMA database_list""").fetchone()[2]
+        key = path if path else f'memory:{id(conn)}' # every in-memory database is its own database
+        try:
+            conn.database_key = key
+        except AttributeError:
+            pass # a plain sqlite3.Connection someone passed in; we'll just ask again next time
+    return key
+
+@contextmanager
+def transaction(conn):
+    """`with transaction(conn):` commits on success like `with conn:`, and forgets cached ids if it rolls back."""
+    try:
+        with conn: # commits and rolls back without going through Connection.commit/rollback
+            yield conn
+    except BaseException:
+        if isinstance(conn, Connection):
+            conn.pending_ids = None # ids read or inserted during the rolled back transaction may not exist anymore
+        result_cache.clear() # and results read inside it were read at a generation that got rolled back
+        raise
+    if isinstance(conn, Connection):
+        share_ids(conn)
+
+@contextmanager
+def read_transaction(conn):
+    """`with read_transaction(conn):` makes several SELECTs read the same snapshot of the database."""
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("""BEGIN""")
+    try:
+        yield conn
+    finally:
+        conn.commit()
+
+def close_connections():
+    """Close every connection this thread has opened through get_connection."""
+    connections = thread_connections.__dict__.pop('connections', {})
+    for conn in connections.values():
+        conn.close()
+
+
+
+""" // ID CACHE // """
+
+# Ids read or inserted in a transaction are only shared with other threads once it commits. The cache is dropped
+# whenever PRAGMA data_version shows that another connection has committed.
+
+class IdCache:
+    """A bounded, thread-safe (database, table, name) -> id cache. The least recently used names are evicted first."""
+
+    def __init__(self, maxsize=8192):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+id_cache = IdCache()
+
+def check_ids(conn):
+    """Drop the cached ids if anyone else has committed since conn last looked; False if conn doesn't cache ids."""
+    if not isinstance(conn, Connection):
+        return False
+    if conn.pending_ids is not None:
+        if conn.in_transaction:
+            return True # already checked in this transaction
+        share_ids(conn) # it was committed with a plain COMMIT
+    version = conn.execute("""PRAGMA data_version""").fetchone()[0]
+    if version != conn.data_version:
+        id_cache.clear()
+        conn.data_version = version
+    if conn.in_transaction:
+        conn.pending_ids = {}
+    return True
+
+def share_ids(conn):
+    """Once conn has committed, let every thread use the ids its transaction read or inserted."""
+    pending, conn.pending_ids = conn.pending_ids, None
+    if pending is None:
+        return
+    version = conn.execute("""PRAGMA data_version""").fetchone()[0]
+    if version != conn.data_version:
+        id_cache.clear()
+        conn.data_version = version
+        return
+    for key, id in pending.items():
+        id_cache.put(key, id)
+
+def cached_id(table, name, conn):
+    """A name's id from the cache (conn's own uncommitted ids first), or None. Call check_ids first."""
+    key = (database_key(conn), table, name)
+    if conn.pending_ids and key in conn.pending_ids:
+        return conn.pending_ids[key]
+    return id_cache.get(key)
+
+def lookup_id(table, name, sql, conn):
+    """Find a name's id through the cache, only running `sql` (which selects the id by name) on a miss."""
+    found = cached_id(table, name, conn) if check_ids(conn) else None
+    if found is None:
+        result = conn.execute(sql, (name,)).fetchone()
+        if result:
+            found = remember_id(table, name, result[0], conn)
+    return found
+
+def remember_id(table, name, id, conn):
+    """Tell the cache about an id we just read or inserted; inside a transaction it waits for the commit."""
+    if not check_ids(conn):
+        return id
+    key = (database_key(conn), table, name)
+    if conn.in_transaction:
+        conn.pending_ids[key] = id
+        return id
+    return id_cache.put(key, id)
+
+def forget_id(table, name, conn):
+    """Drop a name from the cache, ie after its row was deleted or renamed."""
+    key = (database_key(conn), table, name)
+    id_cache.discard(key)
+    if getattr(conn, 'pending_ids', None):
+        conn.pending_ids.pop(key, None)
+
+
+
+""" // RESULT CACHE // """
+
+# The get_* functions are wrapped in @cached_result. Every write path bumps the database's generation counter
+# (see bump_generation), and a cached result is only served while the generation it was read at is still current.
+RESULT_CACHE_SIZE = 256 # results kept in memory
+RESULT_CACHE_ROWS = 500000 # rows kept in memory across all of them
+RESULT_CACHE_FILE = os.environ.get('MUSIC_DB_CACHE_FILE') # optional on-disk tier, see enable_disk_cache
+RESULT_CACHE_TIMEOUT = 1.0 # seconds to wait for another process writing to the cache file before skipping it
+
+class ResultCache:
+    """A bounded, thread-safe (database, function, arguments) -> (generation, result) cache, optionally backed by a file."""
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE, max_rows=RESULT_CACHE_ROWS):
+        self.maxsize = maxsize
+        self.max_rows = max_rows
+        self.entries = OrderedDict()
+        self.rows = 0
+        self.path = None
+        self.file = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get(self, key, generation):
+        """(True, result) if a result for key was cached at this generation, otherwise (False, None)."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None and self.path is not None:
+                entry = self.read(key, generation)
+                if entry is not None:
+                    self.disk_hits += 1
+                    self.store(key, entry)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            if entry[0] != generation:
+                self.stale += 1
+                self.misses += 1
+                self.remove(key)
+                return False, None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return True, entry[1]
+
+    def put(self, key, generation, result):
+        with self.lock:
+            self.store(key, (generation, result))
+            if self.path is not None:
+                self.write(key, generation, result)
+        return result
+
+    def store(self, key, entry):
+        """Keep an entry in memory and evict down to the limits; the caller holds the lock."""
+        self.remove(key)
+        self.entries[key] = entry
+        self.rows += result_rows(entry[1])
+        while self.entries and (len(self.entries) > self.maxsize or self.rows > self.max_rows):
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.rows -= result_rows(old_entry[1])
+            self.evictions += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.rows -= result_rows(entry[1])
+
+    def clear(self):
+        """Forget every result, in memory and on disk."""
+        with self.lock:
+            self.entries.clear()
+            self.rows = 0
+            if self.path is not None:
+                try:
+                    self.disk().execute("""DELETE FROM Results""")
+                except sqlite3.Error:
+                    pass # another process holds the file; results stored there still carry their generation
+
+    def open(self, path):
+        self.close()
+        with self.lock:
+            self.path = path
+
+    def disk(self):
+        """The cache file's (autocommit, WAL) connection, opened the first time it is needed; the caller holds the lock."""
+        if self.file is None:
+            self.file = sqlite3.connect(self.path, timeout=RESULT_CACHE_TIMEOUT, isolation_level=None, check_same_thread=False)
+            self.file.execute("""PRAGMA journal_mode = WAL""")
+            self.file.execute("""PRAGMA synchronous = NORMAL""")
+            self.file.execute("""CREATE TABLE IF NOT EXISTS Results (
+                                     key TEXT PRIMARY KEY,
+                                     generation TEXT NOT NULL,
+                                     result BLOB NOT NULL)""")
+        return self.file
+
+    def read(self, key, generation):
+        """The (generation, result) entry stored on disk for key, if it was stored at this generation; the caller holds the lock."""
+        import pickle # only needed for the disk tier
+        try:
+            row = self.disk().execute("""SELECT result FROM Results WHERE key = ? AND generation = ?""",
+                                      (repr(key), repr(generation))).fetchone()
+        except sqlite3.Error:
+            return None # busy for longer than RESULT_CACHE_TIMEOUT, so just run the query
+        return None if row is None else (generation, pickle.loads(row[0]))
+
+    def write(self, key, generation, result):
+        """Store a result on disk; the caller holds the lock."""
+        import pickle
+        try:
+            self.disk().execute("""INSERT OR REPLACE INTO Results (key, generation, result) VALUES (?, ?, ?)""",
+                                (repr(key), repr(generation), pickle.dumps(result, pickle.HIGHEST_PROTOCOL)))
+        except sqlite3.Error:
+            pass # the result is still cached in memory
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.path = None
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'maxsize': self.maxsize, 'rows': self.rows, 'max_rows': self.max_rows,
+                    'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'stale': self.stale,
+                    'evictions': self.evictions, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'disk': self.path is not None}
+
+result_cache = ResultCache()
+
+def result_rows(result):
+    """How much a result counts against RESULT_CACHE_ROWS: its length if it is a list, otherwise 1."""
+    return len(result) if isinstance(result, (list, tuple)) else 1
+
+def database_generation(conn):
+    """The database's (nonce, generation counter), or None if it doesn't have them yet (so nothing gets cached)."""
+    try:
+        return tuple(conn.execute("""SELECT nonce, generation FROM Generation WHERE id = 1""").fetchone())
+    except (sqlite3.OperationalError, TypeError):
+        return None
+
+def bump_generation(conn):
+    """Mark the database as changed (inside the caller's transaction), which retires every cached result read from it."""
+    try:
+        conn.execute("""UPDATE Generation SET generation = generation + 1 WHERE id = 1""")
+    except sqlite3.OperationalError:
+        pass # not migrated yet, so nothing can have been cached either
+
+def cached_result(function):
+    """Decorator for read-only getters: serve repeated calls from result_cache until the database's generation changes."""
+    name = f"{function.__module__}.{function.__qualname__}" # getters in different modules may share a __name__
+    @functools.wraps(function)
+    def wrapper(*args, conn=None, **kwargs):
+        conn = connection(conn)
+        generation = None if is_snapshot(conn) else database_generation(conn) # a snapshot never changes under us
+        if generation is None:
+            return function(*args, conn=conn, **kwargs)
+        key = (database_key(conn), name, hashable(args), hashable(sorted(kwargs.items())))
+        found, result = result_cache.get(key, generation)
+        if not found:
+            result = result_cache.put(key, generation, function(*args, conn=conn, **kwargs))
+        return list(result) if isinstance(result, list) else result # callers are free to change what they get back
+    return wrapper
+
+def hashable(value):
+    """Arguments as a cache key: lists (ie of genres) become tuples, all the way down."""
+    if isinstance(value, (list, tuple)):
+        return tuple(hashable(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(value))
+    return value
+
+def enable_disk_cache(path=RESULT_CACHE_FILE):
+    """Also keep cached results in a SQLite file that the next process (or several at once) can use."""
+    result_cache.open(path)
+    atexit.register(result_cache.close)
+
+def print_cache_stats():
+    """Print how well the id and result caches are doing."""
+    for name, cache in [('id cache', id_cache), ('result cache', result_cache)]:
+        stats = cache.stats()
+        print(f"{name}: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%}), {stats['size']} entries")
+
+if RESULT_CACHE_FILE:
+    enable_disk_cache(RESULT_CACHE_FILE)
+
+
+
+""" // QUERY PROFILING // """
+
+# Turned on without touching the code: MUSIC_DB_PROFILE=1 python user_music.py
+#   MUSIC_DB_PROFILE      '1' counts and times every statement, 'trace' also logs each one (with its values) at DEBUG
+#   MUSIC_DB_SLOW_MS      statements slower than this are logged with their query plan (default 100)
+#   MUSIC_DB_MAX_STEPS    interrupt any statement running more than this many SQLite VM instructions (default: never)
+#   MUSIC_DB_PROFILE_FILE also write the summary to this JSON file
+PROFILE_SETTING = os.environ.get('MUSIC_DB_PROFILE', '').strip().lower()
+profiling = {
+    'enabled': PROFILE_SETTING not in ('', '0', 'no', 'off', 'false'),
+    'trace': PROFILE_SETTING == 'trace',
+    'slow_ms': float(os.environ.get('MUSIC_DB_SLOW_MS') or 100),
+    'max_steps': int(os.environ.get('MUSIC_DB_MAX_STEPS') or 0),
+    'file': os.environ.get('MUSIC_DB_PROFILE_FILE'),
+}
+PROGRESS_INTERVAL = 1000 # VM instructions between progress handler calls
+
+def profile_logger():
+    """The 'music_collection' logger that slow and traced statements go to; logging is only imported once one is logged."""
+    import logging
+    return logging.getLogger('music_collection')
+
+class QueryProfile:
+    """Thread-safe per-statement counters: calls, total time, rows, VM instructions and the latest latencies (for p95)."""
+
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self.statements = {}
+        self.lock = threading.Lock()
+
+    def record(self, sql, ms, rows, steps=0):
+        key = ' '.join(sql.split())
+        with self.lock:
+            entry = self.statements.get(key)
+            if entry is None:
+                entry = self.statements[key] = {'calls': 0, 'total_ms': 0.0, 'rows': 0, 'vm_steps': 0,
+                                                'latencies': deque(maxlen=self.samples)}
+            entry['calls'] += 1
+            entry['total_ms'] += ms
+            entry['rows'] += rows
+            entry['vm_steps'] += steps * PROGRESS_INTERVAL
+            entry['latencies'].append(ms)
+
+    def summary(self):
+        """One dict per statement, the ones that took the most time in total first."""
+        with self.lock:
+            rows = []
+            for sql, entry in self.statements.items():
+                latencies = sorted(entry['latencies'])
+                rows.append({'sql': sql, 'calls': entry['calls'], 'total_ms': entry['total_ms'],
+                             'mean_ms': entry['total_ms'] / entry['calls'],
+                             'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                             'rows': entry['rows'], 'vm_steps': entry['vm_steps']})
+        return sorted(rows, key=lambda row: row['total_ms'], reverse=True)
+
+    def clear(self):
+        with self.lock:
+            self.statements.clear()
+
+query_profile = QueryProfile()
+
+class ProfiledCursor(sqlite3.Cursor):
+    """A cursor that adds the time, rows and VM instructions of its statement to query_profile, and logs it if it was slow."""
+    statement = None
+
+    def execute(self, sql, parameters=()):
+        self.finish()
+        self.statement, self.parameters, self.elapsed, self.rows, self.steps = sql, parameters, 0.0, 0, 0
+        self.connection.statement_steps = 0
+        return self.timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.finish()
+        self.statement, self.parameters, self.elapsed, self.rows, self.steps = sql, None, 0.0, 0, 0
+        self.connection.statement_steps = 0
+        return self.timed(super().executemany, sql, seq_of_parameters)
+
+    def timed(self, method, *args):
+        steps = getattr(self.connection, 'steps', 0)
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.elapsed += time.perf_counter() - start
+            self.steps += getattr(self.connection, 'steps', 0) - steps
+
+    def fetchone(self):
+        row = self.timed(super().fetchone)
+        if row is None:
+            self.finish()
+        else:
+            self.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self.timed(super().fetchmany, size)
+        self.rows += len(rows)
+        if len(rows) < size:
+            self.finish()
+        return rows
+
+    def fetchall(self):
+        rows = self.timed(super().fetchall)
+        self.rows += len(rows)
+        self.finish()
+        return rows
+
+    def __next__(self):
+        try:
+            row = self.timed(super().__next__)
+        except StopIteration:
+            self.finish()
+            raise
+        self.rows += 1
+        return row
+
+    def close(self):
+        self.finish()
+        super().close()
+
+    def __del__(self):
+        self.finish()
+
+    def finish(self):
+        """Record the statement this cursor ran, if it hasn't been recorded yet."""
+        if self.statement is None:
+            return
+        statement, self.statement = self.statement, None
+        ms = self.elapsed * 1000
+        rows = self.rows or max(self.rowcount, 0) # rows changed, for INSERT/UPDATE/DELETE
+        query_profile.record(statement, ms, rows, self.steps)
+        if ms >= profiling['slow_ms']:
+            log_slow_query(statement, self.parameters, ms, rows, self.connection)
+
+def log_slow_query(sql, parameters, ms, rows, conn):
+    """Log a slow statement along with how SQLite ran it."""
+    plan = []
+    if parameters is not None:
+        try:
+            cursor = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, parameters) # not profiled itself
+            plan = [row[-1] for row in cursor.fetchall()]
+        except sqlite3.Error:
+            pass # ie the connection was closed before the cursor was cleaned up
+    profile_logger().warning("slow query (%.1f ms, %d rows): %s\n    plan: %s", ms, rows, ' '.join(sql.split()), '; '.join(plan) or '-')
+
+def log_statement(sql):
+    """Trace callback: log every statement SQLite runs, with its bound values (and the ones run by triggers)."""
+    profile_logger().debug("sql: %s", sql)
+
+def instrument(conn):
+    """Hook a new connection up for profiling (a VM instruction counter, plus the trace callback in 'trace' mode)."""
+    conn.steps = conn.statement_steps = 0 # all time / since the latest execute
+    def progress():
+        conn.steps += 1
+        conn.statement_steps += 1
+        return profiling['max_steps'] and conn.statement_steps * PROGRESS_INTERVAL > profiling['max_steps']
+    conn.set_progress_handler(progress, PROGRESS_INTERVAL)
+    conn.set_trace_callback(log_statement if profiling['trace'] else None)
+    conn.instrumented = True
+    return conn
+
+def enable_profiling(slow_ms=None, trace=False, max_steps=None):
+    """Turn profiling on from code instead of MUSIC_DB_PROFILE. Connections opened earlier get the hooks at their next statement."""
+    profiling['enabled'] = True
+    profiling['trace'] = trace
+    if slow_ms is not None:
+        profiling['slow_ms'] = slow_ms
+    if max_steps is not None:
+        profiling['max_steps'] = max_steps
+
+def print_query_profile(limit=15, path=None):
+    """Print the statements that took the most time and save them all as JSON, if profiling is on."""
+    if not profiling['enabled']:
+        return []
+    summary = query_profile.summary()
+    print(f"\nQuery profile ({len(summary)} statements, {sum(row['total_ms'] for row in summary):.1f} ms in total):")
+    print(f"{'calls':>7} {'total ms':>10} {'p95 ms':>8} {'rows':>9}  statement")
+    for row in summary[:limit]:
+        sql = row['sql'] if len(row['sql']) <= 90 else row['sql'][:87] + '...'
+        print(f"{row['calls']:>7} {row['total_ms']:>10.1f} {row['p95_ms']:>8.2f} {row['rows']:>9}  {sql}")
+    path = path or profiling['file']
+    if path:
+        with open(path, 'w') as file:
+            json.dump(summary, file, indent=2)
+    return summary
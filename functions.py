@@ -3,38 +3,45 @@ Myriah Hodgson, 06/22/2024"""
 
 # Import SQL
 import sqlite3
+import itertools
+import json
+import random as rand
+import heapq
+import time
 
-# Connect to the database
-conn = sqlite3.connect('music_collection.db')
-cursor = conn.cursor()
+from db import (bump_generation, cached_id, cached_result, check_ids, connection, database_key, forget_id, is_snapshot,
+                log_statement, lookup_id, profiling, read_transaction, remember_id, snapshot_rows, transaction)
+from history import record_suggestions
+from search import SEARCH_INDEX_SQL, fuzzy_find_artist, has_search_index, refresh_search_index, search_index_migration
 
 
 """ // TABLE CREATION FUNCTION // """
 
-def create_tables():
-    cursor.execute("""
+def create_tables(conn=None):
+    conn = connection(conn)
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS Artists (
                id INTEGER PRIMARY KEY,
                name TEXT UNIQUE NOT NULL
         )
     """)
-    cursor.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS Albums (
                id INTEGER PRIMARY KEY,
-               title TEXT UNIQUE NOT NULL,
+               title TEXT NOT NULL,
                artist_id INTEGER NOT NULL,
                year INTEGER,
                FOREIGN KEY (artist_id) REFERENCES Artists(id),
                UNIQUE (title, artist_id)
         )
     """)
-    cursor.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS Formats (
                id INTEGER PRIMARY KEY,
                format_name TEXT UNIQUE NOT NULL
         )
     """)
-    cursor.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS FormattedAlbums (
                album_id INTEGER NOT NULL,
                format_id INTEGER NOT NULL,
@@ -43,13 +50,13 @@ def create_tables():
                PRIMARY KEY (album_id, format_id)
         )
     """)
-    cursor.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS Genres (
                id INTEGER PRIMARY KEY,
                genre_name TEXT UNIQUE NOT NULL
         )""")
 
-    cursor.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS AlbumGenres (
                album_id INTEGER,
                genre_id INTEGER,
@@ -58,188 +65,624 @@ def create_tables():
                FOREIGN KEY (genre_id) REFERENCES Genres(id)
 
         )""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS CatalogAlbums (
+               album_id INTEGER NOT NULL,
+               source TEXT NOT NULL,
+               source_id TEXT,
+               ranking INTEGER,
+               average_rating REAL,
+               rating_count INTEGER,
+               review_count INTEGER,
+               descriptors TEXT,
+               url TEXT,
+               FOREIGN KEY (album_id) REFERENCES Albums(id),
+               PRIMARY KEY (album_id, source)
+        )""")
+    migrate(conn=conn)
     return
 
 
 
+""" // SCHEMA MIGRATIONS & QUERY PLANS // """
+
+# Each entry upgrades the schema by one version; PRAGMA user_version records how many have been applied.
+# Summary tables for the collection I own (albums with at least one format). Triggers keep them current on every
+# insert/delete, so the popularity and decade/format breakdowns are lookups instead of GROUP BYs over the whole collection.
+STATS_TABLES_SQL = """
+    CREATE TABLE IF NOT EXISTS ArtistStats (artist_id INTEGER PRIMARY KEY, album_count INTEGER NOT NULL);
+    CREATE TABLE IF NOT EXISTS GenreStats (genre_id INTEGER PRIMARY KEY, album_count INTEGER NOT NULL);
+    CREATE TABLE IF NOT EXISTS FormatStats (format_id INTEGER PRIMARY KEY, album_count INTEGER NOT NULL);
+    CREATE TABLE IF NOT EXISTS DecadeFormatStats (
+        decade INTEGER NOT NULL,
+        format_id INTEGER NOT NULL,
+        album_count INTEGER NOT NULL,
+        PRIMARY KEY (decade, format_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_artiststats_count ON ArtistStats (album_count);
+
+    CREATE TRIGGER IF NOT EXISTS stats_formattedalbums_insert AFTER INSERT ON FormattedAlbums
+    BEGIN
+        INSERT INTO FormatStats (format_id, album_count) VALUES (NEW.format_id, 1)
+            ON CONFLICT (format_id) DO UPDATE SET album_count = album_count + 1;
+        INSERT INTO DecadeFormatStats (decade, format_id, album_count)
+            SELECT year / 10 * 10, NEW.format_id, 1 FROM Albums WHERE id = NEW.album_id AND year IS NOT NULL
+            ON CONFLICT (decade, format_id) DO UPDATE SET album_count = album_count + 1;
+        -- the album's first format makes it part of my collection
+        INSERT INTO ArtistStats (artist_id, album_count)
+            SELECT artist_id, 1 FROM Albums
+            WHERE id = NEW.album_id AND (SELECT COUNT(*) FROM FormattedAlbums WHERE album_id = NEW.album_id) = 1
+            ON CONFLICT (artist_id) DO UPDATE SET album_count = album_count + 1;
+        INSERT INTO GenreStats (genre_id, album_count)
+            SELECT genre_id, 1 FROM AlbumGenres
+            WHERE album_id = NEW.album_id AND (SELECT COUNT(*) FROM FormattedAlbums WHERE album_id = NEW.album_id) = 1
+            ON CONFLICT (genre_id) DO UPDATE SET album_count = album_count + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS stats_formattedalbums_delete AFTER DELETE ON FormattedAlbums
+    BEGIN
+        UPDATE FormatStats SET album_count = album_count - 1 WHERE format_id = OLD.format_id;
+        UPDATE DecadeFormatStats SET album_count = album_count - 1
+            WHERE format_id = OLD.format_id AND decade = (SELECT year / 10 * 10 FROM Albums WHERE id = OLD.album_id);
+        -- the album's last format leaves my collection
+        UPDATE ArtistStats SET album_count = album_count - 1
+            WHERE artist_id = (SELECT artist_id FROM Albums WHERE id = OLD.album_id)
+            AND NOT EXISTS (SELECT 1 FROM FormattedAlbums WHERE album_id = OLD.album_id);
+        UPDATE GenreStats SET album_count = album_count - 1
+            WHERE genre_id IN (SELECT genre_id FROM AlbumGenres WHERE album_id = OLD.album_id)
+            AND NOT EXISTS (SELECT 1 FROM FormattedAlbums WHERE album_id = OLD.album_id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS stats_albumgenres_insert AFTER INSERT ON AlbumGenres
+    WHEN EXISTS (SELECT 1 FROM FormattedAlbums WHERE album_id = NEW.album_id)
+    BEGIN
+        INSERT INTO GenreStats (genre_id, album_count) VALUES (NEW.genre_id, 1)
+            ON CONFLICT (genre_id) DO UPDATE SET album_count = album_count + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS stats_albumgenres_delete AFTER DELETE ON AlbumGenres
+    WHEN EXISTS (SELECT 1 FROM FormattedAlbums WHERE album_id = OLD.album_id)
+    BEGIN
+        UPDATE GenreStats SET album_count = album_count - 1 WHERE genre_id = OLD.genre_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS stats_albums_artist AFTER UPDATE OF artist_id ON Albums
+    WHEN EXISTS (SELECT 1 FROM FormattedAlbums WHERE album_id = NEW.id)
+    BEGIN
+        UPDATE ArtistStats SET album_count = album_count - 1 WHERE artist_id = OLD.artist_id;
+        INSERT INTO ArtistStats (artist_id, album_count) VALUES (NEW.artist_id, 1)
+            ON CONFLICT (artist_id) DO UPDATE SET album_count = album_count + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS stats_albums_year AFTER UPDATE OF year ON Albums
+    WHEN EXISTS (SELECT 1 FROM FormattedAlbums WHERE album_id = NEW.id)
+    BEGIN
+        UPDATE DecadeFormatStats SET album_count = album_count - 1
+            WHERE decade = OLD.year / 10 * 10 AND format_id IN (SELECT format_id FROM FormattedAlbums WHERE album_id = NEW.id);
+        INSERT INTO DecadeFormatStats (decade, format_id, album_count)
+            SELECT NEW.year / 10 * 10, format_id, 1 FROM FormattedAlbums WHERE album_id = NEW.id AND NEW.year IS NOT NULL
+            ON CONFLICT (decade, format_id) DO UPDATE SET album_count = album_count + 1;
+    END;
+    """
+
+# Recomputes every summary table from scratch (see rebuild_stats).
+STATS_REBUILD_SQL = """
+    DELETE FROM ArtistStats;
+    DELETE FROM GenreStats;
+    DELETE FROM FormatStats;
+    DELETE FROM DecadeFormatStats;
+    INSERT INTO ArtistStats (artist_id, album_count)
+        SELECT artist_id, COUNT(*) FROM Albums
+        WHERE id IN (SELECT album_id FROM FormattedAlbums)
+        GROUP BY artist_id;
+    INSERT INTO GenreStats (genre_id, album_count)
+        SELECT genre_id, COUNT(*) FROM AlbumGenres
+        WHERE album_id IN (SELECT album_id FROM FormattedAlbums)
+        GROUP BY genre_id;
+    INSERT INTO FormatStats (format_id, album_count)
+        SELECT format_id, COUNT(*) FROM FormattedAlbums
+        GROUP BY format_id;
+    INSERT INTO DecadeFormatStats (decade, format_id, album_count)
+        SELECT Albums.year / 10 * 10, FormattedAlbums.format_id, COUNT(*)
+        FROM FormattedAlbums
+        JOIN Albums ON FormattedAlbums.album_id = Albums.id
+        WHERE Albums.year IS NOT NULL
+        GROUP BY 1, 2;
+    """
+
+def albums_uniqueness_migration(conn):
+    """Migration 11: rebuild Albums so only (title, artist_id) is unique, keeping its ids, indexes and triggers."""
+    # dropping Albums drops its indexes and triggers too, so they are created again (the rest already exist)
+    search_triggers = SEARCH_INDEX_SQL if has_search_index(conn) else ""
+    return """
+    PRAGMA legacy_alter_table = ON;
+    CREATE TABLE Albums_new (
+        id INTEGER PRIMARY KEY,
+        title TEXT NOT NULL,
+        artist_id INTEGER NOT NULL,
+        year INTEGER,
+        FOREIGN KEY (artist_id) REFERENCES Artists(id),
+        UNIQUE (title, artist_id)
+    );
+    INSERT INTO Albums_new (id, title, artist_id, year) SELECT id, title, artist_id, year FROM Albums;
+    DROP TABLE Albums;
+    ALTER TABLE Albums_new RENAME TO Albums;
+    PRAGMA legacy_alter_table = OFF;
+    """ + MIGRATIONS[0] + STATS_TABLES_SQL + search_triggers
+
+MIGRATIONS = [
+    # 1: covering indexes for the filters used by the JOIN-heavy getters
+    """
+    CREATE INDEX IF NOT EXISTS idx_albums_year ON Albums (year, artist_id, title);
+    CREATE INDEX IF NOT EXISTS idx_albums_artist ON Albums (artist_id, year, title);
+    CREATE INDEX IF NOT EXISTS idx_albumgenres_genre ON AlbumGenres (genre_id, album_id);
+    CREATE INDEX IF NOT EXISTS idx_formattedalbums_format ON FormattedAlbums (format_id, album_id);
+    """,
+    # 2: summary tables for artist/genre/format/decade counts
+    STATS_TABLES_SQL + STATS_REBUILD_SQL,
+    # 3: trigram full-text index for fuzzy search (a function of the connection, run when the migration is applied)
+    search_index_migration,
+    # 4: owned album -> catalog album links found by match_collection_to_catalog
+    """
+    CREATE TABLE IF NOT EXISTS CatalogMatches (
+        album_id INTEGER PRIMARY KEY REFERENCES Albums(id),
+        catalog_album_id INTEGER NOT NULL REFERENCES Albums(id),
+        score REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_catalogmatches_catalog ON CatalogMatches (catalog_album_id);
+    """,
+    # 5: what sync_music last wrote from each media list
+    """
+    CREATE TABLE IF NOT EXISTS SyncSources (
+        source TEXT PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        synced_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS SyncRecords (
+        source TEXT,
+        record_key TEXT,
+        fingerprint TEXT NOT NULL,
+        record TEXT NOT NULL,
+        PRIMARY KEY (source, record_key)
+    );
+    """,
+    # 6: generation counter bumped by every write, so cached results know when they are stale (see db.cached_result)
+    """
+    CREATE TABLE IF NOT EXISTS Generation (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        generation INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO Generation (id, generation) VALUES (1, 0);
+    """,
+    # 7: catalog file shards already written by import_catalogs, so an interrupted import can pick up where it stopped
+    """
+    CREATE TABLE IF NOT EXISTS IngestShards (
+        path TEXT,
+        signature TEXT NOT NULL,
+        start_byte INTEGER,
+        end_byte INTEGER,
+        rows INTEGER,
+        skipped INTEGER,
+        done_at TEXT,
+        PRIMARY KEY (path, start_byte, end_byte)
+    );
+    """,
+    # 8: every suggestion/listen (append-only), and per-album counts of them for the 'fresh' sample weight
+    """
+    CREATE TABLE IF NOT EXISTS SuggestionHistory (
+        id INTEGER PRIMARY KEY,
+        album_id INTEGER NOT NULL REFERENCES Albums(id),
+        format_id INTEGER REFERENCES Formats(id),
+        event TEXT NOT NULL,
+        at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS AlbumPlayStats (
+        album_id INTEGER PRIMARY KEY REFERENCES Albums(id),
+        suggested INTEGER NOT NULL DEFAULT 0,
+        played INTEGER NOT NULL DEFAULT 0,
+        last_suggested REAL,
+        last_played REAL
+    );
+    """,
+    # 9: the catalogs' own genres/styles, kept apart from the genres I gave my albums (AlbumGenres)
+    """
+    ALTER TABLE CatalogAlbums ADD COLUMN genres TEXT;
+    UPDATE CatalogAlbums SET genres = (
+        SELECT group_concat(Genres.genre_name, '; ') FROM AlbumGenres
+        JOIN Genres ON AlbumGenres.genre_id = Genres.id
+        WHERE AlbumGenres.album_id = CatalogAlbums.album_id)
+    WHERE album_id NOT IN (SELECT album_id FROM FormattedAlbums);
+    DELETE FROM AlbumGenres
+    WHERE album_id IN (SELECT album_id FROM CatalogAlbums) AND album_id NOT IN (SELECT album_id FROM FormattedAlbums);
+    """,
+    # 10: a random nonce per database, so cached results (see db.cached_result) can't outlive a database recreated at the same path
+    """
+    ALTER TABLE Generation ADD COLUMN nonce TEXT;
+    UPDATE Generation SET nonce = lower(hex(randomblob(8)));
+    """,
+    # 11: titles only unique per artist, so a catalog album can't take the title of one I own (or will own) by another artist
+    albums_uniqueness_migration,
+]
+
+LARGE_TABLES = ('Albums', 'FormattedAlbums', 'AlbumGenres', 'CatalogAlbums')
+
+def schema_version(conn=None):
+    """Which migration the database is currently at."""
+    conn = connection(conn)
+    cursor = conn.execute("""PRAGMA user_version""")
+    return cursor.fetchone()[0]
+
+def migrate(conn=None):
+    """Apply any migrations the database hasn't seen yet, each one in its own transaction."""
+    conn = connection(conn)
+    version = schema_version(conn=conn)
+    for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        if callable(script):
+            script = script(conn)
+        conn.executescript(f"BEGIN; {script} PRAGMA user_version = {number}; COMMIT;")
+    refresh_search_index(conn=conn) # migrations that touch albums or genres queue them
+    return schema_version(conn=conn)
+
+schema_ready = set() # databases ensure_schema has already checked in this process
+
+def ensure_schema(conn=None):
+    """create_tables, but only if the database isn't at the latest migration yet (checked once per database)."""
+    conn = connection(conn)
+    key = database_key(conn)
+    if key not in schema_ready:
+        if schema_version(conn=conn) < len(MIGRATIONS):
+            create_tables(conn=conn)
+        schema_ready.add(key)
+
+def explain_query_plan(sql, params=(), conn=None):
+    """Return the detail column of EXPLAIN QUERY PLAN for a statement, ie ['SEARCH Albums USING INDEX ...', ...]."""
+    conn = connection(conn)
+    cursor = conn.execute("EXPLAIN QUERY PLAN " + sql, params)
+    return [row[-1] for row in cursor.fetchall()]
+
+def explain_getters(conn=None):
+    """Run every filtering getter once, with arguments taken from the database, and return the query plan of each."""
+    conn = connection(conn)
+    cursor = conn.execute("""SELECT genre_name FROM Genres LIMIT 1""")
+    genre = (cursor.fetchone() or ('Rock',))[0]
+    cursor = conn.execute("""SELECT name FROM Artists LIMIT 1""")
+    artist = (cursor.fetchone() or ('Eagles',))[0]
+    cursor = conn.execute("""SELECT format_name FROM Formats LIMIT 1""")
+    media = (cursor.fetchone() or ('vinyl',))[0]
+    calls = {
+        'get_albums_by_genre': (get_albums_by_genre, (genre,)),
+        'get_albums_by_artist': (get_albums_by_artist, (artist,)),
+        'get_albums_by_media': (get_albums_by_media, (media,)),
+        'formatted_album_between_years': (formatted_album_between_years, (1970, 1979)),
+        'artist_album_count': (artist_album_count, (artist,)),
+        'get_genres_for_album': (get_genres_for_album, ('Rumours',)),
+    }
+    plans = {}
+    for name, (getter, args) in calls.items():
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            getter.__wrapped__(*args, conn=conn) # straight to the query, past the result cache
+        finally:
+            conn.set_trace_callback(log_statement if profiling['trace'] else None)
+        plans[name] = [line for sql in statements for line in explain_query_plan(sql, conn=conn)]
+    return plans
+
+def full_table_scans(plans=None, tables=LARGE_TABLES, conn=None):
+    """List the (getter, plan line) pairs where a getter scans a whole large table instead of searching an index."""
+    if plans is None:
+        plans = explain_getters(conn=conn)
+    scans = []
+    for name, lines in plans.items():
+        for line in lines:
+            words = line.split()
+            if len(words) > 1 and words[0] == 'SCAN' and words[1] in tables:
+                scans.append((name, line))
+    return scans
+
+
+
 """ // INSERTION & ID FINDING FUNCTIONS // """
 
-def insert_artist(name):
+def insert_artist(name, conn=None):
     """This function inserts a new artist into our Artists table."""
-    cursor.execute("""INSERT OR IGNORE INTO Artists (name) VALUES (?)""", (name,))
+    conn = connection(conn)
+    cursor = conn.execute("""INSERT OR IGNORE INTO Artists (name) VALUES (?)""", (name,))
+    bump_generation(conn)
     conn.commit()
+    if cursor.rowcount == 1:
+        remember_id('Artists', name, cursor.lastrowid, conn)
     return cursor.lastrowid
 
-def find_artist_id(name):
+def find_artist_id(name, conn=None):
     """This function finds the id associated with an artist."""
-    cursor.execute("""SELECT id FROM Artists WHERE name = ?""", (name,))
-    result = cursor.fetchone()
-    if result:
-        return result[0]
-    return None
+    conn = connection(conn)
+    return lookup_id('Artists', name, """SELECT id FROM Artists WHERE name = ?""", conn)
 
-def insert_album(title, artist_name, year):
+def insert_album(title, artist_name, year, conn=None):
     """This function inserts an album into our Albums table if it doesn't already exist."""
-    artist_id = find_artist_id(artist_name)
+    conn = connection(conn)
+    artist_id = find_artist_id(artist_name, conn=conn)
     if not artist_id:
-        artist_id = insert_artist(artist_name) # if for some reason the artist is not in our Artists table, add it.
+        artist_id = insert_artist(artist_name, conn=conn) # if for some reason the artist is not in our Artists table, add it.
     
     # Check if the album already exists
-    cursor.execute("""SELECT id FROM Albums WHERE title = ? AND artist_id = ?""", (title, artist_id))
+    cursor = conn.execute("""SELECT id FROM Albums WHERE title = ? AND artist_id = ?""", (title, artist_id))
     result = cursor.fetchone()
     if result:
         print(f"Album '{title}' by '{artist_name}' already exists in the database.")
         return result[0]
     else:
-        cursor.execute("""INSERT INTO Albums (title, artist_id, year) VALUES (?, ?, ?)""", (title, artist_id, year))
+        cursor = conn.execute("""INSERT INTO Albums (title, artist_id, year) VALUES (?, ?, ?)""", (title, artist_id, year))
+        bump_generation(conn)
         conn.commit()
+        refresh_search_index(conn=conn)
+        forget_id('Albums', title, conn) # the title may now mean this album (see ALBUM_BY_TITLE_SQL)
         return cursor.lastrowid
 
-def find_album_id(title):
+# Titles are only unique per artist, so a bare title means the album I own with it, or else the newest one
+# (ie the album insert_album just added, for insert_formatted_album).
+ALBUM_BY_TITLE_SQL = """
+    SELECT id FROM Albums WHERE title = ?
+    ORDER BY EXISTS (SELECT 1 FROM FormattedAlbums WHERE album_id = Albums.id) DESC, id DESC LIMIT 1"""
+
+def find_album_id(title, conn=None):
     """This function finds the id associated with an album."""
-    cursor.execute("""SELECT id FROM Albums WHERE title = ?""", (title,))
-    result = cursor.fetchone()
-    if result:
-        return result[0]
-    return None
+    conn = connection(conn)
+    return lookup_id('Albums', title, ALBUM_BY_TITLE_SQL, conn)
 
-def load_format(format):
+def load_format(format, conn=None):
     """Insert any new possible format types of our media."""
-    cursor.execute("""INSERT INTO Formats (format_name) VALUES (?)""", (format,))
+    conn = connection(conn)
+    cursor = conn.execute("""INSERT INTO Formats (format_name) VALUES (?)""", (format,))
+    bump_generation(conn)
     conn.commit()
-    return cursor.lastrowid
+    return remember_id('Formats', format, cursor.lastrowid, conn)
 
-def find_format_id(format):
+def find_format_id(format, conn=None):
     """We also need the id associated with each format type."""
-    cursor.execute("""SELECT id from Formats WHERE format_name = ?""", (format,))
-    format_id = cursor.fetchone()[0]
-    return format_id
+    conn = connection(conn)
+    return lookup_id('Formats', format, """SELECT id from Formats WHERE format_name = ?""", conn)
 
-def insert_formatted_album(album_title, format_title):
+def insert_formatted_album(album_title, format_title, conn=None):
     """Finally, we will use the above functions in order to insert an album also with its media type."""
-    album_id = find_album_id(album_title)
-    format_id = find_format_id(format_title)
-    cursor.execute("""INSERT OR IGNORE INTO FormattedAlbums (album_id, format_id) VALUES (?, ?)""", (album_id, format_id))
+    conn = connection(conn)
+    album_id = find_album_id(album_title, conn=conn)
+    format_id = find_format_id(format_title, conn=conn)
+    cursor = conn.execute("""INSERT OR IGNORE INTO FormattedAlbums (album_id, format_id) VALUES (?, ?)""", (album_id, format_id))
+    bump_generation(conn)
     conn.commit()
     return cursor.lastrowid
 
-def insert_genre(genre_name):
+def insert_genre(genre_name, conn=None):
     """Insert a new genre into Genres table, if it doesn't already exist."""
-    cursor.execute("""INSERT OR IGNORE INTO Genres (genre_name) VALUES (?)""", (genre_name,))
+    conn = connection(conn)
+    cursor = conn.execute("""INSERT OR IGNORE INTO Genres (genre_name) VALUES (?)""", (genre_name,))
+    bump_generation(conn)
     conn.commit()
+    if cursor.rowcount == 1:
+        remember_id('Genres', genre_name, cursor.lastrowid, conn)
     return cursor.lastrowid
 
-def find_genre_id(genre_name):
+def find_genre_id(genre_name, conn=None):
     """Retrieve the id of a genre by its name."""
-    cursor.execute("""SELECT id FROM Genres WHERE genre_name = ?""", (genre_name,))
-    result = cursor.fetchone()
-    if result:
-        return result[0]
-    else:
-        return None
+    conn = connection(conn)
+    return lookup_id('Genres', genre_name, """SELECT id FROM Genres WHERE genre_name = ?""", conn)
     
 
 
+""" // SHARED ALBUM QUERIES // """
+
+# Each of these selects (title, artist, year, format) rows; they are shared by the get_*, iter_* and query_* functions.
+FORMATTED_ALBUMS_SQL = """
+    SELECT Albums.title, Artists.name, Albums.year, Formats.format_name
+    FROM FormattedAlbums
+    JOIN Albums ON FormattedAlbums.album_id = Albums.id
+    JOIN Artists ON Albums.artist_id = Artists.id
+    JOIN Formats ON FormattedAlbums.format_id = Formats.id
+    """
+
+ALBUMS_BY_MEDIA_SQL = """
+    SELECT Albums.title, Artists.name, Albums.year, Formats.format_name
+    FROM Albums
+    JOIN Artists ON Albums.artist_id = Artists.id
+    JOIN FormattedAlbums ON Albums.id = FormattedAlbums.album_id
+    JOIN Formats ON FormattedAlbums.format_id = Formats.id
+    WHERE Formats.format_name = ?
+    """
+
+ALBUMS_BY_ARTIST_SQL = """
+    SELECT Albums.title, Artists.name, Albums.year, Formats.format_name
+    FROM Albums
+    JOIN Artists ON Albums.artist_id = Artists.id
+    JOIN FormattedAlbums ON Albums.id = FormattedAlbums.album_id
+    JOIN Formats ON FormattedAlbums.format_id = Formats.id
+    WHERE Artists.name = ?
+    """
+
+ALBUMS_BETWEEN_YEARS_SQL = """
+    SELECT Albums.title, Artists.name, Albums.year, Formats.format_name
+    FROM FormattedAlbums
+    JOIN Albums ON FormattedAlbums.album_id = Albums.id
+    JOIN Artists ON Albums.artist_id = Artists.id
+    JOIN Formats ON FormattedAlbums.format_id = Formats.id
+    WHERE Albums.year BETWEEN ? AND ?
+    """
+
+ALBUMS_BY_GENRE_SQL = """
+    SELECT Albums.title, Artists.name, Albums.year, Formats.format_name
+    FROM Albums
+    JOIN Artists ON Albums.artist_id = Artists.id
+    JOIN AlbumGenres ON Albums.id = AlbumGenres.album_id
+    JOIN FormattedAlbums ON Albums.id = FormattedAlbums.album_id
+    JOIN Formats ON FormattedAlbums.format_id = Formats.id
+    JOIN Genres ON AlbumGenres.genre_id = Genres.id
+    WHERE Genres.genre_name = ?
+    """
+
+
+
+""" // STREAMING (ITER) FUNCTIONS // """
+
+BATCH_SIZE = 500 # rows pulled from SQLite per fetchmany
+PAGE_SIZE = 20 # rows printed per page by the search_* functions
+
+def iter_rows(sql, params=(), batch_size=BATCH_SIZE, limit=None, offset=0, conn=None):
+    """Yield the rows of a query batch_size at a time, paged by limit/offset in a stable (Albums.id, Formats.id) order."""
+    conn = connection(conn)
+    if limit is not None or offset:
+        sql += " ORDER BY Albums.id, Formats.id LIMIT ? OFFSET ?"
+        params = tuple(params) + (-1 if limit is None else limit, offset)
+    cursor = conn.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+def iter_formatted_albums(batch_size=BATCH_SIZE, limit=None, offset=0, conn=None):
+    """Stream all formatted albums."""
+    if is_snapshot(conn):
+        return snapshot_rows(conn, conn.matching(owned=True), limit, offset)
+    return iter_rows(FORMATTED_ALBUMS_SQL, (), batch_size, limit, offset, conn=conn)
+
+def iter_albums_by_media(media_type, batch_size=BATCH_SIZE, limit=None, offset=0, conn=None):
+    """Stream the albums that belong to a specific media type."""
+    if is_snapshot(conn):
+        return snapshot_rows(conn, conn.matching(media=media_type, owned=True), limit, offset)
+    return iter_rows(ALBUMS_BY_MEDIA_SQL, (media_type,), batch_size, limit, offset, conn=conn)
+
+def iter_albums_by_artist(artist_name, batch_size=BATCH_SIZE, limit=None, offset=0, conn=None):
+    """Stream the albums that belong to a specific artist."""
+    if is_snapshot(conn):
+        return snapshot_rows(conn, conn.matching(artist=artist_name, owned=True), limit, offset)
+    return iter_rows(ALBUMS_BY_ARTIST_SQL, (artist_name,), batch_size, limit, offset, conn=conn)
+
+def iter_albums_between_years(start_year, end_year, batch_size=BATCH_SIZE, limit=None, offset=0, conn=None):
+    """Stream the formatted albums released between the start and end years."""
+    if is_snapshot(conn):
+        return snapshot_rows(conn, conn.matching(start_year, end_year, owned=True), limit, offset)
+    return iter_rows(ALBUMS_BETWEEN_YEARS_SQL, (start_year, end_year), batch_size, limit, offset, conn=conn)
+
+def iter_albums_by_genre(genre_name, batch_size=BATCH_SIZE, limit=None, offset=0, conn=None):
+    """Stream the albums that belong to a specific genre."""
+    if is_snapshot(conn):
+        return snapshot_rows(conn, conn.matching(genre=genre_name, owned=True), limit, offset)
+    return iter_rows(ALBUMS_BY_GENRE_SQL, (genre_name,), batch_size, limit, offset, conn=conn)
+
+def print_pages(rows, page_size=PAGE_SIZE):
+    """Print rows a page at a time, asking before each further page, so the first results show up right away."""
+    for number, page in enumerate(chunked(rows, page_size)):
+        if number and input("Press Enter to see more, or 'q' to stop.\n").strip().lower() == 'q':
+            break
+        for line in page:
+            print(f"{line}\n")
+
+
+
 """ // BASIC QUERYING FUNCTIONS // """
 
-def query_artists():
+def query_artists(conn=None):
     """Query all artists."""
-    cursor.execute("SELECT * FROM Artists")
-    rows = cursor.fetchall()
-    for row in rows:
+    conn = connection(conn)
+    for row in iter_rows("SELECT * FROM Artists", conn=conn):
         print(row)
 
-def query_albums():
+def query_albums(conn=None):
     """Query all albums."""
-    cursor.execute("SELECT * FROM Albums")
-    rows = cursor.fetchall()
-    for row in rows:
+    conn = connection(conn)
+    for row in iter_rows("SELECT * FROM Albums", conn=conn):
         print(row)
 
-def query_formats():
+def query_formats(conn=None):
     """Query all formats."""
-    cursor.execute("SELECT * FROM Formats")
-    rows = cursor.fetchall()
-    for row in rows:
+    for row in get_formats(conn=conn):
         print(row)
 
-def query_genres():
+def query_genres(conn=None):
     """Query all genres."""
-    cursor.execute("SELECT * FROM Genres")
-    rows = cursor.fetchall()
-    for row in rows:
+    for row in get_genres(conn=conn): # the genre list is small and asked for a lot, so it comes from the result cache
         print(row)
 
-def query_formatted_albums():
+def query_formatted_albums(conn=None):
     """Query all formatted albums."""
-    cursor.execute("""
-    SELECT Albums.title, Artists.name, Albums.year, Formats.format_name
-    FROM FormattedAlbums
-    JOIN Albums ON FormattedAlbums.album_id = Albums.id
-    JOIN Artists ON Albums.artist_id = Artists.id
-    JOIN Formats ON FormattedAlbums.format_id = Formats.id
-    """)
-    rows = cursor.fetchall()
-    for row in rows:
+    for row in iter_formatted_albums(conn=conn):
         print(row)
 
 
 
 """ // 'GET' FUNCTIONS  (^ BUT RETURN INSTEAD OF PRINT) // """
 
-def get_artists():
+@cached_result
+def get_artists(conn=None):
     """Query all artists."""
-    cursor.execute("SELECT * FROM Artists")
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return conn.name_rows('artist')
+    cursor = conn.execute("SELECT * FROM Artists")
     rows = cursor.fetchall()
     return rows
 
-def get_albums():
+@cached_result
+def get_albums(conn=None):
     """Query all albums."""
-    cursor.execute("SELECT * FROM Albums")
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return conn.albums()
+    cursor = conn.execute("SELECT * FROM Albums")
     rows = cursor.fetchall()
     return rows
 
-def get_formats():
+@cached_result
+def get_formats(conn=None):
     """Query all formats."""
-    cursor.execute("SELECT * FROM Formats")
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return conn.name_rows('format')
+    cursor = conn.execute("SELECT * FROM Formats")
     rows = cursor.fetchall()
     return rows
 
-def get_formatted_albums():
+@cached_result
+def get_genres(conn=None):
+    """Query the genres of the albums I own."""
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return conn.name_rows('genre')
+    cursor = conn.execute("""
+        SELECT Genres.id, Genres.genre_name FROM Genres
+        WHERE Genres.id IN (SELECT genre_id FROM GenreStats WHERE album_count > 0)
+        ORDER BY Genres.id""")
+    rows = cursor.fetchall()
+    return rows
+
+@cached_result
+def get_formatted_albums(conn=None):
     """Query all formatted albums."""
-    cursor.execute("""
-    SELECT Albums.title, Artists.name, Albums.year, Formats.format_name
-    FROM FormattedAlbums
-    JOIN Albums ON FormattedAlbums.album_id = Albums.id
-    JOIN Artists ON Albums.artist_id = Artists.id
-    JOIN Formats ON FormattedAlbums.format_id = Formats.id
-    """)
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return list(iter_formatted_albums(conn=conn))
+    cursor = conn.execute(FORMATTED_ALBUMS_SQL)
     rows = cursor.fetchall()
     return rows
 
-def get_albums_by_media(media_type):
+@cached_result
+def get_albums_by_media(media_type, conn=None):
     """Retrieve albums that belong to a specific media type."""
-    cursor.execute("""
-        SELECT Albums.title, Artists.name, Albums.year, Formats.format_name
-        FROM Albums
-        JOIN Artists ON Albums.artist_id = Artists.id
-        JOIN FormattedAlbums ON Albums.id = FormattedAlbums.album_id
-        JOIN Formats ON FormattedAlbums.format_id = Formats.id
-        WHERE Formats.format_name = ?
-    """, (media_type,))
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return list(iter_albums_by_media(media_type, conn=conn))
+    cursor = conn.execute(ALBUMS_BY_MEDIA_SQL, (media_type,))
     albums = cursor.fetchall()
     return albums
 
-def get_albums_by_artist(artist_name):
+@cached_result
+def get_albums_by_artist(artist_name, conn=None):
     """Retrieve albums that belong to a specific artist."""
-    cursor.execute("""
-        SELECT Albums.title, Artists.name, Albums.year, Formats.format_name
-        FROM Albums
-        JOIN Artists ON Albums.artist_id = Artists.id
-        JOIN FormattedAlbums ON Albums.id = FormattedAlbums.album_id
-        JOIN Formats ON FormattedAlbums.format_id = Formats.id
-        WHERE Artists.name = ?
-    """, (artist_name,))
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return list(iter_albums_by_artist(artist_name, conn=conn))
+    cursor = conn.execute(ALBUMS_BY_ARTIST_SQL, (artist_name,))
     albums = cursor.fetchall()
     return albums
 
@@ -247,26 +690,27 @@ def get_albums_by_artist(artist_name):
 
 """ // DELETE FORMATTED ALBUM FUNCTION // """
 
-def delete_formatted_album(album_name, format_name):
+def delete_formatted_album(album_name, format_name, conn=None):
     """Delete a formatted album from FormattedAlbums."""
-    album_id = find_album_id(album_name)
-    format_id = find_format_id(format_name)
-    cursor.execute("""DELETE FROM FormattedAlbums WHERE album_id = ? AND format_id = ?""", (album_id, format_id))
+    conn = connection(conn)
+    album_id = find_album_id(album_name, conn=conn)
+    format_id = find_format_id(format_name, conn=conn)
+    conn.execute("""DELETE FROM FormattedAlbums WHERE album_id = ? AND format_id = ?""", (album_id, format_id))
+    bump_generation(conn)
+    conn.commit()
+    forget_id('Albums', album_name, conn) # its last format may have gone
 
 
 
 """ // QUERYING BASED ON TIME PERIOD //"""
 
-def formatted_album_between_years(start_year, end_year):
+@cached_result
+def formatted_album_between_years(start_year, end_year, conn=None):
     """Query formatted albums which were released between the specified start and end years."""
-    cursor.execute(
-        """SELECT Albums.title, Artists.name, Albums.year, Formats.format_name
-            FROM FormattedAlbums
-            JOIN Albums ON FormattedAlbums.album_id = Albums.id
-            JOIN Artists ON Albums.artist_id = Artists.id
-            JOIN Formats ON FormattedAlbums.format_id = Formats.id
-            WHERE Albums.year BETWEEN ? AND ?""",
-            (start_year, end_year) )
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return list(iter_albums_between_years(start_year, end_year, conn=conn))
+    cursor = conn.execute(ALBUMS_BETWEEN_YEARS_SQL, (start_year, end_year))
     between_albums = cursor.fetchall()
     return between_albums
 
@@ -274,197 +718,719 @@ def formatted_album_between_years(start_year, end_year):
 
 """ // ARTIST POPULARITY FUNCTIONS // """
 
-def descending_count_albums_by_artist():
+@cached_result
+def descending_count_albums_by_artist(conn=None):
     """This function returns the number of albums I have in my posession by each artist, then sorts by popularity in descending order."""
-    cursor.execute("""
-        SELECT Artists.name, COUNT(Albums.id) as album_count
-        FROM Albums
-        JOIN Artists on Albums.artist_id = Artists.id
-        GROUP BY Artists.name
-        ORDER BY album_count DESC
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return conn.album_counts('artist')
+    cursor = conn.execute("""
+        SELECT Artists.name, ArtistStats.album_count
+        FROM ArtistStats
+        JOIN Artists on ArtistStats.artist_id = Artists.id
+        WHERE ArtistStats.album_count > 0
+        ORDER BY ArtistStats.album_count DESC
         """)
     descending_count_query = cursor.fetchall()
     return descending_count_query
 
-def artist_album_count(artist_name):
+@cached_result
+def artist_album_count(artist_name, conn=None):
     """How many albums do I posess from this specific artist?"""
-    cursor.execute("""
-        SELECT COUNT(Albums.id)
-        FROM Albums
-        JOIN Artists on Albums.artist_id = Artists.id
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return conn.artist_album_count(artist_name)
+    cursor = conn.execute("""
+        SELECT ArtistStats.album_count
+        FROM ArtistStats
+        JOIN Artists on ArtistStats.artist_id = Artists.id
         WHERE Artists.name = ?""", (artist_name,))
-    count = cursor.fetchone()[0]
-    return count
+    count = cursor.fetchone()
+    return count[0] if count else 0
+
+@cached_result
+def genre_album_counts(conn=None):
+    """How many of my albums are in each genre, most popular first."""
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return conn.album_counts('genre')
+    cursor = conn.execute("""
+        SELECT Genres.genre_name, GenreStats.album_count
+        FROM GenreStats
+        JOIN Genres on GenreStats.genre_id = Genres.id
+        WHERE GenreStats.album_count > 0
+        ORDER BY GenreStats.album_count DESC""")
+    return cursor.fetchall()
+
+@cached_result
+def format_album_counts(conn=None):
+    """How many albums I have on each format."""
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return conn.album_counts('format')
+    cursor = conn.execute("""
+        SELECT Formats.format_name, FormatStats.album_count
+        FROM FormatStats
+        JOIN Formats on FormatStats.format_id = Formats.id
+        WHERE FormatStats.album_count > 0
+        ORDER BY FormatStats.album_count DESC""")
+    return cursor.fetchall()
+
+@cached_result
+def decade_format_counts(conn=None):
+    """(decade, format, count) rows, ie (1970, 'vinyl', 21); the whole 'Media Type by Decade' breakdown in one lookup."""
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return conn.decade_format_counts()
+    cursor = conn.execute("""
+        SELECT DecadeFormatStats.decade, Formats.format_name, DecadeFormatStats.album_count
+        FROM DecadeFormatStats
+        JOIN Formats on DecadeFormatStats.format_id = Formats.id
+        WHERE DecadeFormatStats.album_count > 0
+        ORDER BY DecadeFormatStats.decade, Formats.format_name""")
+    return cursor.fetchall()
+
+def rebuild_stats(conn=None):
+    """Recompute all of the summary tables from scratch, ie after editing the database outside of these functions."""
+    conn = connection(conn)
+    conn.executescript("BEGIN; " + STATS_REBUILD_SQL + " UPDATE Generation SET generation = generation + 1; COMMIT;")
 
 
 
 """ // SOME GENRE-RELATED FUNCTIONS // """
-import random as rand
 
-def associate_album_with_genres(album_title, genre_names):
+def associate_album_with_genres(album_title, genre_names, conn=None):
     """Associate an album with one or more genres."""
-    album_id = find_album_id(album_title)
+    conn = connection(conn)
+    album_id = find_album_id(album_title, conn=conn)
     for genre_name in genre_names:
-        genre_id = find_genre_id(genre_name)
+        genre_id = find_genre_id(genre_name, conn=conn)
         if genre_id is None:
-            genre_id = insert_genre(genre_name)
+            genre_id = insert_genre(genre_name, conn=conn)
         try:
-            cursor.execute("""INSERT INTO AlbumGenres (album_id, genre_id) VALUES (?, ?)""", (album_id, genre_id))
+            conn.execute("""INSERT INTO AlbumGenres (album_id, genre_id) VALUES (?, ?)""", (album_id, genre_id))
         except sqlite3.IntegrityError:
             # Handle the case where the association already exists
             print(f"Album '{album_title}' is already associated with genre '{genre_name}'.")
+    bump_generation(conn)
     conn.commit()
+    refresh_search_index(conn=conn)
 
-def get_albums_by_genre(genre_name):
+@cached_result
+def get_albums_by_genre(genre_name, conn=None):
     """Retrieve albums that belong to a specific genre."""
-    cursor.execute("""
-        SELECT Albums.title, Artists.name, Albums.year, Formats.format_name
-        FROM Albums
-        JOIN Artists ON Albums.artist_id = Artists.id
-        JOIN AlbumGenres ON Albums.id = AlbumGenres.album_id
-        JOIN FormattedAlbums ON Albums.id = FormattedAlbums.album_id
-        JOIN Formats ON FormattedAlbums.format_id = Formats.id
-        JOIN Genres ON AlbumGenres.genre_id = Genres.id
-        WHERE Genres.genre_name = ?
-    """, (genre_name,))
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return list(iter_albums_by_genre(genre_name, conn=conn))
+    cursor = conn.execute(ALBUMS_BY_GENRE_SQL, (genre_name,))
     albums = cursor.fetchall()
     return albums
 
-def get_genres_for_album(album_title):
+@cached_result
+def get_genres_for_album(album_title, conn=None):
     """Retrieve genres associated with a specific album."""
-    cursor.execute("""
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return conn.genres_for_album(album_title)
+    cursor = conn.execute(f"""
         SELECT Genres.genre_name
         FROM Albums
         JOIN AlbumGenres ON Albums.id = AlbumGenres.album_id
         JOIN Genres ON AlbumGenres.genre_id = Genres.id
-        WHERE Albums.title = ?
+        WHERE Albums.id = ({ALBUM_BY_TITLE_SQL})
     """, (album_title,))
     genres = cursor.fetchall()
     return [genre[0] for genre in genres]
 
-def remove_genre_from_album(album_title, genre_name):
+def remove_genre_from_album(album_title, genre_name, conn=None):
     """Remove a genre association from a specific album."""
-    album_id = find_album_id(album_title)
-    genre_id = find_genre_id(genre_name)
-    cursor.execute("""
+    conn = connection(conn)
+    album_id = find_album_id(album_title, conn=conn)
+    genre_id = find_genre_id(genre_name, conn=conn)
+    conn.execute("""
         DELETE FROM AlbumGenres
         WHERE album_id = ? AND genre_id = ?
     """, (album_id, genre_id))
+    bump_generation(conn)
     conn.commit()
+    refresh_search_index(conn=conn)
+
+
+
+""" // ALBUM VIEW FUNCTIONS (ONE ROW PER ALBUM) // """
+
+UNIT_SEPARATOR = chr(31) # joins strings that may contain commas
+
+# (title, artist, year, formats, genres) for each album, its formats and genres collapsed into lists by group_concat,
+# so listing n albums is one query rather than one get_genres_for_album call per album.
+ALBUM_VIEW_SQL = """
+    SELECT Albums.title, Artists.name, Albums.year,
+           (SELECT group_concat(Formats.format_name, char(31)) FROM FormattedAlbums
+            JOIN Formats ON FormattedAlbums.format_id = Formats.id
+            WHERE FormattedAlbums.album_id = Albums.id),
+           (SELECT group_concat(Genres.genre_name, char(31)) FROM AlbumGenres
+            JOIN Genres ON AlbumGenres.genre_id = Genres.id
+            WHERE AlbumGenres.album_id = Albums.id)
+    FROM Albums
+    JOIN Artists ON Albums.artist_id = Artists.id
+    """
+
+def album_view_filters(genres=(), match='any', media=None, artist=None, start_year=None, end_year=None, owned=True):
+    """Build the WHERE part (and its parameters) of an album view query, each filter a subquery on Albums.id."""
+    if match not in ('any', 'all'):
+        raise ValueError(f"match must be 'any' or 'all', not {match!r}")
+    conditions, params = [], []
+    genres = list(dict.fromkeys([genres] if isinstance(genres, str) else genres))
+    if genres:
+        placeholders = ', '.join('?' * len(genres))
+        having = f"GROUP BY AlbumGenres.album_id HAVING COUNT(*) = {len(genres)}" if match == 'all' and len(genres) > 1 else ""
+        conditions.append(f"""Albums.id IN (
+            SELECT AlbumGenres.album_id FROM AlbumGenres
+            JOIN Genres ON AlbumGenres.genre_id = Genres.id
+            WHERE Genres.genre_name IN ({placeholders}) {having})""")
+        params.extend(genres)
+    if media is not None:
+        conditions.append("""Albums.id IN (
+            SELECT FormattedAlbums.album_id FROM FormattedAlbums
+            JOIN Formats ON FormattedAlbums.format_id = Formats.id
+            WHERE Formats.format_name = ?)""")
+        params.append(media)
+    elif owned:
+        conditions.append("""Albums.id IN (SELECT album_id FROM FormattedAlbums)""")
+    if artist is not None:
+        conditions.append("""Artists.name = ?""")
+        params.append(artist)
+    if start_year is not None:
+        conditions.append("""Albums.year >= ?""")
+        params.append(start_year)
+    if end_year is not None:
+        conditions.append("""Albums.year <= ?""")
+        params.append(end_year)
+    return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+def album_view_row(row):
+    """Split the group_concat'ed formats and genres of an ALBUM_VIEW_SQL row into lists."""
+    title, artist, year, formats, genres = row
+    return (title, artist, year, formats.split(UNIT_SEPARATOR) if formats else [],
+            genres.split(UNIT_SEPARATOR) if genres else [])
+
+def iter_album_view(genres=(), match='any', media=None, artist=None, start_year=None, end_year=None, owned=True,
+                    batch_size=BATCH_SIZE, limit=None, offset=0, conn=None):
+    """Stream (title, artist, year, [formats], [genres]) once per album, for albums with any/all of `genres`."""
+    conn = connection(conn)
+    if is_snapshot(conn):
+        albums = conn.album_view(genres, match, media, artist, start_year, end_year, owned)
+        yield from itertools.islice(albums, offset, None if limit is None else offset + limit)
+        return
+    where, params = album_view_filters(genres, match, media, artist, start_year, end_year, owned)
+    sql = ALBUM_VIEW_SQL + where + " ORDER BY Albums.id"
+    if limit is not None or offset:
+        sql += " LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else limit, offset]
+    cursor = conn.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for row in rows:
+            yield album_view_row(row)
+
+@cached_result
+def get_album_view(genres=(), match='any', media=None, artist=None, start_year=None, end_year=None, owned=True,
+                   limit=None, offset=0, conn=None):
+    """Like iter_album_view, but returns the list (its formats and genres as tuples, shared with the result cache)."""
+    albums = iter_album_view(genres, match, media, artist, start_year, end_year, owned, limit=limit, offset=offset, conn=conn)
+    return [row[:3] + (tuple(row[3]), tuple(row[4])) for row in albums]
+
+def get_genres_for_albums(album_titles, conn=None):
+    """{title: [genres]} for many albums at once, a chunk of titles per query."""
+    conn = connection(conn)
+    genres = {}
+    for chunk in chunked(dict.fromkeys(album_titles), SQL_CHUNK_SIZE):
+        placeholders = ', '.join('?' * len(chunk))
+        cursor = conn.execute(f"""
+            SELECT Albums.title,
+                   (SELECT group_concat(Genres.genre_name, char(31)) FROM AlbumGenres
+                    JOIN Genres ON AlbumGenres.genre_id = Genres.id
+                    WHERE AlbumGenres.album_id = Albums.id)
+            FROM Albums
+            WHERE Albums.title IN ({placeholders})
+            ORDER BY EXISTS (SELECT 1 FROM FormattedAlbums WHERE album_id = Albums.id), Albums.id""", chunk)
+        # a title shared by several albums ends up with the genres of the one ALBUM_BY_TITLE_SQL picks (the last row)
+        genres.update((title, names.split(UNIT_SEPARATOR) if names else []) for title, names in cursor.fetchall())
+    return genres
+
+
+
+""" // BULK LOADING FUNCTIONS // """
+
+SQL_CHUNK_SIZE = 500 # keeps every IN (...) list well below SQLite's bound-parameter limit
+
+def chunked(items, size):
+    """Yield lists of at most `size` items from any iterable, without materializing the whole thing."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def fetch_ids(table, column, names, conn=None):
+    """Map each name to its id in a dimension table (Artists, Genres, Formats), through the id cache first."""
+    conn = connection(conn)
+    cached = check_ids(conn)
+    ids = {}
+    unknown = []
+    for name in names:
+        found = cached_id(table, name, conn) if cached else None
+        if found is None:
+            unknown.append(name)
+        else:
+            ids[name] = found
+    for chunk in chunked(unknown, SQL_CHUNK_SIZE):
+        placeholders = ', '.join('?' * len(chunk))
+        cursor = conn.execute(f"""SELECT {column}, id FROM {table} WHERE {column} IN ({placeholders})""", chunk)
+        for name, found in cursor.fetchall():
+            ids[name] = remember_id(table, name, found, conn)
+    return ids
+
+def resolve_ids(table, column, names, conn=None):
+    """Like fetch_ids, but any names that are not in the table yet get inserted first."""
+    conn = connection(conn)
+    names = set(names)
+    ids = fetch_ids(table, column, names, conn=conn)
+    missing = [name for name in names if name not in ids]
+    if missing:
+        conn.executemany(f"""INSERT OR IGNORE INTO {table} ({column}) VALUES (?)""", [(name,) for name in missing])
+        ids.update(fetch_ids(table, column, missing, conn=conn))
+    return ids
+
+def fetch_album_rows(titles, conn=None):
+    """Map each (title, artist_id) of albums with these titles to the album id, a chunk of titles per query."""
+    conn = connection(conn)
+    rows = {}
+    for chunk in chunked(titles, SQL_CHUNK_SIZE):
+        placeholders = ', '.join('?' * len(chunk))
+        cursor = conn.execute(f"""SELECT title, artist_id, id FROM Albums WHERE title IN ({placeholders})""", chunk)
+        rows.update(((title, artist_id), album_id) for title, artist_id, album_id in cursor.fetchall())
+    return rows
+
+def bulk_insert_albums(records, format_name=None, conn=None):
+    """Insert many [title, artist, year, [genres...]] records in one transaction; returns each record's album id (None if it wasn't written)."""
+    conn = connection(conn)
+    with transaction(conn): # a single commit for the whole batch
+        album_ids = write_albums(records, format_name, conn=conn)
+    refresh_search_index(conn=conn)
+    return album_ids
+
+def write_albums(records, format_name=None, conn=None):
+    """The body of bulk_insert_albums, for callers that manage the transaction themselves."""
+    conn = connection(conn)
+    records = list(records)
+    artist_ids = resolve_ids('Artists', 'name', (record[1] for record in records), conn=conn)
+    genre_ids = resolve_ids('Genres', 'genre_name', (genre for record in records for genre in record[3]), conn=conn)
+
+    album_rows = fetch_album_rows({record[0] for record in records}, conn=conn)
+    new_albums = {}
+    for title, artist_name, year, genres in records:
+        key = (title, artist_ids[artist_name])
+        if key not in album_rows and key not in new_albums:
+            new_albums[key] = key + (year,)
+    if new_albums:
+        conn.executemany("""INSERT OR IGNORE INTO Albums (title, artist_id, year) VALUES (?, ?, ?)""", new_albums.values())
+        album_rows.update(fetch_album_rows({title for title, artist_id in new_albums}, conn=conn))
+
+    album_ids = [album_rows.get((record[0], artist_ids[record[1]])) for record in records]
+    kept = [(album_id, record) for album_id, record in zip(album_ids, records) if album_id is not None]
+    if format_name is not None: # otherwise the albums are only catalogued
+        format_id = resolve_ids('Formats', 'format_name', [format_name], conn=conn)[format_name]
+        conn.executemany("""INSERT OR IGNORE INTO FormattedAlbums (album_id, format_id) VALUES (?, ?)""",
+                         [(album_id, format_id) for album_id, record in kept])
+        for album_id, record in kept: # a title I now own may have meant a catalog album until now
+            forget_id('Albums', record[0], conn)
+    conn.executemany("""INSERT OR IGNORE INTO AlbumGenres (album_id, genre_id) VALUES (?, ?)""",
+                     [(album_id, genre_ids[genre]) for album_id, record in kept for genre in record[3]])
+    bump_generation(conn)
+    return album_ids
+
+
+
+""" // INCREMENTAL SYNC FUNCTIONS // """
+
+def fingerprint(value):
+    """A content hash of any JSON-able value, ie a whole media list or one [title, artist, year, [genres...]] record."""
+    import hashlib # only needed once something is synced
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def sync_music(media_list, media_type, quiet=False, conn=None):
+    """Bring the database in line with a media list (ie my_music.cds), applying only what changed since the last sync."""
+    conn = connection(conn)
+    start = time.perf_counter()
+    stats = {'source': media_type, 'added': 0, 'changed': 0, 'removed': 0, 'failed': []}
+    list_fingerprint = fingerprint(media_list)
+    cursor = conn.execute("""SELECT fingerprint FROM SyncSources WHERE source = ?""", (media_type,))
+    synced = cursor.fetchone()
+    if synced and synced[0] == list_fingerprint:
+        refresh_search_index(conn=conn) # albums other writers left queued
+        stats['seconds'] = time.perf_counter() - start
+        return stats
+
+    cursor = conn.execute("""SELECT record_key, fingerprint, record FROM SyncRecords WHERE source = ?""", (media_type,))
+    stored = {title: (row_fingerprint, record) for title, row_fingerprint, record in cursor.fetchall()}
+    current = {record[0]: (fingerprint(record), record) for record in media_list} # one record per title in a media list
+    added = [record for title, (row_fingerprint, record) in current.items() if title not in stored]
+    changed = [(json.loads(stored[title][1]), record) for title, (row_fingerprint, record) in current.items()
+               if title in stored and stored[title][0] != row_fingerprint]
+    removed = [title for title in stored if title not in current]
+
+    with transaction(conn):
+        if added:
+            album_ids = write_albums(added, media_type, conn=conn)
+            stats['failed'] = [record[0] for album_id, record in zip(album_ids, added) if album_id is None]
+            added = [record for album_id, record in zip(album_ids, added) if album_id is not None]
+        for old, new in changed:
+            update_synced_album(old, new, media_type, conn=conn)
+        for chunk in chunked(removed, SQL_CHUNK_SIZE):
+            placeholders = ', '.join('?' * len(chunk))
+            conn.execute(f"""
+                DELETE FROM FormattedAlbums
+                WHERE format_id = (SELECT id FROM Formats WHERE format_name = ?)
+                AND album_id IN (SELECT id FROM Albums WHERE title IN ({placeholders}))""", [media_type] + chunk)
+            conn.execute(f"""DELETE FROM SyncRecords WHERE source = ? AND record_key IN ({placeholders})""", [media_type] + chunk)
+            for title in chunk:
+                forget_id('Albums', title, conn)
+        if removed:
+            bump_generation(conn)
+        conn.executemany("""INSERT OR REPLACE INTO SyncRecords (source, record_key, fingerprint, record) VALUES (?, ?, ?, ?)""",
+                         [(media_type, record[0], current[record[0]][0], json.dumps(record))
+                          for record in added + [new for old, new in changed]])
+        if stats['failed']: # no fingerprint for the list, so the next sync tries these records again
+            conn.execute("""DELETE FROM SyncSources WHERE source = ?""", (media_type,))
+        else:
+            conn.execute("""INSERT OR REPLACE INTO SyncSources (source, fingerprint, synced_at) VALUES (?, ?, datetime('now'))""",
+                         (media_type, list_fingerprint))
+    refresh_search_index(conn=conn)
+    stats.update(added=len(added), changed=len(changed), removed=len(removed), seconds=time.perf_counter() - start)
+    if (added or changed or removed or stats['failed']) and not quiet:
+        print(sync_summary(stats))
+    return stats
+
+def sync_summary(stats):
+    """The line sync_music prints for its stats, ie 'Synced CD: 2 added, 0 changed, 1 removed.'"""
+    summary = f"Synced {stats['source']}: {stats['added']} added, {stats['changed']} changed, {stats['removed']} removed."
+    if stats.get('failed'):
+        summary += f" Couldn't write {len(stats['failed'])}: {', '.join(stats['failed'])}."
+    return summary
+
+def update_synced_album(old, new, format_name, conn=None):
+    """Apply an edited [title, artist, year, [genres...]] record: new artist/year, genres added and dropped."""
+    conn = connection(conn)
+    title, artist_name, year, genres = new
+    album_id = find_album_id(title, conn=conn)
+    if album_id is None: # deleted outside of sync; just put it back
+        write_albums([new], format_name, conn=conn)
+        return
+    if (old[1], old[2]) != (artist_name, year):
+        artist_id = resolve_ids('Artists', 'name', [artist_name], conn=conn)[artist_name]
+        cursor = conn.execute("""UPDATE OR IGNORE Albums SET artist_id = ?, year = ? WHERE id = ?""", (artist_id, year, album_id))
+        if cursor.rowcount == 0: # another album (ie a catalog one) already has this title and artist; the format moves to it
+            conn.execute("""DELETE FROM FormattedAlbums WHERE album_id = ? AND format_id = (SELECT id FROM Formats WHERE format_name = ?)""",
+                         (album_id, format_name))
+            forget_id('Albums', title, conn)
+            write_albums([new], format_name, conn=conn)
+            return
+    dropped = [genre for genre in old[3] if genre not in genres]
+    if dropped:
+        genre_ids = fetch_ids('Genres', 'genre_name', dropped, conn=conn)
+        conn.executemany("""DELETE FROM AlbumGenres WHERE album_id = ? AND genre_id = ?""",
+                         [(album_id, genre_id) for genre_id in genre_ids.values()])
+    genre_ids = resolve_ids('Genres', 'genre_name', genres, conn=conn)
+    conn.executemany("""INSERT OR IGNORE INTO AlbumGenres (album_id, genre_id) VALUES (?, ?)""",
+                     [(album_id, genre_ids[genre]) for genre in genres])
+    format_id = resolve_ids('Formats', 'format_name', [format_name], conn=conn)[format_name]
+    conn.execute("""INSERT OR IGNORE INTO FormattedAlbums (album_id, format_id) VALUES (?, ?)""", (album_id, format_id))
+    bump_generation(conn)
+
+
+
+""" // RANDOM SAMPLING FUNCTIONS // """
+
+FRESH_DAYS = 30 # after this many days an album counts as fully rested for the 'fresh' weight
+
+# SQL expressions for weighted sampling; the bigger an album's weight, the likelier it is to be picked.
+SAMPLE_WEIGHTS = {
+    # RYM average rating (0-5) when the album is in a catalog, otherwise a middling 3
+    'rating': """COALESCE((SELECT MAX(CatalogAlbums.average_rating) FROM CatalogAlbums
+                           WHERE CatalogAlbums.album_id = Albums.id), 3.0)""",
+    # under-played albums first: (1 + days since last suggested or played, up to 30) / (1 + suggestions + 2 * plays),
+    # read from AlbumPlayStats (see history.py), so never suggested albums weigh 31
+    'fresh': f"""COALESCE((SELECT (1.0 + MIN((strftime('%s', 'now') - MAX(COALESCE(AlbumPlayStats.last_suggested, 0),
+                                                                        COALESCE(AlbumPlayStats.last_played, 0))) / 86400.0,
+                                         {FRESH_DAYS}.0))
+                                / (1.0 + AlbumPlayStats.suggested + 2 * AlbumPlayStats.played)
+                          FROM AlbumPlayStats WHERE AlbumPlayStats.album_id = Albums.id), {FRESH_DAYS + 1}.0)""",
+}
+SAMPLE_PROBES = 200 # unweighted draws probe this many random FormattedAlbums rowids at a time, when that should be enough
+
+def sample_filters(start_year=None, end_year=None, genre=None, media=None):
+    """Build the FROM/WHERE part (and its parameters) shared by count_albums and sample_albums."""
+    sql = """
+        FROM FormattedAlbums
+        JOIN Albums ON FormattedAlbums.album_id = Albums.id
+        JOIN Formats ON FormattedAlbums.format_id = Formats.id"""
+    conditions = []
+    params = []
+    if start_year is not None:
+        conditions.append("Albums.year >= ?")
+        params.append(start_year)
+    if end_year is not None:
+        conditions.append("Albums.year <= ?")
+        params.append(end_year)
+    if media is not None:
+        conditions.append("Formats.format_name = ?")
+        params.append(media)
+    if genre is not None:
+        conditions.append("""Albums.id IN (SELECT AlbumGenres.album_id FROM AlbumGenres
+                                           WHERE AlbumGenres.genre_id = (SELECT id FROM Genres WHERE genre_name = ?))""")
+        params.append(genre)
+    if conditions:
+        sql += "\n        WHERE " + " AND ".join(conditions)
+    return sql, params
+
+def count_albums(start_year=None, end_year=None, genre=None, media=None, conn=None):
+    """How many formatted albums match the filters, counted inside SQLite (or the snapshot)."""
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return conn.count_albums(start_year, end_year, genre, media, owned=True)
+    sql, params = sample_filters(start_year, end_year, genre, media)
+    cursor = conn.execute("SELECT COUNT(*) " + sql, params)
+    return cursor.fetchone()[0]
+
+def sample_albums(quantity, start_year=None, end_year=None, genre=None, media=None, weight=None, rng=None, conn=None):
+    """Draw up to `quantity` distinct random (title, artist, year, format) rows matching the filters, in one read transaction."""
+    conn = connection(conn)
+    if is_snapshot(conn):
+        return conn.sample_albums(quantity, start_year, end_year, genre, media, weight=weight, rng=rng, owned=True)
+    if weight is not None and weight not in SAMPLE_WEIGHTS:
+        raise ValueError(f"unknown weight {weight!r}; use None or one of {sorted(SAMPLE_WEIGHTS)}")
+    if not isinstance(rng, rand.Random):
+        rng = rand.Random(rng)
+    if quantity <= 0:
+        return []
+    sql, params = sample_filters(start_year, end_year, genre, media)
+    row_sql = """SELECT Albums.title, Artists.name, Albums.year, Formats.format_name
+        FROM FormattedAlbums
+        JOIN Albums ON FormattedAlbums.album_id = Albums.id
+        JOIN Artists ON Albums.artist_id = Artists.id
+        JOIN Formats ON FormattedAlbums.format_id = Formats.id"""
+
+    with read_transaction(conn):
+        if weight is None:
+            picks = draw_rows(quantity, sql, params, rng, conn)
+        else:
+            picks = draw_weighted_rows(quantity, sql, params, SAMPLE_WEIGHTS[weight], rng, conn)
+        samples = []
+        for album_id, format_id in picks:
+            cursor = conn.execute(row_sql + " WHERE FormattedAlbums.album_id = ? AND FormattedAlbums.format_id = ?", (album_id, format_id))
+            row = cursor.fetchone()
+            if row is not None:
+                samples.append(row)
+    return samples
+
+def draw_rows(quantity, sql, params, rng, conn):
+    """Uniformly pick up to `quantity` (album_id, format_id) keys from the rows of a sample_filters query, in random order."""
+    available = conn.execute("SELECT COUNT(*) " + sql, params).fetchone()[0]
+    quantity = min(quantity, available)
+    if not quantity:
+        return []
+    low, high = conn.execute("SELECT MIN(rowid), MAX(rowid) FROM FormattedAlbums").fetchone()
+    probes = quantity * (high - low + 1) / available
+    if quantity <= available // 2 and probes <= SAMPLE_PROBES:
+        # CROSS JOIN: look each probe up by rowid rather than letting the filters pick the scan
+        probe_sql = "SELECT FormattedAlbums.rowid, FormattedAlbums.album_id, FormattedAlbums.format_id " + sql.replace(
+            "FROM FormattedAlbums", "FROM json_each(?) AS Probes CROSS JOIN FormattedAlbums ON FormattedAlbums.rowid = Probes.value", 1)
+        picks = {}
+        for attempt in range(4):
+            rowids = [rng.randint(low, high) for probe in range(SAMPLE_PROBES)]
+            found = {rowid: (album_id, format_id) for rowid, album_id, format_id in conn.execute(probe_sql, [json.dumps(rowids)] + params)}
+            for rowid in rowids:
+                if rowid in found:
+                    picks.setdefault(found[rowid], None)
+                    if len(picks) == quantity:
+                        return list(picks)
+    # too few rows match to find them by probing, so number the matching rows and pick row numbers instead
+    offsets = rng.sample(range(available), quantity)
+    cursor = conn.execute(f"""SELECT album_id, format_id, position FROM (
+                                  SELECT FormattedAlbums.album_id, FormattedAlbums.format_id,
+                                         row_number() OVER (ORDER BY FormattedAlbums.album_id, FormattedAlbums.format_id) - 1 AS position
+                                  {sql})
+                              WHERE position IN (SELECT value FROM json_each(?))""", params + [json.dumps(offsets)])
+    rows = {position: (album_id, format_id) for album_id, format_id, position in cursor}
+    return [rows[offset] for offset in offsets if offset in rows]
+
+def draw_weighted_rows(quantity, sql, params, weight_sql, rng, conn):
+    """Pick up to `quantity` (album_id, format_id) keys with probability proportional to weight_sql, heaviest key first."""
+    reservoir = []
+    cursor = conn.execute(f"""SELECT FormattedAlbums.album_id, FormattedAlbums.format_id, {weight_sql} {sql}
+                          ORDER BY FormattedAlbums.album_id, FormattedAlbums.format_id""", params)
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        for album_id, format_id, row_weight in rows:
+            if not row_weight or row_weight <= 0:
+                continue
+            key = rng.random() ** (1.0 / row_weight) # Efraimidis & Spirakis: keep the largest keys
+            if len(reservoir) < quantity:
+                heapq.heappush(reservoir, (key, album_id, format_id))
+            elif key > reservoir[0][0]:
+                heapq.heapreplace(reservoir, (key, album_id, format_id))
+    return [(album_id, format_id) for key, album_id, format_id in sorted(reservoir, reverse=True)]
 
 
 
 """ // FUNCTIONS FOR REFACTORING MAIN SCRIPT // """
 
-def add_music(media_list, media_type):
-    for media in media_list:
-        insert_album(media[0], media[1], media[2])
-        insert_formatted_album(media[0], media_type)
-        associate_album_with_genres(media[0], media[3])
+def add_music(media_list, media_type, conn=None):
+    """Load a whole list of media (ie, my_music.cds) with a single bulk insert."""
+    return bulk_insert_albums(media_list, media_type, conn=conn)
 
-def random_album_suggestion():
-    type = input("Would you like to select an album based on (1) time of release or (2) genre? (Choose '1' or '2')\n").strip()
+def random_album_suggestion(conn=None):
+    type = input("Would you like to select an album based on (1) time of release, (2) genre or (3) an album you like? (Choose '1', '2' or '3')\n").strip()
     if type == '1':
-        select_album_by_time()
+        select_album_by_time(conn=conn)
     elif type == '2':
-        select_album_by_genre()
+        select_album_by_genre(conn=conn)
+    elif type == '3':
+        select_similar_albums(conn=conn)
     else:
         print("Invalid selection. Please restart the program and choose a valid option.")
 
-def select_album_by_time():
+def select_album_by_time(conn=None):
     beginning = int(input("What is the oldest year you would like to listen to? (Enter a year, ie, '1960')\n"))
     ending = int(input("What is the most recent year you would like to listen to? (Enter a year >= your last selection)\n"))
-    possibilities = formatted_album_between_years(beginning, ending)
     media = input('What media type are you listening on?\n').strip()
-    new_possibilities = [i for i in possibilities if i[3] == media]
-    if new_possibilities:
-        quantity = int(input(f"How many suggestions would you like? ({len(new_possibilities)} maximum)\n"))
-        if quantity <= len(new_possibilities):
-            suggest_albums(new_possibilities, quantity)
-        else:
-            print(f"You don't have quite that many options to choose from...\n But here's what you have:\n")
-            suggest_albums(new_possibilities, len(new_possibilities))
-    else:
-        print(f"No albums found for the given criteria.")
+    suggest_sample(start_year=beginning, end_year=ending, media=media, weight=rotation_weight(conn), conn=conn)
 
-def select_album_by_genre():
+def select_album_by_genre(conn=None):
     print(f'Here are the possible genres to listen to:')
-    query_genres()
+    query_genres(conn=conn)
     genre = input("Which genre would you like to listen to? (Enter name of genre)\n").strip()
-    possibilities = get_albums_by_genre(genre)
     media = input('What media type are you listening on?\n').strip()
-    new_possibilities = [i for i in possibilities if i[3] == media]
-    if new_possibilities:
-        quantity = int(input(f"How many suggestions would you like? ({len(new_possibilities)} maximum) \n"))
-        if quantity <= len(new_possibilities):
-            suggest_albums(new_possibilities, quantity)
-        else:
-            print(f"You don't have quite that many options to choose from... \nBut here's what you have:\n")
-            suggest_albums(new_possibilities, len(new_possibilities))           
+    suggest_sample(genre=genre, media=media, weight=rotation_weight(conn), conn=conn)
+
+def rotation_weight(conn=None):
+    """The weight the menu's suggestions use: 'fresh' (least played first), except on a snapshot, which has no history."""
+    return None if is_snapshot(conn) else 'fresh'
+
+def select_similar_albums(conn=None):
+    if is_snapshot(conn):
+        print("Finding albums like one you like needs the database; this is a read-only snapshot.")
+        return
+    title = input("Which album do you like? (Enter its title)\n").strip()
+    new = input("Only albums you don't own yet? ('Yes' or 'No')\n").strip().lower() == 'yes'
+    from similarity import similar_albums # similarity imports functions (and numpy), so not at the top
+    albums = similar_albums(title, not_owned=new, conn=conn)
+    if albums:
+        print(f"Here are some albums like {title}...\n")
+        for album in albums:
+            print(f"{album}\n")
+        print(f"Enjoy!")
+    else:
+        print(f"No albums found like '{title}'.")
+
+def suggest_sample(start_year=None, end_year=None, genre=None, media=None, weight=None, conn=None):
+    """Ask how many suggestions are wanted, then draw them with sample_albums instead of fetching every candidate."""
+    available = count_albums(start_year, end_year, genre, media, conn=conn)
+    if available:
+        quantity = int(input(f"How many suggestions would you like? ({available} maximum)\n"))
+        if quantity > available:
+            print(f"You don't have quite that many options to choose from...\nBut here's what you have:\n")
+            quantity = available
+        if quantity < 1:
+            print("Invalid quantity. Please restart the program and choose a valid option.")
+            return
+        # already a random draw, and with weight='rating' maybe a short one (albums rated 0 are never drawn)
+        choices = sample_albums(quantity, start_year, end_year, genre, media, weight=weight, conn=conn)
+        if not choices:
+            print(f"No albums found for the given criteria.")
+        record_suggestions(print_suggestions(choices), conn=conn) # buffered, so this doesn't wait on a write
     else:
         print(f"No albums found for the given criteria.")
 
 def suggest_albums(possibilities, quantity):
+    """Print the suggestions; returns the ones that were suggested."""
     if quantity == 1:
-        choice = rand.choice(possibilities)
-        print(f"Here is our selection: {choice}. Happy listening!")
+        return print_suggestions([rand.choice(possibilities)])
     elif quantity > 1:
-        choices = rand.sample(possibilities, quantity)
+        return print_suggestions(rand.sample(possibilities, quantity))
+    else:
+        print("Invalid quantity. Please restart the program and choose a valid option.")
+        return []
+
+def print_suggestions(choices):
+    """Print suggestions that were already drawn; returns them."""
+    if len(choices) == 1:
+        print(f"Here is our selection: {choices[0]}. Happy listening!")
+    elif choices:
         print(f"Here are some options...\n")
         for choice in choices:
             print(f"{choice}\n")
         print(f"Enjoy!")
-    else:
-        print("Invalid quantity. Please restart the program and choose a valid option.")
+    return choices
 
-def search_albums():
+def search_albums(conn=None):
     way = input(f"How would you like to search for albums?\n(1) Time Period\n(2) Artist\n(3) Media Type\n(4) Genre\nChoose '1', '2', '3' or '4':\n").strip()
     if way == '1':
-        search_by_time_period()
+        search_by_time_period(conn=conn)
     elif way == '2':
-        search_by_artist()
+        search_by_artist(conn=conn)
     elif way == '3':
-        search_by_media_type()
+        search_by_media_type(conn=conn)
     elif way == '4':
-        search_by_genre()
+        search_by_genre(conn=conn)
     else:
         print("Invalid selection. Please restart the program and choose a valid option.")
 
-def search_by_time_period():
+def search_by_time_period(conn=None):
     beginning = int(input("What is the earliest year you would like to browse? (Enter a year, ie, '1960')\n"))
     ending = int(input("What is the most recent year you would like to browse? (Enter a year >= your last selection)\n"))
-    possibilities = formatted_album_between_years(beginning, ending)
     print(f"Here are your albums between the years {beginning} and {ending}:\n")
-    for line in possibilities:
-        print(f"{line}\n")
+    print_pages(iter_albums_between_years(beginning, ending, conn=conn))
 
-def search_by_artist():
+def search_by_artist(conn=None):
     artist = input('What artist would you like to search for?\n').strip()
-    number = artist_album_count(artist)
+    number = artist_album_count(artist, conn=conn)
+    if number == 0:
+        closest = fuzzy_find_artist(artist, conn=conn)
+        if closest and closest != artist and artist_album_count(closest, conn=conn):
+            if input(f"Did you mean '{closest}'? ('Yes' or 'No')\n").strip().lower() == 'yes':
+                artist = closest
+                number = artist_album_count(artist, conn=conn)
     print(f"You own {number} albums by {artist}. Here they are:\n")
-    possibilities = get_albums_by_artist(artist)
-    for line in possibilities:
-        print(f"{line}\n")
+    print_pages(iter_albums_by_artist(artist, conn=conn))
 
-def search_by_media_type():
+def search_by_media_type(conn=None):
     print(f"Here are your possible media types:")
-    print(f"{query_formats()}")
+    print(f"{query_formats(conn=conn)}")
     format = input("Which media type would you like to see? (Enter name of media type)\n").strip()
-    possibilities = get_albums_by_media(format)
     print(f"Here are all of your {format} albums:\n")
-    for line in possibilities:
-        print(f"{line}\n")
+    print_pages(iter_albums_by_media(format, conn=conn))
 
-def search_by_genre():
+def search_by_genre(conn=None):
     print(f'Here are the possible genres to listen to:')
-    query_genres()
-    genre = input("Which genre would you like to listen to? (Enter name of genre)\n").strip()
-    possibilities = get_albums_by_genre(genre)
-    print(f"Here are all of your {genre} albums:\n")
-    for line in possibilities:
-        print(f"{line}\n")
-
-def add_new_music():
+    query_genres(conn=conn)
+    answer = input("Which genre would you like to listen to? (Enter name of genre, or several separated by commas)\n")
+    genres = [genre.strip() for genre in answer.split(',') if genre.strip()]
+    match = 'any'
+    if len(genres) > 1:
+        match = 'all' if input("Albums with (1) all of these genres or (2) any of them? (Choose '1' or '2')\n").strip() == '1' else 'any'
+    print(f"Here are all of your {(' and ' if match == 'all' else ' or ').join(genres)} albums, with their formats and genres:\n")
+    print_pages(iter_album_view(genres, match, conn=conn))
+
+def add_new_music(conn=None):
     while True:
         album_name = input("What is the name of the album?\n").strip()
         artist_name = input("Who is the artist of that album?\n").strip()
@@ -476,7 +1442,7 @@ def add_new_music():
             else:
                 print("Please enter a valid year (e.g., 2020).")
         
-        insert_album(album_name, artist_name, year)
+        insert_album(album_name, artist_name, year, conn=conn)
         
         while True:
             format = input("What format is this album? (e.g., CD, vinyl, cassette)\n").strip()
@@ -485,11 +1451,11 @@ def add_new_music():
             else:
                 print("Please enter a valid format (CD, Vinyl, Cassette).")
         
-        insert_formatted_album(album_name, format)
+        insert_formatted_album(album_name, format, conn=conn)
         
         genres = input("Enter the genres for this album, separated by commas (e.g., Rock, Pop):\n").strip()
         genre_list = [genre.strip() for genre in genres.split(',')]
-        associate_album_with_genres(album_name, genre_list)
+        associate_album_with_genres(album_name, genre_list, conn=conn)
         
         cont = input("Added. Do you have another album to add? ('Yes' or 'No')\n").strip().lower()
         if cont == 'no':
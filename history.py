@@ -0,0 +1,140 @@
+"""Suggestion history functions used in Personal Music Collection project."""
+
+import sqlite3
+import atexit
+import threading
+import time
+
+from db import close_connections, connection, database_key, get_connection, is_snapshot, transaction
+
+
+""" // SUGGESTION HISTORY // """
+
+# Suggestions and listens are buffered and written HISTORY_BATCH at a time by a background thread, each batch appended
+# to SuggestionHistory and folded into AlbumPlayStats (which the 'fresh' weight reads) in one transaction.
+HISTORY_BATCH = 50 # events buffered per database before they are written
+
+class HistoryBuffer:
+    """Thread-safe buffer of (title, format, event, at) events per database, flushed in batches."""
+
+    def __init__(self, batch=HISTORY_BATCH):
+        self.batch = batch
+        self.pending = {} # database path -> events
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.written = 0
+
+    def add(self, database, events):
+        """Buffer events; once a database has a full batch, start writing them in the background."""
+        with self.lock:
+            self.pending.setdefault(database, []).extend(events)
+            if len(self.pending[database]) < self.batch or (self.flusher and self.flusher.is_alive()):
+                return
+            self.flusher = threading.Thread(target=self.flush_in_background, name='history', daemon=True)
+            self.flusher.start()
+
+    def take(self, database):
+        with self.lock:
+            return self.pending.pop(database, [])
+
+    def flush(self, database, conn=None):
+        """Write a database's buffered events now; if that fails they go back in the buffer for the next try."""
+        events = self.take(database)
+        if not events:
+            return 0
+        try:
+            write_history(events, conn or get_connection(database))
+        except sqlite3.Error:
+            with self.lock:
+                self.pending[database] = events + self.pending.get(database, [])
+            raise
+        with self.lock:
+            self.written += len(events)
+        return len(events)
+
+    def flush_in_background(self):
+        try:
+            for database in list(self.pending):
+                try:
+                    self.flush(database)
+                except sqlite3.Error:
+                    pass # kept in the buffer; the next batch (or exit) tries again
+        finally:
+            close_connections() # this thread's own connections
+
+    def close(self):
+        """Wait for a background write, then write everything that is left (run at exit)."""
+        if self.flusher:
+            self.flusher.join()
+        for database in list(self.pending):
+            self.flush(database)
+
+    def stats(self):
+        with self.lock:
+            return {'pending': sum(len(events) for events in self.pending.values()), 'written': self.written}
+
+history_buffer = HistoryBuffer()
+atexit.register(history_buffer.close)
+
+def write_history(events, conn):
+    """Append (title, format, event, at) events to SuggestionHistory and add them to AlbumPlayStats, in one transaction."""
+    totals = {}
+    for title, format_name, event, at in events:
+        suggested, played, last_suggested, last_played = totals.get(title, (0, 0, None, None))
+        if event == 'played':
+            totals[title] = (suggested, played + 1, last_suggested, max(at, last_played or 0))
+        else:
+            totals[title] = (suggested + 1, played, max(at, last_suggested or 0), last_played)
+    from functions import ALBUM_BY_TITLE_SQL # functions imports this module
+    with transaction(conn):
+        conn.executemany(f"""
+            INSERT INTO SuggestionHistory (album_id, format_id, event, at)
+            SELECT Albums.id, (SELECT id FROM Formats WHERE format_name = ?), ?, ?
+            FROM Albums WHERE Albums.id = ({ALBUM_BY_TITLE_SQL})""",
+            [(format_name, event, at, title) for title, format_name, event, at in events])
+        conn.executemany(f"""
+            INSERT INTO AlbumPlayStats (album_id, suggested, played, last_suggested, last_played)
+            SELECT Albums.id, ?, ?, ?, ? FROM Albums WHERE Albums.id = ({ALBUM_BY_TITLE_SQL})
+            ON CONFLICT (album_id) DO UPDATE SET
+                suggested = suggested + excluded.suggested,
+                played = played + excluded.played,
+                last_suggested = COALESCE(MAX(last_suggested, excluded.last_suggested), last_suggested, excluded.last_suggested),
+                last_played = COALESCE(MAX(last_played, excluded.last_played), last_played, excluded.last_played)""",
+            [total + (title,) for title, total in totals.items()])
+
+def record_history(rows, event, conn):
+    """Buffer one event for each (title, ..., format) row; a read-only snapshot has no history to record."""
+    if is_snapshot(conn):
+        return
+    conn = connection(conn)
+    key = database_key(conn)
+    at = time.time()
+    events = [(row[0], row[-1], event, at) for row in rows]
+    if key.startswith('memory:'): # nothing else can open an in-memory database, so write through this connection
+        write_history(events, conn)
+    else:
+        history_buffer.add(key, events)
+
+def record_suggestions(rows, conn=None):
+    """Remember that these (title, artist, year, format) rows were just suggested."""
+    record_history(rows, 'suggested', conn)
+
+def record_played(album_title, format_name=None, conn=None):
+    """Remember that I listened to an album (on a format, if given)."""
+    record_history([(album_title, format_name)], 'played', conn)
+
+def flush_history(conn=None):
+    """Write the events buffered for this database now, ie before reading AlbumPlayStats."""
+    conn = connection(conn)
+    return history_buffer.flush(database_key(conn), conn)
+
+def get_album_play_stats(album_title, conn=None):
+    """(times suggested, times played, last suggested, last played) for an album, the times as Unix timestamps."""
+    from functions import ALBUM_BY_TITLE_SQL # functions imports this module
+    conn = connection(conn)
+    cursor = conn.execute(f"""
+        SELECT AlbumPlayStats.suggested, AlbumPlayStats.played, AlbumPlayStats.last_suggested, AlbumPlayStats.last_played
+        FROM AlbumPlayStats
+        JOIN Albums ON AlbumPlayStats.album_id = Albums.id
+        WHERE Albums.id = ({ALBUM_BY_TITLE_SQL})""", (album_title,))
+    return cursor.fetchone() or (0, 0, None, None)
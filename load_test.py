@@ -0,0 +1,128 @@
+"""Load test for service.py: lots of concurrent clients asking for a mix of searches and suggestions.
+`python load_test.py --clients 50 --requests 5000` starts the service on a temporary copy of the database,
+hammers it, and reports requests/sec and latency percentiles. `--port` tests a service that is already running instead.
+`--batch 10` sends requests ten to a line, to see what batching buys."""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import db
+from benchmarks import summarize
+
+
+def request_mix(database, count, seed=0):
+    """`count` requests in the proportions people actually use the menu: mostly suggestions and artist/genre searches."""
+    rng = random.Random(seed)
+    conn = db.connect(database)
+    genres = [row[0] for row in conn.execute("""SELECT genre_name FROM Genres""").fetchall()] or ['Rock']
+    artists = [row[0] for row in conn.execute("""SELECT name FROM Artists""").fetchall()] or ['Eagles']
+    formats = [row[0] for row in conn.execute("""SELECT format_name FROM Formats""").fetchall()] or ['vinyl']
+    conn.close()
+    def years(span):
+        start = rng.randint(1960, 2015)
+        return {'start_year': start, 'end_year': start + span}
+    makers = [
+        (30, lambda: ('suggest', {'quantity': rng.randint(1, 5), 'genre': rng.choice(genres), 'media': rng.choice(formats)})),
+        (10, lambda: ('suggest', dict(quantity=3, weight='rating', **years(10)))),
+        (20, lambda: ('by_artist', {'artist_name': rng.choice(artists)})),
+        (15, lambda: ('by_genre', {'genre_name': rng.choice(genres)})),
+        (10, lambda: ('artist_count', {'artist_name': rng.choice(artists)})),
+        (10, lambda: ('fuzzy_search', {'text': rng.choice(artists)[:12], 'limit': 5})),
+        (5, lambda: ('between_years', years(5))),
+    ]
+    weights = [weight for weight, maker in makers]
+    requests = []
+    for number in range(count):
+        op, args = rng.choices(makers, weights)[0][1]()
+        requests.append({'id': number, 'op': op, 'args': args})
+    return requests
+
+
+async def client(host, port, requests, batch, latencies, errors):
+    """One client: send its requests a line at a time (or `batch` per line), waiting for each reply before the next."""
+    reader, writer = await asyncio.open_connection(host, port, limit=2 ** 22)
+    try:
+        for start in range(0, len(requests), batch):
+            chunk = requests[start:start + batch]
+            message = chunk[0] if batch == 1 else {'batch': chunk}
+            began = time.perf_counter()
+            writer.write(json.dumps(message).encode('utf-8') + b'\n')
+            await writer.drain()
+            reply = json.loads(await reader.readline())
+            elapsed = (time.perf_counter() - began) * 1000
+            replies = reply['batch'] if batch > 1 else [reply]
+            latencies.extend([elapsed] * len(replies))
+            errors.extend(reply['error'] for reply in replies if 'error' in reply)
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, requests, clients, batch):
+    """Split the requests between `clients` concurrent clients; return (seconds, latencies, errors)."""
+    latencies, errors = [], []
+    shares = [requests[number::clients] for number in range(clients)]
+    start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, share, batch, latencies, errors) for share in shares if share))
+    return time.perf_counter() - start, latencies, errors
+
+
+def start_service(database, workers):
+    """Run service.py in its own process on a free port; returns (process, port)."""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'service.py'),
+               '--database', database, '--port', '0']
+    if workers:
+        command += ['--workers', str(workers)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline() # "Serving <database> on 127.0.0.1:<port> with N workers"
+    if not line.startswith('Serving'):
+        process.kill()
+        raise RuntimeError(f"service.py didn't start: {line!r}")
+    return process, int(line.split(' on ')[1].split()[0].rsplit(':', 1)[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database', default=db.DATABASE, help='copied to a temporary file first, unless --port is given')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='test a service that is already running')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--batch', type=int, default=1, help='requests per line')
+    parser.add_argument('--workers', type=int, help='worker threads for the service this script starts')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        process = None
+        database = args.database
+        if args.port is None:
+            database = os.path.join(directory, 'load_test.db')
+            shutil.copy(args.database, database) # the service may migrate the schema; leave the real file alone
+            process, port = start_service(database, args.workers)
+        else:
+            port = args.port
+        try:
+            requests = request_mix(database, args.requests, args.seed)
+            seconds, latencies, errors = asyncio.run(run_load(args.host, port, requests, args.clients, args.batch))
+        finally:
+            if process:
+                process.terminate()
+                process.wait()
+
+    report = summarize(latencies)
+    print(f"\n{len(latencies)} requests from {args.clients} clients ({args.batch} per line) in {seconds:.2f}s: "
+          f"{len(latencies) / seconds:,.0f} requests/sec, {len(errors)} errors")
+    print(', '.join(f"{key} {value:.2f}" for key, value in report.items() if key != 'calls'))
+    for error in sorted(set(errors))[:5]:
+        print(f"  error: {error}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""Bulk mutation functions used in Personal Music Collection project."""
+
+import time
+from contextlib import contextmanager
+
+from db import bump_generation, connection, id_cache, transaction
+from functions import STATS_REBUILD_SQL, album_view_filters, ensure_schema
+from search import refresh_search_index
+
+
+""" // BULK MUTATION FUNCTIONS // """
+
+# Set-based versions of the one-album write functions: each call is a handful of statements joined against temporary
+# tables of target ids, run in one transaction, whatever the number of albums.
+STATS_REBUILD_SHARE = 0.1 # a change touching more than this share of the FormattedAlbums/AlbumGenres rows recomputes the
+                          # summary tables once instead of running the stats triggers on every row
+
+BULK_TARGETS_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS TargetAlbums (id INTEGER PRIMARY KEY);
+    CREATE TEMP TABLE IF NOT EXISTS TargetNames (name TEXT PRIMARY KEY, new_name TEXT);
+    CREATE TEMP TABLE IF NOT EXISTS IdMap (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL);
+    DELETE FROM temp.TargetAlbums;
+    DELETE FROM temp.TargetNames;
+    DELETE FROM temp.IdMap;
+    """
+
+class BulkMutation:
+    """What one bulk change has done so far: rows changed per table, and the stats triggers it switched off."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = {}
+        self.triggers = [] # (name, sql) of each dropped stats trigger, re-created when the change commits
+        self.stats = {}
+
+    def count(self, table, cursor):
+        """Add a statement's changed rows to the table's total."""
+        self.rows[table] = self.rows.get(table, 0) + max(cursor.rowcount, 0)
+        return cursor.rowcount
+
+    def expect(self, rows):
+        """Drop the stats triggers until the change commits if it is about to write more than STATS_REBUILD_SHARE of their rows."""
+        if self.triggers or not rows:
+            return
+        watched = self.conn.execute("""SELECT (SELECT COUNT(*) FROM FormattedAlbums) + (SELECT COUNT(*) FROM AlbumGenres)""").fetchone()[0]
+        if rows > STATS_REBUILD_SHARE * watched:
+            self.triggers = self.conn.execute("""
+                SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'stats_%'""").fetchall()
+            for name, sql in self.triggers:
+                self.conn.execute(f"""DROP TRIGGER {name}""")
+
+@contextmanager
+def bulk_mutation(action, conn):
+    """`with bulk_mutation('Deleted albums', conn) as mutation:` runs the body in one transaction and prints mutation.stats."""
+    ensure_schema(conn=conn)
+    start = time.perf_counter()
+    mutation = BulkMutation(conn)
+    with transaction(conn):
+        if not conn.in_transaction:
+            conn.execute("""BEGIN""") # so dropping the stats triggers (DDL) is rolled back along with everything else
+        for statement in BULK_TARGETS_SQL.split(';'):
+            if statement.strip():
+                conn.execute(statement)
+        yield mutation
+        if mutation.triggers:
+            for statement in STATS_REBUILD_SQL.split(';'):
+                if statement.strip():
+                    conn.execute(statement)
+            for name, sql in mutation.triggers:
+                conn.execute(sql)
+        bump_generation(conn)
+    id_cache.clear() # deleted and merged-away names may be cached
+    refresh_search_index(conn=conn)
+    seconds = time.perf_counter() - start
+    rows = sum(mutation.rows.values())
+    mutation.stats = dict(mutation.rows, rows=rows, seconds=seconds, rows_per_sec=rows / seconds if seconds else 0.0,
+                          stats_rebuilt=bool(mutation.triggers))
+    tables = ', '.join(f"{table} {count}" for table, count in mutation.rows.items())
+    print(f"{action}: {rows} rows changed ({tables or 'none'}) in {seconds:.2f}s, {mutation.stats['rows_per_sec']:,.0f} rows/sec.")
+
+def target_albums(titles=None, genres=(), match='any', media=None, artist=None, start_year=None, end_year=None, owned=True, conn=None):
+    """Fill temp.TargetAlbums with the albums named in `titles` and/or passing the album_view_filters; returns how many."""
+    conn = connection(conn)
+    if titles is None and not (genres or media or artist or start_year is not None or end_year is not None):
+        raise ValueError("give a list of titles or at least one filter (genres, media, artist, start_year, end_year)")
+    where, params = album_view_filters(genres, match, media, artist, start_year, end_year, owned)
+    albums = "Albums"
+    if titles is not None: # CROSS JOIN makes SQLite start from the titles rather than from a filter's subquery
+        conn.executemany("""INSERT OR IGNORE INTO temp.TargetNames (name) VALUES (?)""", ((title,) for title in titles))
+        albums = "temp.TargetNames CROSS JOIN Albums ON Albums.title = TargetNames.name"
+    cursor = conn.execute(f"""
+        INSERT INTO temp.TargetAlbums (id)
+        SELECT Albums.id FROM {albums}
+        JOIN Artists ON Albums.artist_id = Artists.id{where}""", params)
+    return cursor.rowcount
+
+def target_rows(conn):
+    """How many FormattedAlbums and AlbumGenres rows belong to the albums in temp.TargetAlbums."""
+    cursor = conn.execute("""
+        SELECT (SELECT COUNT(*) FROM FormattedAlbums WHERE album_id IN (SELECT id FROM temp.TargetAlbums))
+             + (SELECT COUNT(*) FROM AlbumGenres WHERE album_id IN (SELECT id FROM temp.TargetAlbums))""")
+    return cursor.fetchone()[0]
+
+def map_names(table, column, renames, create, conn):
+    """Fill temp.IdMap with (old id, new id) for {old name: new name} pairs, creating the new names if `create` is set."""
+    renames = {old: new for old, new in dict(renames).items() if old != new}
+    chained = sorted(set(renames) & set(renames.values()))
+    if chained:
+        raise ValueError(f"these names are merged into others and can't also be merge targets: {chained}")
+    conn.executemany("""INSERT INTO temp.TargetNames (name, new_name) VALUES (?, ?)""", renames.items())
+    if create:
+        conn.execute(f"""
+            INSERT OR IGNORE INTO {table} ({column})
+            SELECT DISTINCT new_name FROM temp.TargetNames
+            WHERE name IN (SELECT {column} FROM {table})""")
+    cursor = conn.execute(f"""
+        INSERT INTO temp.IdMap (old_id, new_id)
+        SELECT old.id, new.id FROM temp.TargetNames
+        JOIN {table} AS old ON old.{column} = TargetNames.name
+        JOIN {table} AS new ON new.{column} = TargetNames.new_name""")
+    return cursor.rowcount
+
+def delete_formatted_albums(titles=None, media=None, genres=(), match='any', artist=None, start_year=None, end_year=None, conn=None):
+    """delete_formatted_album for many albums at once, ie delete_formatted_albums(media='cassette', end_year=1979)."""
+    conn = connection(conn)
+    with bulk_mutation("Deleted formatted albums", conn) as mutation:
+        target_albums(titles, genres, match, media, artist, start_year, end_year, owned=True, conn=conn)
+        format_filter, params = ("", []) if media is None else (" AND format_id = (SELECT id FROM Formats WHERE format_name = ?)", [media])
+        rows = conn.execute(f"""SELECT COUNT(*) FROM FormattedAlbums
+                                WHERE album_id IN (SELECT id FROM temp.TargetAlbums){format_filter}""", params).fetchone()[0]
+        mutation.expect(rows)
+        mutation.count('FormattedAlbums', conn.execute(f"""
+            DELETE FROM FormattedAlbums
+            WHERE album_id IN (SELECT id FROM temp.TargetAlbums){format_filter}""", params))
+    return mutation.stats
+
+def delete_albums(titles=None, genres=(), match='any', media=None, artist=None, start_year=None, end_year=None, owned=True, conn=None):
+    """Delete every album named in `titles` and/or passing the filters, with every row that points at it (owned=False: catalog ones too)."""
+    conn = connection(conn)
+    with bulk_mutation("Deleted albums", conn) as mutation:
+        target_albums(titles, genres, match, media, artist, start_year, end_year, owned, conn=conn)
+        mutation.expect(target_rows(conn))
+        for table in ('FormattedAlbums', 'AlbumGenres', 'CatalogAlbums', 'SuggestionHistory', 'AlbumPlayStats'):
+            mutation.count(table, conn.execute(f"""DELETE FROM {table} WHERE album_id IN (SELECT id FROM temp.TargetAlbums)"""))
+        mutation.count('CatalogMatches', conn.execute("""
+            DELETE FROM CatalogMatches
+            WHERE album_id IN (SELECT id FROM temp.TargetAlbums) OR catalog_album_id IN (SELECT id FROM temp.TargetAlbums)"""))
+        mutation.count('Albums', conn.execute("""DELETE FROM Albums WHERE id IN (SELECT id FROM temp.TargetAlbums)"""))
+    return mutation.stats
+
+def retag_albums(titles=None, add=(), remove=(), genres=(), match='any', media=None, artist=None, start_year=None, end_year=None,
+                 owned=True, conn=None):
+    """Drop the `remove` genres from, then add the `add` genres to, every album named in `titles` and/or passing the filters."""
+    conn = connection(conn)
+    add, remove = list(dict.fromkeys(add)), list(dict.fromkeys(remove))
+    with bulk_mutation("Re-tagged albums", conn) as mutation:
+        albums = target_albums(titles, genres, match, media, artist, start_year, end_year, owned, conn=conn)
+        mutation.expect(albums * (len(add) + len(remove)))
+        if remove:
+            placeholders = ', '.join('?' * len(remove))
+            mutation.count('AlbumGenres', conn.execute(f"""
+                DELETE FROM AlbumGenres
+                WHERE album_id IN (SELECT id FROM temp.TargetAlbums)
+                AND genre_id IN (SELECT id FROM Genres WHERE genre_name IN ({placeholders}))""", remove))
+        if add:
+            conn.executemany("""INSERT OR IGNORE INTO Genres (genre_name) VALUES (?)""", [(genre,) for genre in add])
+            placeholders = ', '.join('?' * len(add))
+            mutation.count('AlbumGenres', conn.execute(f"""
+                INSERT OR IGNORE INTO AlbumGenres (album_id, genre_id)
+                SELECT TargetAlbums.id, Genres.id FROM temp.TargetAlbums, Genres
+                WHERE Genres.genre_name IN ({placeholders})""", add))
+    return mutation.stats
+
+def merge_genres(renames, conn=None):
+    """Merge genres, {old name: new name}, ie merge_genres({'Hip-Hop': 'Hip Hop'}); new names are created as needed."""
+    conn = connection(conn)
+    with bulk_mutation("Merged genres", conn) as mutation:
+        map_names('Genres', 'genre_name', renames, True, conn)
+        rows = conn.execute("""SELECT COUNT(*) FROM AlbumGenres WHERE genre_id IN (SELECT old_id FROM temp.IdMap)""").fetchone()[0]
+        mutation.expect(2 * rows)
+        conn.execute("""
+            INSERT OR IGNORE INTO AlbumGenres (album_id, genre_id)
+            SELECT AlbumGenres.album_id, IdMap.new_id FROM AlbumGenres
+            JOIN temp.IdMap ON AlbumGenres.genre_id = IdMap.old_id""")
+        mutation.count('AlbumGenres', conn.execute("""DELETE FROM AlbumGenres WHERE genre_id IN (SELECT old_id FROM temp.IdMap)"""))
+        mutation.count('Genres', conn.execute("""DELETE FROM Genres WHERE id IN (SELECT old_id FROM temp.IdMap)"""))
+    return mutation.stats
+
+def merge_artists(renames, conn=None):
+    """Merge artists, {variant: canonical name}, ie merge_artists({'Beatles': 'The Beatles'}); new names are created as needed."""
+    conn = connection(conn)
+    with bulk_mutation("Merged artists", conn) as mutation:
+        map_names('Artists', 'name', renames, True, conn)
+        rows = conn.execute("""
+            SELECT COUNT(*) FROM Albums
+            WHERE artist_id IN (SELECT old_id FROM temp.IdMap) AND id IN (SELECT album_id FROM FormattedAlbums)""").fetchone()[0]
+        mutation.expect(rows)
+        mutation.count('Albums', conn.execute("""
+            UPDATE Albums SET artist_id = (SELECT new_id FROM temp.IdMap WHERE old_id = Albums.artist_id)
+            WHERE artist_id IN (SELECT old_id FROM temp.IdMap)"""))
+        mutation.count('Artists', conn.execute("""DELETE FROM Artists WHERE id IN (SELECT old_id FROM temp.IdMap)"""))
+    return mutation.stats
+
+def merge_albums(duplicates, conn=None):
+    """Merge duplicate albums, {duplicate title: kept title}, moving everything that points at a duplicate to the kept album."""
+    conn = connection(conn)
+    duplicates = dict(duplicates)
+    with bulk_mutation("Merged albums", conn) as mutation:
+        merged = map_names('Albums', 'title', duplicates, False, conn)
+        if merged:
+            conn.execute("""INSERT INTO temp.TargetAlbums (id) SELECT old_id FROM temp.IdMap""")
+            mutation.expect(2 * target_rows(conn))
+            for table, columns in [('FormattedAlbums', 'format_id'), ('AlbumGenres', 'genre_id'),
+                                   ('CatalogAlbums', 'source, source_id, ranking, average_rating, rating_count, review_count, descriptors, url, genres'),
+                                   ('CatalogMatches', 'catalog_album_id, score')]:
+                conn.execute(f"""
+                    INSERT OR IGNORE INTO {table} (album_id, {columns})
+                    SELECT IdMap.new_id, {columns} FROM {table}
+                    JOIN temp.IdMap ON {table}.album_id = IdMap.old_id""")
+                mutation.count(table, conn.execute(f"""DELETE FROM {table} WHERE album_id IN (SELECT old_id FROM temp.IdMap)"""))
+            mutation.count('CatalogMatches', conn.execute("""
+                UPDATE CatalogMatches SET catalog_album_id = (SELECT new_id FROM temp.IdMap WHERE old_id = CatalogMatches.catalog_album_id)
+                WHERE catalog_album_id IN (SELECT old_id FROM temp.IdMap)"""))
+            mutation.count('SuggestionHistory', conn.execute("""
+                UPDATE SuggestionHistory SET album_id = (SELECT new_id FROM temp.IdMap WHERE old_id = SuggestionHistory.album_id)
+                WHERE album_id IN (SELECT old_id FROM temp.IdMap)"""))
+            conn.execute("""
+                INSERT INTO AlbumPlayStats (album_id, suggested, played, last_suggested, last_played)
+                SELECT IdMap.new_id, SUM(suggested), SUM(played), MAX(last_suggested), MAX(last_played)
+                FROM AlbumPlayStats
+                JOIN temp.IdMap ON AlbumPlayStats.album_id = IdMap.old_id
+                WHERE true
+                GROUP BY IdMap.new_id
+                ON CONFLICT (album_id) DO UPDATE SET
+                    suggested = suggested + excluded.suggested,
+                    played = played + excluded.played,
+                    last_suggested = COALESCE(MAX(last_suggested, excluded.last_suggested), last_suggested, excluded.last_suggested),
+                    last_played = COALESCE(MAX(last_played, excluded.last_played), last_played, excluded.last_played)""")
+            mutation.count('AlbumPlayStats', conn.execute("""DELETE FROM AlbumPlayStats WHERE album_id IN (SELECT old_id FROM temp.IdMap)"""))
+            mutation.count('Albums', conn.execute("""DELETE FROM Albums WHERE id IN (SELECT old_id FROM temp.IdMap)"""))
+    mutation.stats['skipped'] = len({old: new for old, new in duplicates.items() if old != new}) - merged
+    return mutation.stats
@@ -0,0 +1,207 @@
+"""Fuzzy search functions used in Personal Music Collection project."""
+
+import sqlite3
+
+from db import connection, is_snapshot, transaction
+
+
+""" // SEARCH INDEX // """
+
+# A trigram full-text index over album titles, artist names and genres (rowid = Albums.id). Triggers only queue
+# changed albums in SearchQueue; the write paths re-index the queue with refresh_search_index after they commit.
+SEARCH_INDEX_SQL = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS AlbumSearch USING fts5 (title, artist, genres, tokenize = 'trigram');
+    CREATE VIRTUAL TABLE IF NOT EXISTS AlbumSearchVocab USING fts5vocab (AlbumSearch, 'row');
+    CREATE TABLE IF NOT EXISTS SearchQueue (album_id INTEGER PRIMARY KEY);
+
+    CREATE TRIGGER IF NOT EXISTS search_albums_insert AFTER INSERT ON Albums
+    BEGIN
+        INSERT OR IGNORE INTO SearchQueue (album_id) VALUES (NEW.id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS search_albums_update AFTER UPDATE OF title, artist_id ON Albums
+    BEGIN
+        INSERT OR IGNORE INTO SearchQueue (album_id) VALUES (NEW.id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS search_albums_delete AFTER DELETE ON Albums
+    BEGIN
+        INSERT OR IGNORE INTO SearchQueue (album_id) VALUES (OLD.id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS search_artists_update AFTER UPDATE OF name ON Artists
+    BEGIN
+        INSERT OR IGNORE INTO SearchQueue (album_id) SELECT id FROM Albums WHERE artist_id = NEW.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS search_genres_update AFTER UPDATE OF genre_name ON Genres
+    BEGIN
+        INSERT OR IGNORE INTO SearchQueue (album_id) SELECT album_id FROM AlbumGenres WHERE genre_id = NEW.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS search_albumgenres_insert AFTER INSERT ON AlbumGenres
+    BEGIN
+        INSERT OR IGNORE INTO SearchQueue (album_id) VALUES (NEW.album_id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS search_albumgenres_delete AFTER DELETE ON AlbumGenres
+    BEGIN
+        INSERT OR IGNORE INTO SearchQueue (album_id) VALUES (OLD.album_id);
+    END;
+    """
+
+# Re-indexes every queued album (albums that no longer exist just drop out of the index).
+SEARCH_REFRESH_SQL = """
+    DELETE FROM AlbumSearch WHERE rowid IN (SELECT album_id FROM SearchQueue);
+    INSERT INTO AlbumSearch (rowid, title, artist, genres)
+        SELECT Albums.id, Albums.title, Artists.name, COALESCE((
+            SELECT group_concat(Genres.genre_name, ', ') FROM AlbumGenres
+            JOIN Genres ON AlbumGenres.genre_id = Genres.id
+            WHERE AlbumGenres.album_id = Albums.id), '')
+        FROM Albums
+        JOIN Artists ON Albums.artist_id = Artists.id
+        WHERE Albums.id IN (SELECT album_id FROM SearchQueue);
+    DELETE FROM SearchQueue;
+    """
+
+def trigram_tokenizer(conn):
+    """Whether this SQLite has FTS5 with the trigram tokenizer (SQLite 3.34+ built with FTS5)."""
+    try:
+        conn.execute("""CREATE VIRTUAL TABLE temp.TrigramCheck USING fts5 (text, tokenize = 'trigram')""")
+    except sqlite3.OperationalError:
+        return False
+    conn.execute("""DROP TABLE temp.TrigramCheck""")
+    return True
+
+def search_index_migration(conn):
+    """Migration 3, or nothing where the trigram tokenizer is missing (rebuild_search_index adds it later)."""
+    if not trigram_tokenizer(conn):
+        return ""
+    return SEARCH_INDEX_SQL + "INSERT INTO SearchQueue (album_id) SELECT id FROM Albums;" + SEARCH_REFRESH_SQL
+
+
+
+""" // FUZZY SEARCH FUNCTIONS // """
+
+SEARCH_FIELDS = ('title', 'artist', 'genres')
+
+SEARCH_TRIGRAMS = 8 # how many of the query's rarest trigrams are used to find candidates
+SEARCH_PAIRING = 5000 # once those trigrams appear in this many albums between them, candidates must match pairs of them
+
+def trigrams(text):
+    """The set of lowercase 3-letter pieces of text, padded so short words and word starts count too."""
+    text = '  ' + ' '.join(text.lower().split()) + ' '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def dice(a, b):
+    """The Dice coefficient of two trigram sets."""
+    return 2 * len(a & b) / (len(a) + len(b)) if a or b else 0.0
+
+def similarity(a, b):
+    """How alike two strings are, from 0 to 1."""
+    return dice(trigrams(a), trigrams(b))
+
+def trigram_query(text, conn):
+    """An FTS5 query matching any of the rarest trigrams of text (pairs of them when even those are common)."""
+    text = ' '.join(text.lower().split())
+    pieces = sorted({text[i:i + 3] for i in range(len(text) - 2)})
+    if not pieces:
+        return ''
+    placeholders = ', '.join('?' * len(pieces))
+    cursor = conn.execute(f"""SELECT term, doc FROM AlbumSearchVocab WHERE term IN ({placeholders})""", pieces)
+    rarest = sorted(cursor.fetchall(), key=lambda row: row[1])[:SEARCH_TRIGRAMS]
+    terms = ['"' + term.replace('"', '""') + '"' for term, doc in rarest]
+    if len(terms) >= 4 and sum(doc for term, doc in rarest) > SEARCH_PAIRING:
+        # every trigram is common (ie 'the', 'ove'); pairs still survive a typo but match far fewer albums
+        terms = [f"({first} AND {second})" for first, second in zip(terms[::2], terms[1::2])]
+    return ' OR '.join(terms)
+
+def fuzzy_search(text, fields=SEARCH_FIELDS, limit=10, candidates=50, conn=None):
+    """Find the (score, title, artist, year) rows whose title/artist/genres best match `text`, typos and all."""
+    conn = connection(conn)
+    fields = [field for field in fields if field in SEARCH_FIELDS]
+    if not fields:
+        return []
+    if is_snapshot(conn):
+        rows = conn.search_rows()
+    elif has_search_index(conn):
+        query = trigram_query(text, conn)
+        if not query:
+            return []
+        cursor = conn.execute("""
+            SELECT AlbumSearch.title, AlbumSearch.artist, AlbumSearch.genres, Albums.year
+            FROM AlbumSearch
+            JOIN Albums ON AlbumSearch.rowid = Albums.id
+            WHERE AlbumSearch MATCH ?
+            ORDER BY rank
+            LIMIT ?""", ('{' + ' '.join(fields) + '} : (' + query + ')', candidates))
+        rows = cursor.fetchall()
+    else:
+        rows = like_candidates(text, fields, candidates, conn)
+    wanted = trigrams(text)
+    results = []
+    for title, artist, genres, year in rows:
+        values = [title] * ('title' in fields) + [artist] * ('artist' in fields)
+        if 'title' in fields and 'artist' in fields:
+            values.append(f"{artist} {title}")
+        if 'genres' in fields:
+            values.extend(genres.split(', '))
+        score = max(dice(wanted, trigrams(value)) for value in values)
+        results.append((round(score, 3), title, artist, year))
+    results.sort(key=lambda result: result[0], reverse=True)
+    return results[:limit]
+
+def like_candidates(text, fields, candidates, conn):
+    """fuzzy_search's candidates without the trigram index, found with LIKE over every album."""
+    text = ' '.join(text.lower().split())
+    pieces = sorted({text[i:i + 3] for i in range(len(text) - 2)})
+    if not pieces:
+        return []
+    columns = {'title': "Albums.title", 'artist': "Artists.name", 'genres': "COALESCE(Tags.genres, '')"}
+    searched = " || ' ' || ".join(columns[field] for field in fields)
+    hits = ' + '.join([f"({searched} LIKE ? ESCAPE '\\')"] * len(pieces))
+    patterns = ['%' + piece.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%' for piece in pieces]
+    cursor = conn.execute(f"""
+        SELECT Albums.title, Artists.name, COALESCE(Tags.genres, ''), Albums.year, {hits} AS hits
+        FROM Albums
+        JOIN Artists ON Albums.artist_id = Artists.id
+        LEFT JOIN (SELECT AlbumGenres.album_id, group_concat(Genres.genre_name, ', ') AS genres
+                   FROM AlbumGenres JOIN Genres ON AlbumGenres.genre_id = Genres.id
+                   GROUP BY AlbumGenres.album_id) AS Tags ON Tags.album_id = Albums.id
+        WHERE hits > 0
+        ORDER BY hits DESC
+        LIMIT ?""", patterns + [candidates])
+    return [row[:4] for row in cursor.fetchall()]
+
+def fuzzy_find_artist(name, conn=None):
+    """The closest artist name in the database to `name`, or None if nothing is close."""
+    if is_snapshot(conn):
+        return conn.find_artist(name)
+    matches = fuzzy_search(name, fields=('artist',), limit=1, conn=conn)
+    if matches and matches[0][0] >= 0.5:
+        return matches[0][2]
+    return None
+
+def has_search_index(conn):
+    """Whether the database has the trigram index (see search_index_migration)."""
+    return conn.execute("""SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE name = 'AlbumSearch')""").fetchone()[0]
+
+def refresh_search_index(conn=None):
+    """Bring the fuzzy search index up to date with any albums changed since the last refresh."""
+    conn = connection(conn)
+    if has_search_index(conn) and conn.execute("""SELECT EXISTS (SELECT 1 FROM SearchQueue)""").fetchone()[0]:
+        with transaction(conn):
+            for statement in SEARCH_REFRESH_SQL.split(';'):
+                if statement.strip():
+                    conn.execute(statement)
+
+def rebuild_search_index(conn=None):
+    """Re-index every album from scratch, creating the index first if this SQLite has gained the trigram tokenizer."""
+    conn = connection(conn)
+    if not has_search_index(conn):
+        if not trigram_tokenizer(conn):
+            return
+        conn.executescript("BEGIN; " + SEARCH_INDEX_SQL + " COMMIT;")
+    conn.execute("""INSERT OR IGNORE INTO SearchQueue (album_id) SELECT id FROM Albums""")
+    conn.execute("""DELETE FROM AlbumSearch""")
+    refresh_search_index(conn=conn)
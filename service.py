@@ -0,0 +1,163 @@
+"""Asyncio service for the Personal Music Collection project, so many people can search and get suggestions at once.
+Run `python service.py --database music_collection.db --port 8765` and send one JSON request per line:
+    {"id": 1, "op": "suggest", "args": {"quantity": 3, "genre": "Rock", "media": "vinyl"}}
+    {"id": 2, "op": "by_artist", "args": {"artist_name": "Eagles", "limit": 20, "offset": 0}}
+Each reply is one line, {"id": 1, "result": [...]} or {"id": 1, "error": "..."}, sent as soon as it is ready
+(so replies can come back out of order). A line holding {"batch": [request, request, ...]} runs every request
+in a single trip to a worker thread and gets back a single {"batch": [reply, reply, ...]} line.
+The queries run on a bounded pool of worker threads, each with its own read connection (see db.get_connection)."""
+
+import argparse
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import functions
+import search
+
+# op -> the function it calls; the request's args are passed as keyword arguments
+OPERATIONS = {
+    'suggest': functions.sample_albums, # quantity, start_year, end_year, genre, media, weight
+    'count': functions.count_albums,
+    'by_artist': functions.iter_albums_by_artist, # the iter_* searches take limit/offset for paging
+    'by_genre': functions.iter_albums_by_genre,
+    'by_media': functions.iter_albums_by_media,
+    'between_years': functions.iter_albums_between_years,
+    'albums': functions.iter_album_view, # one row per album with its formats and genres; genres/match/media/artist/years
+    'artist_count': functions.artist_album_count,
+    'artists_by_count': functions.descending_count_albums_by_artist,
+    'genre_counts': functions.genre_album_counts,
+    'genres_for_album': functions.get_genres_for_album,
+    'fuzzy_search': search.fuzzy_search,
+    'find_artist': search.fuzzy_find_artist,
+}
+PAGED_OPERATIONS = {'by_artist', 'by_genre', 'by_media', 'between_years', 'albums'}
+
+WORKERS = min(8, (os.cpu_count() or 1) + 2)
+MAX_PENDING = 256 # requests in flight before the service stops reading from its clients
+MAX_LINE = 2 ** 20 # bytes, so batches fit on one line
+
+
+def answer_request(request, conn, limit=functions.PAGE_SIZE):
+    """Run one {"id", "op", "args"} request against `conn` and return its reply; paged ops return at most `limit` rows."""
+    reply = {'id': request.get('id')} if isinstance(request, dict) else {'id': None}
+    try:
+        op = request['op']
+        if op not in OPERATIONS:
+            raise ValueError(f"unknown op {op!r}")
+        args = dict(request.get('args') or {})
+        if op in PAGED_OPERATIONS and limit is not None:
+            args.setdefault('limit', limit)
+        result = OPERATIONS[op](**args, conn=conn)
+        reply['result'] = list(result) if op in PAGED_OPERATIONS else result
+    except Exception as error:
+        reply['error'] = f"{type(error).__name__}: {error}"
+    return reply
+
+
+class MusicService:
+    """Runs requests against one database on a thread pool, at most max_pending at a time."""
+
+    def __init__(self, database=None, workers=WORKERS, max_pending=MAX_PENDING):
+        self.database = database or db.DATABASE
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='music-service')
+        self.pending = asyncio.Semaphore(max_pending)
+        self.stats = {'requests': 0, 'batches': 0, 'errors': 0}
+        self.stats_lock = threading.Lock()
+
+    def count(self, stat):
+        with self.stats_lock:
+            self.stats[stat] += 1
+
+    def run_request(self, request):
+        """Answer one request; runs on a worker thread."""
+        reply = answer_request(request, self.database)
+        if 'error' in reply:
+            self.count('errors')
+        self.count('requests')
+        return reply
+
+    def run_batch(self, requests):
+        """Answer a list of requests in one go; runs on a worker thread."""
+        self.count('batches')
+        return [self.run_request(request) for request in requests]
+
+    async def answer(self, line, writer, write_lock):
+        """Parse one request line, run it on the pool and write the reply."""
+        loop = asyncio.get_running_loop()
+        try:
+            message = json.loads(line)
+            if isinstance(message, dict) and isinstance(message.get('batch'), list):
+                reply = {'batch': await loop.run_in_executor(self.executor, self.run_batch, message['batch'])}
+            else:
+                reply = await loop.run_in_executor(self.executor, self.run_request, message)
+        except ValueError as error:
+            self.count('errors')
+            reply = {'id': None, 'error': f"bad request: {error}"}
+        finally:
+            self.pending.release()
+        async with write_lock:
+            writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+            await writer.drain()
+
+    async def handle_client(self, reader, writer):
+        """Read request lines from one client until it disconnects; each line is answered concurrently."""
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                await self.pending.acquire() # back-pressure: stop reading while too much is in flight
+                task = asyncio.create_task(self.answer(line, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass # the client went away or sent a line that was too long
+        finally:
+            writer.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+async def serve(host='127.0.0.1', port=8765, database=None, workers=WORKERS, max_pending=MAX_PENDING):
+    """Start the service and run until cancelled."""
+    database = database or db.DATABASE
+    functions.ensure_schema(conn=database) # make sure the schema (and the stats/search tables) is up to date
+    db.close_connections()
+    service = MusicService(database, workers, max_pending)
+    server = await asyncio.start_server(service.handle_client, host, port, limit=MAX_LINE)
+    address = server.sockets[0].getsockname()
+    print(f"Serving {database} on {address[0]}:{address[1]} with {workers} workers", flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+        print(f"Stopped after {service.stats['requests']} requests ({service.stats['errors']} errors).", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765, help='0 picks a free port')
+    parser.add_argument('--database', default=db.DATABASE)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--max-pending', type=int, default=MAX_PENDING)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.database, args.workers, args.max_pending))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""Similarity (albums like this) functions used in Personal Music Collection project (needs numpy)."""
+
+import threading
+import time
+
+from analytics import fetch_columns
+from db import connection, database_generation, database_key
+from functions import find_album_id
+
+
+""" // SIMILARITY (ALBUMS LIKE THIS) FUNCTIONS // """
+
+# Every album with genres or RYM descriptors gets a sparse tag vector, each tag weighted by how rare it is (idf) and
+# scaled to length 1, so the dot product of two albums is their cosine. Owned albums borrow their catalog match's tags.
+SIMILAR_ALBUMS = 10 # results returned by similar_albums / recommend_albums
+
+class SimilarityIndex:
+    """Tag vectors for every album in one database, read at one generation (see similarity_index)."""
+
+    def __init__(self, album_ids, row_tags, row_weights, owned, matches, generation):
+        import numpy as np
+        self.generation = generation
+        self.album_ids = album_ids # sorted, so an album's row is np.searchsorted(album_ids, id)
+        self.owned = owned # bool per row: on a format, or matched from an album that is
+        self.matches = matches # owned album id -> the catalog album id it was matched to
+        self.matched_by = {catalog_id: owned_id for owned_id, catalog_id in matches.items()}
+        lengths = np.bincount(row_tags[0], minlength=len(album_ids))
+        self.row_offsets = np.zeros(len(album_ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.row_offsets[1:])
+        self.row_albums, self.row_tags, self.row_weights = row_tags[0], row_tags[1], row_weights # row_albums: each entry's row
+        order = np.argsort(row_tags[1], kind='stable')
+        tag_count = int(row_tags[1].max()) + 1 if len(order) else 0
+        self.tag_offsets = np.zeros(tag_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row_tags[1], minlength=tag_count), out=self.tag_offsets[1:])
+        self.tag_rows, self.tag_weights = row_tags[0][order], row_weights[order]
+
+    def row(self, album_id):
+        """The row of an album id, or None if it has no tags."""
+        import numpy as np
+        position = int(np.searchsorted(self.album_ids, album_id))
+        if position < len(self.album_ids) and self.album_ids[position] == album_id:
+            return position
+        return None
+
+    def vector(self, row):
+        """(tags, weights) of one row."""
+        start, end = self.row_offsets[row], self.row_offsets[row + 1]
+        return self.row_tags[start:end], self.row_weights[start:end]
+
+    def scores(self, tags, weights):
+        """Cosine similarity of every album with a (tags, weights) vector, adding up only the albums that share a tag."""
+        import numpy as np
+        scores = np.zeros(len(self.album_ids), dtype=np.float32)
+        for tag, weight in zip(tags.tolist(), weights.tolist()):
+            if tag < len(self.tag_offsets) - 1:
+                start, end = self.tag_offsets[tag], self.tag_offsets[tag + 1]
+                scores[self.tag_rows[start:end]] += weight * self.tag_weights[start:end] # rows are distinct within a tag
+        return scores
+
+    def profile_scores(self, selected):
+        """Cosine similarity of every album with the sum of the selected rows' vectors (selected is a bool per row)."""
+        import numpy as np
+        entries = selected[self.row_albums]
+        centroid = np.bincount(self.row_tags[entries], weights=self.row_weights[entries], minlength=len(self.tag_offsets))
+        norm = np.linalg.norm(centroid)
+        if not norm:
+            return np.zeros(len(self.album_ids), dtype=np.float32)
+        return np.bincount(self.row_albums, weights=self.row_weights * centroid[self.row_tags] / norm,
+                           minlength=len(self.album_ids)).astype(np.float32)
+
+    def top(self, scores, k, exclude=(), not_owned=False):
+        """The k best scoring rows, best first, as (row, score); rows in `exclude` (and owned ones, if asked) are skipped."""
+        import numpy as np
+        scores = scores.copy()
+        scores[list(exclude)] = 0
+        if not_owned:
+            scores[self.owned] = 0
+        k = min(k, int(np.count_nonzero(scores > 0)))
+        if k <= 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return list(zip(best.tolist(), scores[best].tolist()))
+
+    def nbytes(self):
+        return sum(array.nbytes for array in [self.album_ids, self.owned, self.row_offsets, self.row_albums, self.row_tags,
+                                               self.row_weights, self.tag_offsets, self.tag_rows, self.tag_weights])
+
+similarity_indexes = {} # database key -> SimilarityIndex
+similarity_lock = threading.Lock()
+
+def build_similarity_index(conn=None):
+    """Read every album's genres, descriptors and catalog match and build a SimilarityIndex from them."""
+    import numpy as np
+    conn = connection(conn)
+    generation = database_generation(conn)
+    pair_albums, pair_tags = fetch_columns("""SELECT album_id, genre_id FROM AlbumGenres""", 2, conn)
+    genre_ids = dict(conn.execute("""SELECT genre_name, id FROM Genres""").fetchall())
+    tag_count = max(genre_ids.values(), default=0) + 1
+    descriptor_ids = {} # catalog genres I never used and descriptors, each after the Genres ids
+    descriptor_albums, descriptor_tags = [], []
+    cursor = conn.execute("""SELECT album_id, genres, descriptors FROM CatalogAlbums WHERE genres <> '' OR descriptors <> ''""")
+    for album_id, genres, descriptors in cursor.fetchall():
+        for genre in genres.split('; ') if genres else []:
+            descriptor_albums.append(album_id)
+            descriptor_tags.append(genre_ids.get(genre) or descriptor_ids.setdefault(('genre', genre), tag_count + len(descriptor_ids)))
+        for descriptor in descriptors.split(', ') if descriptors else []:
+            descriptor_albums.append(album_id)
+            descriptor_tags.append(descriptor_ids.setdefault(('descriptor', descriptor), tag_count + len(descriptor_ids)))
+    pair_albums = np.concatenate([pair_albums, np.array(descriptor_albums, dtype=np.int64)])
+    pair_tags = np.concatenate([pair_tags, np.array(descriptor_tags, dtype=np.int64)])
+
+    # owned albums borrow the tags of the catalog album they were matched to
+    matches = dict(conn.execute("""
+        SELECT CatalogMatches.album_id, CatalogMatches.catalog_album_id FROM CatalogMatches
+        WHERE CatalogMatches.album_id IN (SELECT album_id FROM FormattedAlbums)""").fetchall())
+    if matches:
+        owned_ids, catalog_ids = np.array(list(matches.items()), dtype=np.int64).T
+        order = np.argsort(catalog_ids)
+        catalog_ids, owned_ids = catalog_ids[order], owned_ids[order]
+        borrowed = np.isin(pair_albums, catalog_ids)
+        positions = np.searchsorted(catalog_ids, pair_albums[borrowed])
+        pair_albums = np.concatenate([pair_albums, owned_ids[positions]])
+        pair_tags = np.concatenate([pair_tags, pair_tags[borrowed]])
+        # (an album matched by two owned albums only lends its tags to one of them; rare enough not to matter)
+
+    album_ids, rows = np.unique(pair_albums, return_inverse=True)
+    cells = np.unique(rows.astype(np.int64) * (tag_count + len(descriptor_ids) + 1) + pair_tags) # sorted by row, then tag
+    rows, tags = np.divmod(cells, tag_count + len(descriptor_ids) + 1)
+    frequency = np.bincount(tags, minlength=tag_count + len(descriptor_ids))
+    idf = np.log((1 + len(album_ids)) / (1 + frequency)) + 1
+    weights = idf[tags]
+    norms = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=len(album_ids)))
+    weights = (weights / norms[rows]).astype(np.float32)
+
+    owned_ids, = fetch_columns("""SELECT DISTINCT album_id FROM FormattedAlbums""", 1, conn)
+    owned = np.isin(album_ids, np.concatenate([owned_ids, np.array(list(matches.values()), dtype=np.int64)]))
+    return SimilarityIndex(album_ids, (rows, tags), weights, owned, matches, generation)
+
+def similarity_index(conn=None):
+    """This database's SimilarityIndex, rebuilt first if anything was written since it was built."""
+    conn = connection(conn)
+    key = database_key(conn)
+    generation = database_generation(conn)
+    with similarity_lock:
+        index = similarity_indexes.get(key)
+        if index is None or generation is None or index.generation != generation:
+            index = similarity_indexes[key] = build_similarity_index(conn=conn)
+    return index
+
+def rebuild_similarity_index(conn=None):
+    """Build the in-memory index again (ie after editing the catalog tables by hand) and print its stats."""
+    conn = connection(conn)
+    start = time.perf_counter()
+    with similarity_lock:
+        index = similarity_indexes[database_key(conn)] = build_similarity_index(conn=conn)
+    seconds = time.perf_counter() - start
+    stats = {'albums': len(index.album_ids), 'tags': len(index.row_tags), 'owned': int(index.owned.sum()),
+             'bytes': index.nbytes(), 'seconds': seconds}
+    print(f"Indexed {stats['albums']} albums ({stats['tags']} tags, {stats['owned']} owned) in {seconds:.2f}s.")
+    return stats
+
+def album_details(album_ids, conn):
+    """album id -> (title, artist, year) for a handful of albums."""
+    placeholders = ', '.join('?' * len(album_ids))
+    cursor = conn.execute(f"""
+        SELECT Albums.id, Albums.title, Artists.name, Albums.year FROM Albums
+        JOIN Artists ON Albums.artist_id = Artists.id
+        WHERE Albums.id IN ({placeholders})""", album_ids)
+    return {album_id: (title, artist, year) for album_id, title, artist, year in cursor.fetchall()}
+
+def scored_albums(index, best, conn):
+    """Turn SimilarityIndex.top's (row, score) pairs into (title, artist, year, score) rows."""
+    album_ids = [int(index.album_ids[row]) for row, score in best]
+    details = album_details(album_ids, conn) if album_ids else {}
+    return [details[album_id] + (round(score, 3),) for album_id, (row, score) in zip(album_ids, best)]
+
+def similar_albums(album_title, k=SIMILAR_ALBUMS, not_owned=False, conn=None):
+    """The k albums most like `album_title` by genres, styles and descriptors, as (title, artist, year, similarity) rows."""
+    conn = connection(conn)
+    index = similarity_index(conn=conn)
+    album_id = find_album_id(album_title, conn=conn)
+    row = index.row(album_id) if album_id is not None else None
+    if row is None:
+        return []
+    exclude = {row}
+    for other in (index.matches.get(album_id), index.matched_by.get(album_id)): # the same album under its other title
+        if other is not None and index.row(other) is not None:
+            exclude.add(index.row(other))
+    return scored_albums(index, index.top(index.scores(*index.vector(row)), k, exclude, not_owned), conn)
+
+def recommend_albums(k=SIMILAR_ALBUMS, conn=None):
+    """The k albums I don't own that are most like my collection as a whole, as (title, artist, year, similarity) rows."""
+    conn = connection(conn)
+    index = similarity_index(conn=conn)
+    return scored_albums(index, index.top(index.profile_scores(index.owned), k, not_owned=True), conn)
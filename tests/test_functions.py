@@ -0,0 +1,688 @@
+"""Checks for functions.py against a throwaway copy of my collection (python -m pytest tests)."""
+import copy
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import analytics
+import catalog
+import collection
+import db
+import functions
+import history
+import my_music
+import mutations
+import search
+import service
+import similarity
+import user_music
+
+STATS_TABLES = ['ArtistStats', 'GenreStats', 'FormatStats', 'DecadeFormatStats']
+PACKAGE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RYM_CSV = os.path.join(PACKAGE, 'rym_top_5000_all_time.csv')
+ALL_CSV = os.path.join(PACKAGE, 'all.csv')
+
+
+
+""" // HELPERS // """
+
+class CollectionTestCase(unittest.TestCase):
+    """Each test gets its own database file with my_music synced into it (after importing `catalogs`)."""
+    catalogs = ()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.conn = db.get_connection(os.path.join(self.directory, 'music.db'))
+        functions.create_tables(conn=self.conn)
+        for path in self.catalogs:
+            catalog.import_catalog(path, conn=self.conn)
+        self.sources = {'CD': copy.deepcopy(my_music.cds), 'cassette': copy.deepcopy(my_music.cassettes),
+                        'vinyl': copy.deepcopy(my_music.vinyl)}
+        for media_type, media_list in self.sources.items():
+            functions.sync_music(media_list, media_type, conn=self.conn)
+
+    def tearDown(self):
+        db.close_connections()
+        db.id_cache.clear()
+        shutil.rmtree(self.directory)
+
+    def stats(self):
+        return {table: sorted(self.conn.execute(f"SELECT * FROM {table} WHERE album_count > 0").fetchall())
+                for table in STATS_TABLES}
+
+    def assertStatsCurrent(self):
+        """The summary tables the triggers kept up to date match what rebuild_stats computes from scratch."""
+        kept = self.stats()
+        functions.rebuild_stats(conn=self.conn)
+        self.assertEqual(kept, self.stats())
+
+
+
+""" // QUERY PLANS // """
+
+class QueryPlanTests(CollectionTestCase):
+
+    def test_getters_use_indexes(self):
+        self.assertEqual(functions.full_table_scans(conn=self.conn), [])
+
+
+
+""" // ID CACHE // """
+
+class IdCacheTests(CollectionTestCase):
+
+    def cached(self, name):
+        return db.id_cache.get((db.database_key(self.conn), 'Artists', name))
+
+    def test_rolled_back_ids_are_forgotten(self):
+        seen = []
+        with self.assertRaises(RuntimeError):
+            with db.transaction(self.conn):
+                self.conn.execute("""INSERT INTO Artists (name) VALUES ('Nobody')""")
+                self.assertIsNotNone(functions.find_artist_id('Nobody', conn=self.conn))
+                thread = threading.Thread(target=lambda: seen.append(self.cached('Nobody')))
+                thread.start()
+                thread.join()
+                raise RuntimeError
+        self.assertEqual(seen, [None])
+        self.assertIsNone(functions.find_artist_id('Nobody', conn=self.conn))
+
+    def test_committed_ids_are_shared(self):
+        with db.transaction(self.conn):
+            self.conn.execute("""INSERT INTO Artists (name) VALUES ('Somebody')""")
+            found = functions.find_artist_id('Somebody', conn=self.conn)
+            self.assertIsNone(self.cached('Somebody'))
+        self.assertEqual(self.cached('Somebody'), found)
+
+    def test_other_connections_changes(self):
+        artist = self.sources['CD'][0][1]
+        self.assertIsNotNone(functions.find_artist_id(artist, conn=self.conn))
+        other = sqlite3.connect(os.path.join(self.directory, 'music.db'))
+        other.execute("""UPDATE Artists SET name = 'Renamed' WHERE name = ?""", (artist,))
+        other.commit()
+        other.close()
+        self.assertIsNone(functions.find_artist_id(artist, conn=self.conn))
+
+
+
+""" // PAGING // """
+
+class PagingTests(CollectionTestCase):
+
+    def test_pages_cover_every_row_once(self):
+        searches = {
+            'iter_formatted_albums': (),
+            'iter_albums_by_media': ('CD',),
+            'iter_albums_by_genre': ('Rock',),
+            'iter_albums_by_artist': (self.sources['vinyl'][0][1],),
+            'iter_albums_between_years': (1970, 1989),
+            'iter_album_view': (['Rock', 'Pop'],),
+        }
+        for name, args in searches.items():
+            with self.subTest(name):
+                search_rows = getattr(functions, name)
+                everything = list(search_rows(*args, conn=self.conn))
+                pages = [list(search_rows(*args, limit=7, offset=offset, conn=self.conn)) for offset in range(0, len(everything) + 7, 7)]
+                rows = [row for page in pages for row in page]
+                self.assertEqual(pages[-1], [])
+                self.assertEqual(len(rows), len(everything))
+                self.assertEqual(sorted(map(repr, rows)), sorted(map(repr, everything)))
+                self.assertEqual(pages[1], list(search_rows(*args, limit=7, offset=7, conn=self.conn)))
+
+
+
+""" // ALBUM VIEW // """
+
+class AlbumViewTests(CollectionTestCase):
+
+    def expected(self, genres, match, media=None):
+        """The titles my_music says should pass the genre filter (and are on `media`, if given)."""
+        tags, formats = {}, {}
+        for media_type, media_list in self.sources.items():
+            for title, artist, year, album_genres in media_list:
+                tags.setdefault(title, set()).update(album_genres)
+                formats.setdefault(title, set()).add(media_type)
+        test = set.issubset if match == 'all' else lambda wanted, found: bool(wanted & found)
+        return sorted(title for title in tags if test(set(genres), tags[title]) and (media is None or media in formats[title]))
+
+    def test_genre_matching(self):
+        for genres, match, media in [(['Rock', 'Pop'], 'all', None), (['Rock', 'Pop'], 'any', None),
+                                     (['Punk', 'Rock'], 'all', 'vinyl'), (['Indie', 'Folk'], 'any', 'CD'), ('Rock', 'all', None)]:
+            with self.subTest(genres=genres, match=match, media=media):
+                albums = functions.get_album_view(genres, match, media, conn=self.conn)
+                wanted = [genres] if isinstance(genres, str) else genres
+                self.assertEqual(sorted(album[0] for album in albums), self.expected(wanted, match, media))
+                for title, artist, year, formats, album_genres in albums:
+                    self.assertTrue(media is None or media in formats)
+
+    def test_bad_match(self):
+        with self.assertRaises(ValueError):
+            functions.get_album_view(['Rock'], match='some', conn=self.conn)
+
+
+
+""" // ANALYTICS // """
+
+class AnalyticsTests(CollectionTestCase):
+
+    def test_fetch_columns_keeps_the_row_order(self):
+        sql = """SELECT id, artist_id FROM Albums ORDER BY artist_id DESC, id"""
+        ids, artist_ids = analytics.fetch_columns(sql, 2, self.conn)
+        self.assertEqual(list(zip(ids.tolist(), artist_ids.tolist())), self.conn.execute(sql).fetchall())
+
+    def test_columns_match_the_database(self):
+        columns = analytics.collection_columns(conn=self.conn)
+        rows = [(columns['titles'][album], columns['artists'][artist], int(year) or None, columns['formats'][format_code])
+                for album, artist, year, format_code in zip(columns['album'], columns['artist'], columns['year'], columns['format'])]
+        self.assertEqual(sorted(rows, key=repr), sorted(functions.get_formatted_albums(conn=self.conn), key=repr))
+        decades, formats, counts = analytics.decade_format_table(columns)
+        table = [(int(decade), format_name, int(counts[i, j])) for i, decade in enumerate(decades)
+                 for j, format_name in enumerate(formats) if counts[i, j]]
+        self.assertEqual(sorted(table), sorted(functions.decade_format_counts(conn=self.conn)))
+
+
+
+""" // RESULT CACHE // """
+
+class ResultCacheTests(CollectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = db.ResultCache()
+        patcher = mock.patch.object(db, 'result_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.cache.close)
+
+    def artist_names(self):
+        return {name for id, name in functions.get_artists(conn=self.conn)}
+
+    def test_keys_include_the_module(self):
+        def make(module, value):
+            def getter(conn=None):
+                return value
+            getter.__module__ = module
+            return db.cached_result(getter)
+        getters = [make(module, module) for module in ('functions', 'catalog')]
+        self.assertEqual([getter(conn=self.conn) for getter in getters], ['functions', 'catalog'])
+
+    def test_writes_on_another_connection(self):
+        self.assertNotIn('Other Connection', self.artist_names())
+        other = db.connect(os.path.join(self.directory, 'music.db'))
+        functions.insert_artist('Other Connection', conn=other)
+        other.close()
+        self.assertIn('Other Connection', self.artist_names())
+
+    def test_writes_on_another_thread(self):
+        self.assertNotIn('Other Thread', self.artist_names())
+        def write():
+            functions.insert_artist('Other Thread', conn=os.path.join(self.directory, 'music.db'))
+            db.close_connections()
+        thread = threading.Thread(target=write)
+        thread.start()
+        thread.join()
+        self.assertIn('Other Thread', self.artist_names())
+
+    def test_generation_bump(self):
+        self.artist_names()
+        self.artist_names()
+        self.assertEqual((self.cache.hits, self.cache.stale), (1, 0))
+        db.bump_generation(self.conn)
+        self.conn.commit()
+        self.artist_names()
+        self.assertEqual((self.cache.hits, self.cache.stale), (1, 1))
+
+    def test_disk_round_trip(self):
+        self.cache.open(os.path.join(self.directory, 'cache.db'))
+        names = self.artist_names()
+        self.cache.entries.clear() # as if this were the next process
+        self.assertEqual(self.artist_names(), names)
+        self.assertEqual(self.cache.disk_hits, 1)
+
+
+
+""" // PROFILING // """
+
+class ProfilingTests(CollectionTestCase):
+
+    def test_connections_opened_earlier(self):
+        opened, enabled, instrumented = threading.Event(), threading.Event(), []
+        def read():
+            conn = db.get_connection(os.path.join(self.directory, 'music.db'))
+            opened.set()
+            enabled.wait()
+            conn.execute("""SELECT COUNT(*) FROM Genres""").fetchone()
+            instrumented.append(conn.instrumented)
+            db.close_connections()
+        thread = threading.Thread(target=read)
+        self.addCleanup(db.query_profile.clear)
+        with mock.patch.dict(db.profiling):
+            thread.start()
+            opened.wait()
+            db.enable_profiling()
+            enabled.set()
+            thread.join()
+            self.conn.execute("""SELECT COUNT(*) FROM Artists""").fetchone()
+        self.assertEqual(instrumented, [True])
+        self.assertTrue(self.conn.instrumented)
+        profiled = {row['sql'] for row in db.query_profile.summary()}
+        self.assertTrue({"SELECT COUNT(*) FROM Genres", "SELECT COUNT(*) FROM Artists"} <= profiled)
+
+
+
+""" // SAMPLING // """
+
+class SampleTests(CollectionTestCase):
+
+    def test_seed_repeats_the_draw(self):
+        for filters in [{}, {'genre': 'Rock'}, {'media': 'vinyl'}, {'start_year': 1970, 'end_year': 1979},
+                        {'weight': 'rating'}, {'weight': 'fresh', 'genre': 'Pop'}]:
+            with self.subTest(**filters):
+                first = functions.sample_albums(5, rng=42, conn=self.conn, **filters)
+                self.assertEqual(len(first), 5)
+                self.assertEqual(first, functions.sample_albums(5, rng=42, conn=self.conn, **filters))
+
+    def test_samples_match_filters(self):
+        rock = set(functions.get_albums_by_genre('Rock', conn=self.conn))
+        samples = functions.sample_albums(10, genre='Rock', media='CD', rng=7, conn=self.conn)
+        self.assertEqual(len(set(samples)), len(samples))
+        for title, artist, year, format_name in samples:
+            self.assertEqual(format_name, 'CD')
+            self.assertIn(title, {row[0] for row in rock})
+
+    def test_draws_whole_pool(self):
+        available = functions.count_albums(media='cassette', conn=self.conn)
+        samples = functions.sample_albums(available + 10, media='cassette', rng=1, conn=self.conn)
+        self.assertEqual(len(set(samples)), available)
+
+    def test_menu_prints_a_short_draw(self):
+        # albums rated 0 are never drawn with weight='rating', so asking for every cassette gets back fewer
+        self.conn.execute("""
+            INSERT INTO CatalogAlbums (album_id, source, average_rating)
+            SELECT album_id, 'rym', 0.0 FROM FormattedAlbums
+            WHERE format_id = (SELECT id FROM Formats WHERE format_name = 'cassette') LIMIT -1 OFFSET 2""")
+        self.conn.commit()
+        available = functions.count_albums(media='cassette', conn=self.conn)
+        with mock.patch('builtins.input', return_value=str(available)), \
+             mock.patch('functions.record_suggestions') as record, mock.patch('builtins.print'):
+            functions.suggest_sample(media='cassette', weight='rating', conn=self.conn)
+        self.assertEqual(len(record.call_args.args[0]), 2)
+
+    def test_unknown_weight(self):
+        with self.assertRaises(ValueError):
+            functions.sample_albums(1, weight='loudness', conn=self.conn)
+
+
+
+""" // HISTORY // """
+
+class HistoryBufferTests(CollectionTestCase):
+
+    def play_stats(self, title):
+        return self.conn.execute("""
+            SELECT suggested, played FROM AlbumPlayStats JOIN Albums ON Albums.id = album_id
+            WHERE title = ?""", (title,)).fetchall()
+
+    def test_flushes_at_batch_size(self):
+        buffer = history.HistoryBuffer(batch=3)
+        key = db.database_key(self.conn)
+        title = my_music.vinyl[0][0]
+        buffer.add(key, [(title, 'vinyl', 'suggested', 1.0)] * 2)
+        self.assertEqual(buffer.stats(), {'pending': 2, 'written': 0})
+        self.assertIsNone(buffer.flusher)
+        buffer.add(key, [(title, 'vinyl', 'played', 2.0)])
+        buffer.flusher.join()
+        self.assertEqual(buffer.stats(), {'pending': 0, 'written': 3})
+        self.assertEqual(self.play_stats(title), [(2, 1)])
+        buffer.add(key, [(title, 'vinyl', 'played', 3.0)])
+        buffer.close()
+        self.assertEqual(buffer.stats(), {'pending': 0, 'written': 4})
+        self.assertEqual(self.play_stats(title), [(2, 2)])
+
+    def test_flushes_at_exit(self):
+        title = my_music.vinyl[0][0]
+        script = ("import sys, db, functions, history\n"
+                  "conn = db.get_connection(sys.argv[1])\n"
+                  "history.record_played(sys.argv[2], 'vinyl', conn=conn)\n"
+                  "assert history.history_buffer.stats() == {'pending': 1, 'written': 0}\n")
+        db.close_connections()
+        subprocess.run([sys.executable, '-c', script, os.path.join(self.directory, 'music.db'), title],
+                       cwd=PACKAGE, check=True, capture_output=True)
+        self.conn = db.get_connection(os.path.join(self.directory, 'music.db'))
+        self.assertEqual(self.play_stats(title), [(0, 1)])
+
+
+
+""" // FUZZY SEARCH // """
+
+class SearchTests(CollectionTestCase):
+
+    def test_writes_leave_nothing_queued(self):
+        functions.insert_album('Tolouse Street Live', 'The Doobie Brothers', 1973, conn=self.conn)
+        functions.associate_album_with_genres('Tolouse Street Live', ['Rock'], conn=self.conn)
+        self.assertEqual(self.conn.execute("""SELECT COUNT(*) FROM SearchQueue""").fetchone()[0], 0)
+
+    def test_read_only_connection(self):
+        self.conn.execute("""INSERT INTO SearchQueue (album_id) SELECT id FROM Albums LIMIT 1""")
+        self.conn.commit()
+        path = os.path.join(self.directory, 'music.db')
+        reader = sqlite3.connect(f'file:{path}?mode=ro', uri=True, factory=db.Connection)
+        try:
+            self.assertEqual(search.fuzzy_search('Tolouse Stret', limit=1, conn=reader)[0][1], 'Tolouse Street')
+        finally:
+            reader.close()
+
+    def test_like_fallback(self):
+        for text in ['Tolouse Stret', 'Snoop Doggy Dog', 'Fleetwod Mac']:
+            with self.subTest(text=text):
+                indexed = search.fuzzy_search(text, limit=1, conn=self.conn)
+                with mock.patch.object(search, 'has_search_index', return_value=False):
+                    scanned = search.fuzzy_search(text, limit=1, conn=self.conn)
+                self.assertEqual(scanned[0][0], indexed[0][0])
+
+
+
+""" // SUMMARY TABLES // """
+
+class StatsTests(CollectionTestCase):
+
+    def test_after_sync(self):
+        self.assertStatsCurrent()
+
+    def test_insert(self):
+        functions.insert_album('Test Album', 'Test Artist', 1999, conn=self.conn)
+        functions.associate_album_with_genres('Test Album', ['Rock', 'Test Genre'], conn=self.conn)
+        functions.insert_formatted_album('Test Album', 'vinyl', conn=self.conn)
+        functions.insert_formatted_album('Test Album', 'CD', conn=self.conn)
+        self.assertStatsCurrent()
+
+    def test_delete_formatted_album(self):
+        title = self.sources['CD'][0][0]
+        functions.delete_formatted_album(title, 'CD', conn=self.conn)
+        self.assertStatsCurrent()
+
+    def test_genres(self):
+        title = self.sources['vinyl'][0][0]
+        functions.associate_album_with_genres(title, ['Shoegaze'], conn=self.conn)
+        functions.remove_genre_from_album(title, self.sources['vinyl'][0][3][0], conn=self.conn)
+        self.assertStatsCurrent()
+
+    def test_sync_changes(self):
+        cds = self.sources['CD']
+        cds[0] = [cds[0][0], 'Someone Else', 1966, ['Jazz']]
+        del cds[1]
+        cds.append(['Brand New', 'New Artist', 2025, ['Pop']])
+        functions.sync_music(cds, 'CD', conn=self.conn)
+        self.assertStatsCurrent()
+
+    def test_bulk_deletes(self):
+        mutations.delete_formatted_albums(media='cassette', conn=self.conn)
+        self.assertStatsCurrent()
+        mutations.delete_formatted_albums([self.sources['CD'][0][0]], conn=self.conn)
+        self.assertStatsCurrent()
+        mutations.delete_albums([self.sources['vinyl'][0][0]], conn=self.conn)
+        self.assertStatsCurrent()
+
+    def test_retag(self):
+        mutations.retag_albums(add=['Classic Rock'], remove=['Rock'], genres='Rock', conn=self.conn) # big enough to rebuild the stats
+        self.assertStatsCurrent()
+        mutations.retag_albums([self.sources['CD'][0][0]], add=['Rap'], conn=self.conn)
+        self.assertStatsCurrent()
+
+    def test_merges(self):
+        mutations.merge_genres({'Pop': 'Rock'}, conn=self.conn)
+        self.assertStatsCurrent()
+        mutations.merge_artists({self.sources['CD'][0][1]: self.sources['CD'][1][1]}, conn=self.conn)
+        self.assertStatsCurrent()
+        mutations.merge_albums({self.sources['vinyl'][0][0]: self.sources['CD'][2][0]}, conn=self.conn)
+        self.assertStatsCurrent()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+
+""" // SNAPSHOTS // """
+
+class SnapshotTests(CollectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.snapshot_path = collection.export_snapshot(os.path.join(self.directory, 'music.snapshot'), conn=self.conn)
+        self.snapshot = collection.Collection.open(self.snapshot_path)
+        self.addCleanup(self.snapshot.close)
+
+    def test_round_trip(self):
+        def albums(source):
+            return [(album.title, album.artist, album.year, sorted(album.genres), album.format) for album in source]
+        loaded = collection.Collection.from_database(conn=self.conn)
+        self.assertEqual(albums(self.snapshot), albums(loaded))
+        self.assertEqual(sorted(map(repr, map(self.snapshot.row, range(len(self.snapshot))))),
+                         sorted(map(repr, functions.get_formatted_albums(conn=self.conn))))
+        for kind in ('genre', 'format'):
+            self.assertEqual(self.snapshot.name_rows(kind), loaded.name_rows(kind))
+
+    def test_getters_match_the_database(self):
+        getters = {
+            'get_artists': lambda rows: sorted(name for id, name in rows),
+            'get_albums': lambda rows: sorted(row[1] for row in rows),
+            'descending_count_albums_by_artist': sorted,
+            'genre_album_counts': sorted,
+            'format_album_counts': sorted,
+            'decade_format_counts': sorted,
+        }
+        for name, normalize in getters.items():
+            with self.subTest(name):
+                getter = getattr(functions, name)
+                self.assertEqual(normalize(getter(conn=self.snapshot)), normalize(getter(conn=self.conn)))
+        self.assertEqual(sorted(functions.get_genres_for_album('Wish', conn=self.snapshot)), ['Indie', 'Pop'])
+
+    def test_fuzzy_search(self):
+        self.assertEqual(search.fuzzy_search('Tolouse Stret', limit=1, conn=self.snapshot)[0][1:3],
+                         search.fuzzy_search('Tolouse Stret', limit=1, conn=self.conn)[0][1:3])
+
+    def test_batch_mode(self):
+        args = {
+            'suggest': {'quantity': 3, 'media': 'vinyl'},
+            'count': {'genre': 'Rock'},
+            'by_artist': {'artist_name': 'Eagles'},
+            'by_genre': {'genre_name': 'Rock', 'limit': 5},
+            'by_media': {'media_type': 'CD', 'limit': 5},
+            'between_years': {'start_year': 1970, 'end_year': 1979},
+            'albums': {'genres': ['Rock', 'Pop'], 'match': 'all'},
+            'artist_count': {'artist_name': 'Eagles'},
+            'artists_by_count': {},
+            'genre_counts': {},
+            'genres_for_album': {'album_title': 'Wish'},
+            'fuzzy_search': {'text': 'Tolouse Stret'},
+            'find_artist': {'name': 'Eagels'},
+        }
+        self.assertEqual(set(args), set(service.OPERATIONS))
+        queries, replies = os.path.join(self.directory, 'queries.jsonl'), os.path.join(self.directory, 'replies.jsonl')
+        with open(queries, 'w') as file:
+            file.writelines(json.dumps({'id': op, 'op': op, 'args': op_args}) + '\n' for op, op_args in args.items())
+        with mock.patch.object(user_music, 'SNAPSHOT', self.snapshot_path), mock.patch('sys.stderr'):
+            user_music.batch_main(['--batch', queries, '--output', replies])
+        with open(replies) as file:
+            replies = [json.loads(line) for line in file]
+        self.assertEqual([reply.get('error') for reply in replies], [None] * len(args))
+        self.assertEqual(sorted({reply['id']: reply['result'] for reply in replies}['genres_for_album']), ['Indie', 'Pop'])
+
+
+
+""" // BULK LOADING // """
+
+class BulkInsertTests(CollectionTestCase):
+
+    def album(self, album_id):
+        return self.conn.execute("""
+            SELECT Albums.title, Artists.name FROM Albums JOIN Artists ON Albums.artist_id = Artists.id
+            WHERE Albums.id = ?""", (album_id,)).fetchone()
+
+    def test_returns_each_records_id(self):
+        existing = self.sources['CD'][0]
+        records = [['Bulk One', 'Bulk Artist', 2001, ['Pop']], existing, ['Bulk Two', 'Bulk Artist', 2002, []],
+                   ['Bulk One', 'Bulk Artist', 2001, ['Pop']], ['Bulk One', 'Other Artist', 2003, ['Rock']]]
+        album_ids = functions.bulk_insert_albums(records, 'vinyl', conn=self.conn)
+        self.assertEqual([self.album(album_id) for album_id in album_ids], [tuple(record[:2]) for record in records])
+        self.assertEqual(album_ids[0], album_ids[3])
+        self.assertNotEqual(album_ids[0], album_ids[4])
+        self.assertEqual(album_ids[1], functions.find_album_id(existing[0], conn=self.conn))
+        self.assertStatsCurrent()
+
+
+
+""" // SIMILARITY // """
+
+class SimilarityTests(CollectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        functions.bulk_insert_albums([['Target', 'Similar Artist', 2000, ['Zeta', 'Eta', 'Theta']],
+                                      ['Twin', 'Similar Artist', 2001, ['Zeta', 'Eta', 'Theta']],
+                                      ['Close', 'Similar Artist', 2002, ['Zeta', 'Eta', 'Theta', 'Rock']],
+                                      ['Far', 'Similar Artist', 2003, ['Zeta']]], 'vinyl', conn=self.conn)
+        functions.bulk_insert_albums([['Unowned Twin', 'Other Artist', 2004, ['Zeta', 'Eta', 'Theta']]], conn=self.conn)
+
+    def test_ranking(self):
+        rows = similarity.similar_albums('Target', conn=self.conn)
+        titles, scores = [row[0] for row in rows], [row[3] for row in rows]
+        self.assertEqual(set(titles[:2]), {'Twin', 'Unowned Twin'}) # the same tags, so a cosine of 1
+        self.assertEqual(titles[2:], ['Close', 'Far']) # albums sharing no tag with Target aren't listed at all
+        self.assertEqual(scores[:2], [1.0, 1.0])
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_not_owned(self):
+        rows = similarity.similar_albums('Target', not_owned=True, conn=self.conn)
+        self.assertEqual([row[:2] for row in rows], [('Unowned Twin', 'Other Artist')])
+
+    def test_index_follows_writes(self):
+        similarity.similar_albums('Target', conn=self.conn)
+        functions.remove_genre_from_album('Twin', 'Theta', conn=self.conn)
+        titles = [row[0] for row in similarity.similar_albums('Target', conn=self.conn)]
+        self.assertEqual(titles[0], 'Unowned Twin')
+
+
+
+""" // INCREMENTAL SYNC // """
+
+class SyncTests(CollectionTestCase):
+
+    def test_unwritten_records_are_retried(self):
+        write_albums = functions.write_albums
+        def drop_first(records, format_name=None, conn=None):
+            return [None] + write_albums(records[1:], format_name, conn=conn)
+        cds = self.sources['CD'] + [['New One', 'New Artist', 2001, ['Pop']], ['New Two', 'New Artist', 2002, ['Pop']]]
+        with mock.patch('functions.write_albums', drop_first):
+            stats = functions.sync_music(cds, 'CD', quiet=True, conn=self.conn)
+        self.assertEqual((stats['added'], stats['failed']), (1, ['New One']))
+        stats = functions.sync_music(cds, 'CD', quiet=True, conn=self.conn)
+        self.assertEqual((stats['added'], stats['failed']), (1, []))
+        self.assertIsNotNone(functions.find_album_id('New One', conn=self.conn))
+
+
+
+""" // CATALOGS // """
+
+class CatalogFirstTests(CollectionTestCase):
+    catalogs = (RYM_CSV,)
+
+    def owned(self):
+        cursor = self.conn.execute("""
+            SELECT Albums.title, Artists.name FROM Albums
+            JOIN Artists ON Albums.artist_id = Artists.id
+            WHERE Albums.id IN (SELECT album_id FROM FormattedAlbums)""")
+        return set(cursor.fetchall())
+
+    def test_sync_keeps_titles_the_catalog_has(self):
+        owned = self.owned()
+        for media_list in self.sources.values():
+            for title, artist, year, genres in media_list:
+                self.assertIn((title, artist), owned)
+        self.assertIn(('Wish', 'Cure'), self.conn.execute("""
+            SELECT Albums.title, Artists.name FROM Albums JOIN Artists ON Albums.artist_id = Artists.id""").fetchall())
+
+    def test_titles_mean_the_owned_album(self):
+        album_id = functions.find_album_id('Wish', conn=self.conn)
+        cursor = self.conn.execute("""SELECT Artists.name FROM Albums JOIN Artists ON Albums.artist_id = Artists.id WHERE Albums.id = ?""",
+                                   (album_id,))
+        self.assertEqual(cursor.fetchone()[0], 'The Cure')
+        self.assertEqual(sorted(functions.get_genres_for_album('Wish', conn=self.conn)), sorted(['Indie', 'Pop']))
+
+    def test_delete_albums_spares_the_catalog(self):
+        count = """SELECT COUNT(*) FROM Albums WHERE title = 'Wish'"""
+        mutations.delete_albums(['Wish'], conn=self.conn)
+        self.assertEqual(self.conn.execute(count).fetchone()[0], 1) # Wish by Cure, from the catalog
+        mutations.delete_albums(['Wish'], owned=False, conn=self.conn)
+        self.assertEqual(self.conn.execute(count).fetchone()[0], 0)
+
+    def test_resync_after_import(self):
+        catalog.import_catalog(RYM_CSV, conn=self.conn)
+        self.sources['CD'].append(['Icon', 'Paradise Lost', 1993, ['Metal']])
+        functions.sync_music(self.sources['CD'], 'CD', conn=self.conn)
+        self.assertIn(('Icon', 'Paradise Lost'), self.owned())
+        self.assertIn(('Icon', 'Lynyrd Skynyrd'), self.owned())
+        self.assertStatsCurrent()
+
+
+class CatalogImportTests(CollectionTestCase):
+
+    def catalog_rows(self, conn):
+        return conn.execute("""SELECT COUNT(*), COUNT(DISTINCT album_id) FROM CatalogAlbums""").fetchone()
+
+    def test_resumes_after_an_interrupted_shard(self):
+        write_shard, written = catalog.write_shard, []
+        def interrupt(shard, parsed, stats, conn):
+            if len(written) == 3:
+                raise KeyboardInterrupt
+            write_shard(shard, parsed, stats, conn)
+            written.append(shard)
+        with mock.patch('catalog.write_shard', interrupt), mock.patch('builtins.print'):
+            with self.assertRaises(KeyboardInterrupt):
+                catalog.import_catalogs([ALL_CSV], workers=2, shard_bytes=2 ** 15, conn=self.conn)
+        with mock.patch('builtins.print'):
+            stats = catalog.import_catalogs([ALL_CSV], workers=2, shard_bytes=2 ** 15, conn=self.conn)
+        self.assertEqual(stats['resumed'], 3)
+        self.assertGreater(stats['shards'], 0)
+
+        fresh = db.get_connection(os.path.join(self.directory, 'fresh.db'))
+        functions.create_tables(conn=fresh)
+        with mock.patch('builtins.print'):
+            catalog.import_catalogs([ALL_CSV], workers=2, shard_bytes=2 ** 15, conn=fresh)
+        self.assertEqual(self.catalog_rows(self.conn), self.catalog_rows(fresh))
+
+
+class CatalogMatchTests(CollectionTestCase):
+    # my album -> the catalog album it is, spelled the way the bundled CSVs spell it
+    PAIRS = {('Wish', 'The Cure'): ('Wish', 'Cure'),
+             ('Dig Me Out', 'Sleater Kinney'): ('Dig Me Out', 'Sleater-Kinney'),
+             ('Bad Co', 'Bad Co'): ('Bad Co', 'Bad Company')}
+
+    def assertPairsMatch(self, conn):
+        catalog.match_collection_to_catalog(conn=conn)
+        matches = {row[:2]: row[2:4] for row in catalog.get_catalog_matches(conn=conn)}
+        for owned, expected in self.PAIRS.items():
+            self.assertEqual(matches.get(owned), expected)
+
+    def test_sync_then_import(self):
+        for path in (ALL_CSV, RYM_CSV):
+            catalog.import_catalog(path, conn=self.conn)
+        self.assertPairsMatch(self.conn)
+
+    def test_import_then_sync(self):
+        conn = db.get_connection(os.path.join(self.directory, 'catalogs_first.db'))
+        functions.create_tables(conn=conn)
+        for path in (ALL_CSV, RYM_CSV):
+            catalog.import_catalog(path, conn=conn)
+        for media_type, media_list in self.sources.items():
+            functions.sync_music(media_list, media_type, conn=conn)
+        self.assertPairsMatch(conn)
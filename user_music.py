@@ -1,11 +1,120 @@
 """Script for user input for Personal Music Collection project,
-Myriah Hodgson 06/22/2024"""
+Myriah Hodgson 06/22/2024
 
-import sqlite3
+`python user_music.py --batch queries.jsonl` (or `--batch -` to read stdin) answers a whole file of queries without
+the menu, one JSON reply line per query, and reports the queries/sec at the end. Each line is a query, ie
+    {"id": 1, "op": "by_artist", "args": {"artist_name": "Eagles"}}
+    {"id": 2, "op": "suggest", "args": {"quantity": 3, "start_year": 1970, "end_year": 1979, "media": "vinyl"}}
+with the ops service.py takes (suggest, count, by_artist, by_genre, by_media, between_years, albums, ...)."""
+
+import os
+import sys
+import threading
+
+import db
 import functions
 import my_music
 import random as rand
 
+# A snapshot file written by collection.export_snapshot; when set, searches and suggestions are answered from it
+# (read-only, no database needed) instead of syncing and querying the database
+SNAPSHOT = os.environ.get('MUSIC_DB_SNAPSHOT')
+
+def sync_collection(errors, reports=None):
+    """Bring the database up to date with my_music on its own thread, handing back errors (and with `reports`, the stats)."""
+    try:
+        functions.ensure_schema() # Create the tables needed, if necessary (one PRAGMA when they already are)
+        for media_list, media_type in [(my_music.cds, 'CD'), (my_music.cassettes, 'cassette'), (my_music.vinyl, 'vinyl')]:
+            # only what changed in my_music since the last run is written
+            stats = functions.sync_music(media_list, media_type, quiet=reports is not None)
+            if reports is not None:
+                reports.append(stats)
+    except Exception as error:
+        errors.append(error)
+    finally:
+        db.close_connections()
+
+def print_sync_reports(reports):
+    """Print what the background sync changed, once the menu is done with the screen."""
+    for stats in reports:
+        if stats['added'] or stats['changed'] or stats['removed'] or stats['failed']:
+            print(functions.sync_summary(stats))
+
+def run_batch(queries, output, conn=None):
+    """Answer each JSON query line on the one connection `conn`, writing each reply as soon as it is ready; returns (timings, errors)."""
+    import json
+    import time
+    import service # the ops and how a request is answered are shared with the service
+    timings = {}
+    errors = 0
+    for line in queries:
+        if not line.strip():
+            continue
+        start = time.perf_counter()
+        try:
+            request = json.loads(line)
+        except ValueError as error:
+            request = None
+            reply = {'id': None, 'error': f"bad query: {error}"}
+        else:
+            reply = service.answer_request(request, conn, limit=None)
+        reply['ms'] = round((time.perf_counter() - start) * 1000, 3)
+        output.write(json.dumps(reply) + '\n')
+        errors += 'error' in reply
+        op = request.get('op') if isinstance(request, dict) else None
+        timings.setdefault(op if isinstance(op, str) else '(bad query)', []).append(reply['ms'])
+    output.flush()
+    return timings, errors
+
+def print_batch_report(timings, errors, seconds, file=sys.stderr):
+    """How many queries ran and how fast, overall and for each op."""
+    count = sum(len(times) for times in timings.values())
+    print(f"{count} queries in {seconds:.2f}s: {count / seconds if seconds else 0:,.0f} queries/sec, {errors} errors", file=file)
+    for op, times in sorted(timings.items(), key=lambda item: -len(item[1])):
+        times = sorted(times)
+        print(f"  {op}: {len(times)} queries, {1000 * len(times) / (sum(times) or 1):,.0f}/sec, mean {sum(times) / len(times):.3f} ms, "
+              f"p50 {times[len(times) // 2]:.3f} ms, p95 {times[min(len(times) - 1, int(len(times) * 0.95))]:.3f} ms", file=file)
+
+def batch_main(arguments):
+    """`python user_music.py --batch FILE`: answer every query in FILE (or stdin) without the menu."""
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch', required=True, metavar='FILE', help="JSON lines of queries; '-' reads stdin")
+    parser.add_argument('--output', default='-', help="where the JSON reply lines go; '-' (the default) is stdout")
+    parser.add_argument('--database', default=db.DATABASE)
+    parser.add_argument('--sync', action='store_true', help='bring the database up to date with my_music first')
+    args = parser.parse_args(arguments)
+
+    if SNAPSHOT:
+        import collection # only needed for snapshots
+        conn = collection.Collection.open(SNAPSHOT)
+    else:
+        db.use_database(args.database)
+        if args.sync:
+            import contextlib
+            sync_errors = []
+            with contextlib.redirect_stdout(sys.stderr): # stdout is only for the replies
+                sync_collection(sync_errors)
+            if sync_errors:
+                raise sync_errors[0]
+        functions.ensure_schema()
+        conn = db.get_connection() # one warm connection for every query
+    queries = sys.stdin if args.batch == '-' else open(args.batch, encoding='utf-8')
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    start = time.perf_counter()
+    try:
+        timings, errors = run_batch(queries, output, conn)
+    finally:
+        for file in (queries, output):
+            if file not in (sys.stdin, sys.stdout):
+                file.close()
+    print_batch_report(timings, errors, time.perf_counter() - start)
+    if SNAPSHOT:
+        conn.close()
+    db.close_connections()
+    db.print_query_profile() # only when MUSIC_DB_PROFILE is set
+
 def main():
 
     # Greet the user... hehe
@@ -15,14 +124,17 @@ def main():
     # My music, or someone else's? (Develop a more generalized way to connect to a different database, eventually...)
     myriah = input("Will you be using Myriah's music today? ('Yes' or 'No')\n").strip().lower()
 
-    if myriah == 'yes':
-        # Connect to the database/create it, if not yet created
-        conn = sqlite3.connect('music_collection.db')
-        cursor = conn.cursor()
-        functions.create_tables() # Create the tables needed, if necessary
-        functions.add_music(my_music.cds, 'CD')
-        functions.add_music(my_music.cassettes, 'cassette')
-        functions.add_music(my_music.vinyl, 'vinyl')
+    snapshot = None
+    if myriah == 'yes' and SNAPSHOT:
+        import collection # only needed for snapshots
+        snapshot = collection.Collection.open(SNAPSHOT)
+        sync = None
+    elif myriah == 'yes':
+        # The database is opened (and created, if not yet created) in the background, so the menu shows up right away
+        sync_errors = []
+        sync_reports = [] # printed after the join, so the sync doesn't write over the menu
+        sync = threading.Thread(target=sync_collection, args=(sync_errors, sync_reports), name='sync')
+        sync.start()
     else:
         print(f"Apologies, but outside collections are not yet supported. Sorry!")
         return
@@ -34,20 +146,36 @@ def main():
     print(f"(3) Add music to your database")
 
     use = input("Choose '1', '2', or '3':\n").strip()
+    if sync:
+        sync.join() # whatever was chosen should see the whole collection
+        print_sync_reports(sync_reports)
+        if sync_errors:
+            raise sync_errors[0]
 
     if use == '1': # RANDOMIZED ALBUM SUGGESTION
-        functions.random_album_suggestion()
+        functions.random_album_suggestion(conn=snapshot)
     elif use == '2': # QUERYING
-        functions.search_albums()
+        functions.search_albums(conn=snapshot)
+    elif use == '3' and snapshot: # a snapshot is read-only
+        print("Music can't be added to a snapshot. Unset MUSIC_DB_SNAPSHOT to add music to your database.")
     elif use == '3': # ADDING MUSIC
         functions.add_new_music()
     else:
         print("Invalid selection. Please restart the program and choose a valid option.")
     
-    # Close the database connection
-    conn.close()
+    # Close the database connection (or snapshot)
+    if snapshot:
+        snapshot.close()
+    db.close_connections()
+    db.print_query_profile() # only when MUSIC_DB_PROFILE is set
     return
 
 if __name__ == "__main__":
-    main()
+    if db.profiling['enabled']:
+        import logging
+        logging.basicConfig(level=logging.DEBUG if db.profiling['trace'] else logging.WARNING)
+    if len(sys.argv) > 1:
+        batch_main(sys.argv[1:])
+    else:
+        main()
 